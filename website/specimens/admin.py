@@ -1,14 +1,42 @@
-from django.contrib import admin
+import calendar
+import datetime
+import os
+
+from django.contrib import admin, messages
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.admin.views.main import SEARCH_VAR
+from django.contrib.admin.widgets import ForeignKeyRawIdWidget
+from django.conf.urls import url
+from django.core.exceptions import PermissionDenied
+from django.db import transaction
+from django.db.models import BooleanField, Case, Exists, OuterRef, Q, Value, When
+from django.http import FileResponse, Http404, HttpResponseRedirect, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.template.response import TemplateResponse
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import require_GET, require_POST
+from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 from django import forms
 
-from mptt.admin import DraggableMPTTAdmin
+from mptt.exceptions import InvalidMove
 
 from .models import (Specimen, SpecimenLocation, Person, Fixation, Station, Expedition, SpecimenPicture, Taxon,
-                     Bioregion, Gear)
+                     TaxonRank, Bioregion, Gear, ExportJob, AUSTRAL_SEASONS)
+from .bioregions import assign_bioregions, bioregion_for_point
+from .exports import default_export_fields, enqueue_export
+from .reconciliation import reconcile_specimens
+from .routers import replica_configured, use_replica
+from .taxonomy import get_taxonomy_snapshot, bump_version
 from .widgets import LatLongWidget
 
 
+def is_autocomplete(request):
+    """Whether the request is for the autocomplete view of a ModelAdmin (rather than its changelist)."""
+    return request.resolver_match is not None and request.resolver_match.url_name.endswith('_autocomplete')
+
+
 # Custom form to provide lat/lon widget instead of OL map.
 class MyAdminForm(forms.ModelForm):
 
@@ -20,6 +48,92 @@ class MyAdminForm(forms.ModelForm):
         }
 
 
+class SpecimenAdminForm(forms.ModelForm):
+    # Not a model field: stored in a separate table (see SpecimenSequence)
+    sequence_fasta = forms.CharField(required=False, widget=forms.Textarea)
+
+    class Meta:
+        model = Specimen
+        fields = "__all__"
+
+    def __init__(self, *args, **kwargs):
+        super(SpecimenAdminForm, self).__init__(*args, **kwargs)
+        if self.instance.pk is not None:
+            self.initial.setdefault('sequence_fasta', self.instance.sequence_fasta)
+
+    def save(self, commit=True):
+        if 'sequence_fasta' in self.changed_data:  # Otherwise, don't rewrite it
+            self.instance.sequence_fasta = self.cleaned_data['sequence_fasta']
+        return super(SpecimenAdminForm, self).save(commit)
+
+
+def background_export_action(format):
+    """Admin action enqueuing an export of the selected objects (see exports.py).
+
+    Exported fields are the export_fields attribute of the ModelAdmin, or all the concrete fields of the model.
+    """
+    def export_in_background(modeladmin, request, queryset):
+        fields = getattr(modeladmin, 'export_fields', None) or default_export_fields(modeladmin.model)
+        # "Select all": the worker runs the changelist query again, rather than getting a (long) list of ids
+        select_across = request.POST.get('select_across') == '1'
+        job = enqueue_export(queryset, fields, format=format, user=request.user,
+                             changelist_params=request.GET.dict() if select_across else None)
+        modeladmin.message_user(request, format_html(
+            'Export #{pk} queued, it will be available from the <a href="{url}">export jobs</a> page.',
+            pk=job.pk, url=reverse('admin:specimens_exportjob_changelist')), messages.SUCCESS)
+
+    export_in_background.__name__ = 'export_{format}_in_background'.format(format=format)
+    export_in_background.short_description = 'Export selected %(verbose_name_plural)s in background ({format})'.format(
+        format=dict(ExportJob.FORMAT_CHOICES)[format])
+    return export_in_background
+
+
+class BackgroundExportMixin(object):
+    """Adds the background export actions to the ModelAdmin (ModelAdmin.get_actions() collects the actions of the
+    parent classes).
+    """
+    actions = [background_export_action(export_format) for export_format in (ExportJob.CSV, ExportJob.XLSX)]
+
+
+class ReplicaChangeListMixin(object):
+    """Changelists read from the replica database (see routers.py), for the users who opted in.
+
+    The choice is kept in the session, and changed with the link of the object tools (see replica_reads.html).
+    """
+    REPLICA_SESSION_KEY = 'replica_changelists'
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        return [
+            url(r'^replica_reads/$', self.admin_site.admin_view(self.replica_reads_view),
+                name='{0}_{1}_replica_reads'.format(*info)),
+        ] + super(ReplicaChangeListMixin, self).get_urls()
+
+    def replica_reads_view(self, request):
+        request.session[self.REPLICA_SESSION_KEY] = request.GET.get('on') == '1'
+        opts = self.model._meta
+        return HttpResponseRedirect(reverse('admin:{0}_{1}_changelist'.format(opts.app_label, opts.model_name)))
+
+    def changelist_view(self, request, extra_context=None):
+        replica_reads = replica_configured() and request.session.get(self.REPLICA_SESSION_KEY, False)
+        extra_context = dict(extra_context or {}, replica_configured=replica_configured(), replica_reads=replica_reads)
+        if request.method != 'GET' or not replica_reads:  # Actions are POSTed to the changelist
+            return super(ReplicaChangeListMixin, self).changelist_view(request, extra_context)
+
+        with use_replica():
+            response = super(ReplicaChangeListMixin, self).changelist_view(request, extra_context)
+            if hasattr(response, 'render'):
+                response.render()  # The queries run when the template is rendered
+        return response
+
+
+class AssignTaxonForm(forms.Form):
+    taxon = forms.ModelChoiceField(queryset=Taxon.objects.all(),
+                                   widget=ForeignKeyRawIdWidget(Specimen._meta.get_field('taxon').remote_field,
+                                                                admin.site))
+    uncertain_identification = forms.NullBooleanField(required=False, help_text='Leave "Unknown" to keep it unchanged')
+
+
 class SpecimenPictureInline(admin.TabularInline):
     model = SpecimenPicture
 
@@ -58,14 +172,132 @@ class HasGearListFilter(HasFKListFilter):
     title = _('Has gear')
 
 
+class FloatRangeListFilter(admin.SimpleListFilter):
+    """Filter on predefined [min, max) ranges of a float field. Subclasses define field_name and ranges."""
+    ranges = ()  # (min, max) pairs, None for no bound
+
+    @staticmethod
+    def _range_label(min_value, max_value):
+        if min_value is None:
+            return '< {max}'.format(max=max_value)
+        if max_value is None:
+            return '>= {min}'.format(min=min_value)
+        return '{min} - {max}'.format(min=min_value, max=max_value)
+
+    def lookups(self, request, model_admin):
+        choices = [(str(i), self._range_label(min_value, max_value))
+                   for i, (min_value, max_value) in enumerate(self.ranges)]
+        return choices + [('none', _('No value'))]
+
+    def queryset(self, request, queryset):
+        if self.value() == 'none':
+            return queryset.filter(**{'{0}__isnull'.format(self.field_name): True})
+        if self.value() is not None:
+            try:
+                min_value, max_value = self.ranges[int(self.value())]
+            except (ValueError, IndexError):
+                return queryset
+            if min_value is not None:
+                queryset = queryset.filter(**{'{0}__gte'.format(self.field_name): min_value})
+            if max_value is not None:
+                queryset = queryset.filter(**{'{0}__lt'.format(self.field_name): max_value})
+            return queryset
+
+
+class CNRatioListFilter(FloatRangeListFilter):
+    parameter_name = 'c_n_ratio'
+    field_name = 'isotope_C_N_ratio'
+    title = _('C/N proportion')
+    ranges = ((None, 3), (3, 3.5), (3.5, 4), (4, 5), (5, 7), (7, None))
+
+
+class StationListFilter(admin.SimpleListFilter):
+    """Filter on StationQuerySet methods, for stations or for the objects of a station (see station_field)."""
+    station_field = None  # E.g. 'station' to filter specimens
+
+    def filter_stations(self, stations, value):
+        raise NotImplementedError
+
+    def queryset(self, request, queryset):
+        if self.value() is None:
+            return queryset
+        try:
+            if self.station_field is None:
+                return self.filter_stations(queryset, self.value())
+            stations = self.filter_stations(Station.objects.all(), self.value()).values('pk')
+            return queryset.filter(**{'{0}__in'.format(self.station_field): stations})
+        except (KeyError, ValueError, IndexError):
+            return queryset  # Invalid value in the URL
+
+
+class CaptureYearListFilter(StationListFilter):
+    parameter_name = 'capture_year'
+    title = _('Capture year')
+
+    def lookups(self, request, model_admin):
+        return [(str(d.year), str(d.year)) for d in Station.objects.dates('capture_date_start', 'year')]
+
+    def filter_stations(self, stations, value):
+        year = int(value)
+        return stations.captured_between(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+
+
+class CaptureSeasonListFilter(StationListFilter):
+    parameter_name = 'capture_season'
+    title = _('Capture season (austral)')
+
+    def lookups(self, request, model_admin):
+        return [(season, '{season} ({first}-{last})'.format(season=season.capitalize(),
+                                                            first=calendar.month_abbr[months[0]],
+                                                            last=calendar.month_abbr[months[-1]]))
+                for season, months in AUSTRAL_SEASONS.items()]
+
+    def filter_stations(self, stations, value):
+        return stations.captured_in_season(value)
+
+
+class DepthListFilter(StationListFilter):
+    parameter_name = 'depth'
+    title = _('Depth (overlapping)')
+    ranges = ((0, 200), (200, 1000), (1000, 2000), (2000, 4000), (4000, None))  # Meters
+
+    def lookups(self, request, model_admin):
+        return [(str(i), '{min} - {max}m'.format(min=min_depth, max=max_depth) if max_depth is not None
+                 else '> {min}m'.format(min=min_depth))
+                for i, (min_depth, max_depth) in enumerate(self.ranges)]
+
+    def filter_stations(self, stations, value):
+        return stations.depth_overlaps(*self.ranges[int(value)])
+
+
+class SpecimenCaptureYearListFilter(CaptureYearListFilter):
+    station_field = 'station'
+
+
+class SpecimenCaptureSeasonListFilter(CaptureSeasonListFilter):
+    station_field = 'station'
+
+
+class SpecimenDepthListFilter(DepthListFilter):
+    station_field = 'station'
+
+
 @admin.register(Specimen)
-class SpecimenAdmin(admin.ModelAdmin):
-    list_display = ('specimen_id', 'station', 'has_picture', 'initial_scientific_name', 'taxon',
-                    'uncertain_identification', 'identified_by', 'specimen_location', 'vial', 'bioregion', 'fixation')
+class SpecimenAdmin(ReplicaChangeListMixin, BackgroundExportMixin, admin.ModelAdmin):
+    form = SpecimenAdminForm
+    list_display = ('specimen_id', 'station', 'has_picture', 'initial_scientific_name', 'taxon_label',
+                    'uncertain_identification', 'identified_by', 'specimen_location', 'vial', 'bioregion', 'fixation',
+                    'isotope_C_N_ratio')
     list_filter = ('identified_by', 'specimen_location', 'fixation', 'station__expedition', 'bioregion',
-                   'uncertain_identification', HasTaxonListFilter, HasPicturesListFilter)
-    search_fields = ['initial_scientific_name', 'specimen_id']
+                   'uncertain_identification', HasTaxonListFilter, HasPicturesListFilter, CNRatioListFilter,
+                   SpecimenCaptureYearListFilter, SpecimenCaptureSeasonListFilter, SpecimenDepthListFilter)
+    # Only for the autocompletes (e.g. SpecimenPicture.specimen): the changelist uses the full-text search document
+    # (see get_search_results()), where partial specimen IDs wouldn't match
+    search_fields = ['^specimen_id']
     # TODO: document searchable fields in template? (https://stackoverflow.com/questions/11411622/add-help-text-for-search-field-in-admin-py)
+    # Paginated prefix search (indexed, see migration 0006) rather than <select> with all the objects
+    autocomplete_fields = ('taxon', 'station', 'identified_by', 'specimen_location', 'bioregion', 'fixation')
+    list_select_related = ('station__expedition', 'identified_by', 'specimen_location', 'bioregion', 'fixation')
 
     fieldsets = (
         (None, {
@@ -91,48 +323,152 @@ class SpecimenAdmin(admin.ModelAdmin):
             'classes': ('collapse',),
             'fields': (('isotope_d13C', 'isotope_d15N', 'isotope_d34S'),
                        ('isotope_percentN', 'isotope_percentC', 'isotope_percentS'),
-                       'isotope_C_N_proportion')
+                       'isotope_C_N_ratio')
         }),
     )
 
-    readonly_fields = ('initial_scientific_name', 'isotope_C_N_proportion')
+    readonly_fields = ('initial_scientific_name', 'isotope_C_N_ratio')
 
     inlines = [
         SpecimenPictureInline,
     ]
 
+    # Bulk actions are single UPDATE queries: save() and full_clean() are skipped, the fields they change are not
+    # involved in the validation rules of Specimen.
+    actions = ['assign_taxon', 'mark_uncertain_identification', 'mark_certain_identification', 'reconcile_taxon']
+
+    def assign_taxon(self, request, queryset):
+        form = AssignTaxonForm(request.POST if 'apply' in request.POST else None)
+
+        if form.is_valid():
+            values = {'taxon': form.cleaned_data['taxon']}
+            if form.cleaned_data['uncertain_identification'] is not None:
+                values['uncertain_identification'] = form.cleaned_data['uncertain_identification']
+            with transaction.atomic():
+                updated_count = queryset.update(**values)
+            self.message_user(request, '{count} specimen(s) attached to {taxon}.'.format(
+                count=updated_count, taxon=form.cleaned_data['taxon']), messages.SUCCESS)
+            return None  # Back to the change list
+
+        # Intermediate page: choose the taxon
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Assign a taxon',
+            opts=self.model._meta,
+            form=form,
+            media=self.media + form.media,
+            action=request.POST['action'],
+            select_across=request.POST.get('select_across', '0'),
+            selected=request.POST.getlist(ACTION_CHECKBOX_NAME),
+            action_checkbox_name=ACTION_CHECKBOX_NAME,
+            specimens_count=queryset.count(),
+        )
+        return TemplateResponse(request, 'admin/specimens/specimen/assign_taxon.html', context)
+    assign_taxon.short_description = 'Assign a taxon to the selected specimens'
+
+    def mark_uncertain_identification(self, request, queryset):
+        with transaction.atomic():
+            updated_count = queryset.update(uncertain_identification=True)
+        self.message_user(request, '{count} specimen(s) marked as uncertain.'.format(count=updated_count))
+    mark_uncertain_identification.short_description = 'Mark identification as uncertain'
+
+    def mark_certain_identification(self, request, queryset):
+        with transaction.atomic():
+            updated_count = queryset.update(uncertain_identification=False)
+        self.message_user(request, '{count} specimen(s) marked as certain.'.format(count=updated_count))
+    mark_certain_identification.short_description = 'Mark identification as certain'
+
+    def reconcile_taxon(self, request, queryset):
+        updated_count = reconcile_specimens(queryset, get_taxonomy_snapshot())
+        self.message_user(request, '{count} specimen(s) attached to a taxon matching their initial scientific '
+                                   'name.'.format(count=updated_count))
+    reconcile_taxon.short_description = 'Re-run taxonomy reconciliation'
+
+    def get_search_results(self, request, queryset, search_term):
+        if search_term and not is_autocomplete(request):
+            return queryset.search(search_term), False
+        return super(SpecimenAdmin, self).get_search_results(request, queryset, search_term)
+
+    def get_ordering(self, request):
+        if request.GET.get(SEARCH_VAR):
+            return ['-search_rank']  # Most relevant first (search_rank is annotated by get_search_results())
+        return super(SpecimenAdmin, self).get_ordering(request)
+
+    def get_queryset(self, request):
+        # has_picture() from the changelist query rather than one query per row
+        pictures = SpecimenPicture.objects.filter(specimen=OuterRef('pk'))
+        return super(SpecimenAdmin, self).get_queryset(request).annotate(pictures_exist=Exists(pictures))
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        # The labels of the selected station/taxon need related objects (see their __str__)
+        if db_field.name == 'station':
+            kwargs['queryset'] = Station.objects.select_related('expedition')
+        elif db_field.name == 'taxon':
+            kwargs['queryset'] = Taxon.objects.select_related('parent__parent')
+        return super(SpecimenAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
+
+    def save_model(self, request, obj, form, change):
+        # Like assign_bioregions: the bioregion containing the station, unless chosen by hand
+        if 'bioregion' not in form.changed_data:
+            bioregion = bioregion_for_point(obj.station.coordinates)
+            if bioregion is not None:
+                obj.bioregion = bioregion
+        super(SpecimenAdmin, self).save_model(request, obj, form, change)
+
     def has_picture(self, obj):
-        return obj.has_pictures()
+        return obj.pictures_exist
     has_picture.short_description = 'Has pictures?'
     has_picture.boolean = True
+    has_picture.admin_order_field = 'pictures_exist'
+
+    def taxon_label(self, obj):
+        # From the taxonomy snapshot rather than str(obj.taxon), which needs several queries per specimen
+        return get_taxonomy_snapshot().label(obj.taxon_id)
+    taxon_label.short_description = 'Taxon'
+    taxon_label.admin_order_field = 'taxon__name'
+
+    export_fields = ('specimen_id', 'initial_scientific_name', 'taxon__name', 'uncertain_identification',
+                     'identified_by__first_name', 'identified_by__last_name', 'station__name',
+                     'station__expedition__name', 'specimen_location__name', 'vial', 'vial_size', 'bioregion__name',
+                     'fixation__name', 'mnhn_number', 'mna_code', 'bold_process_id', 'bold_sample_id', 'bold_bin',
+                     'sequence_name', 'isotope_d13C', 'isotope_d15N', 'isotope_d34S', 'isotope_percentN',
+                     'isotope_percentC', 'isotope_percentS', 'isotope_C_N_ratio', 'comment')
 
 
 @admin.register(Gear)
-class GearAdmin(admin.ModelAdmin):
-    pass
+class GearAdmin(BackgroundExportMixin, admin.ModelAdmin):
+    search_fields = ['^name']
+    ordering = ('name',)
 
 
 @admin.register(SpecimenLocation)
-class SpecimenLocationAdmin(admin.ModelAdmin):
-    pass
+class SpecimenLocationAdmin(BackgroundExportMixin, admin.ModelAdmin):
+    search_fields = ['^name']
+    ordering = ('name',)
 
 
 @admin.register(Person)
-class PersonAdmin(admin.ModelAdmin):
-    pass
+class PersonAdmin(BackgroundExportMixin, admin.ModelAdmin):
+    search_fields = ['^first_name', '^last_name']
+    ordering = ('last_name', 'first_name')
 
 
 @admin.register(Fixation)
-class FixationAdmin(admin.ModelAdmin):
-    pass
+class FixationAdmin(BackgroundExportMixin, admin.ModelAdmin):
+    search_fields = ['^name']
+    ordering = ('name',)
 
 
 @admin.register(Station)
-class StationAdmin(admin.ModelAdmin):
+class StationAdmin(ReplicaChangeListMixin, BackgroundExportMixin, admin.ModelAdmin):
     form = MyAdminForm
 
     list_display = ('name', 'expedition', 'coordinates_str', 'depth_str')
-    list_filter = ('expedition', HasGearListFilter)
+    list_filter = ('expedition', HasGearListFilter, CaptureYearListFilter, CaptureSeasonListFilter, DepthListFilter)
+    list_select_related = ('expedition',)
+    search_fields = ['^name']
+    ordering = ('name',)
+    autocomplete_fields = ('expedition', 'gear')
 
     fields = ('name',
               'expedition',
@@ -144,6 +480,16 @@ class StationAdmin(admin.ModelAdmin):
 
     readonly_fields = ('initial_capture_year', 'initial_capture_date')
 
+    def get_search_results(self, request, queryset, search_term):
+        # Also used by the autocomplete views: labels (__str__) need the expedition
+        queryset, use_distinct = super(StationAdmin, self).get_search_results(request, queryset, search_term)
+        return queryset.select_related('expedition'), use_distinct
+
+    def save_model(self, request, obj, form, change):
+        super(StationAdmin, self).save_model(request, obj, form, change)
+        if change and 'coordinates' in form.changed_data:
+            assign_bioregions(station_ids=[obj.pk])
+
     class Media:
         css = {
              "all": ("https://cdnjs.cloudflare.com/ajax/libs/ol3/3.15.1/ol.css",)
@@ -154,22 +500,229 @@ class StationAdmin(admin.ModelAdmin):
 
 
 @admin.register(Expedition)
-class ExpeditionAdmin(admin.ModelAdmin):
-    pass
+class ExpeditionAdmin(BackgroundExportMixin, admin.ModelAdmin):
+    search_fields = ['^name']
+    ordering = ('name',)
 
 
 @admin.register(SpecimenPicture)
-class SpecimenPictureAdmin(admin.ModelAdmin):
+class SpecimenPictureAdmin(BackgroundExportMixin, admin.ModelAdmin):
     fields = ('specimen', 'image', 'high_interest')
+    autocomplete_fields = ('specimen',)
 
 
 @admin.register(Taxon)
-class TaxonAdmin(DraggableMPTTAdmin):
-    pass
+class TaxonAdmin(BackgroundExportMixin, admin.ModelAdmin):
+    """Paginated list of taxa + a tree view (tree/) whose nodes are loaded on demand through small JSON endpoints.
+
+    Rendering the whole tree (like DraggableMPTTAdmin does) is not an option for a large taxonomy.
+    """
+    list_display = ('name', 'rank_name', 'parent_name', 'authority', 'aphia_id')
+    list_select_related = ('parent',)
+    list_filter = ('rank',)
+    search_fields = ['^name']
+    raw_id_fields = ('parent',)  # Rather than a <select> of all the taxa
+
+    change_list_template = 'admin/specimens/taxon/change_list.html'
+
+    TREE_NODE_FIELDS = ('pk', 'name', 'rank_id', 'lft', 'rght', 'tree_id')
+    TREE_SEARCH_LIMIT = 20
+    MAX_MOVED_SUBTREE_SIZE = 500  # Moving a node renumbers its whole tree, only allowed for small subtrees
+
+    def get_search_results(self, request, queryset, search_term):
+        # Also used by the autocomplete views: labels (__str__) of species need their genus (and subgenus)
+        queryset, use_distinct = super(TaxonAdmin, self).get_search_results(request, queryset, search_term)
+        return queryset.select_related('parent__parent'), use_distinct
+
+    def rank_name(self, obj):
+        return TaxonRank.objects.name_for(obj.rank_id)
+    rank_name.short_description = 'Rank'
+    rank_name.admin_order_field = 'rank__name'
+
+    def parent_name(self, obj):
+        return obj.parent.name if obj.parent else '-'
+    parent_name.short_description = 'Parent'
+    parent_name.admin_order_field = 'parent__name'
+
+    def get_urls(self):
+        return [
+            url(r'^tree/$', self.admin_site.admin_view(self.tree_view), name='specimens_taxon_tree'),
+            url(r'^tree/children/$', self.admin_site.admin_view(self.tree_children_view),
+                name='specimens_taxon_tree_children'),
+            url(r'^tree/search/$', self.admin_site.admin_view(self.tree_search_view),
+                name='specimens_taxon_tree_search'),
+            url(r'^tree/move/$', self.admin_site.admin_view(self.tree_move_view), name='specimens_taxon_tree_move'),
+        ] + super(TaxonAdmin, self).get_urls()
+
+    @staticmethod
+    def tree_node(values):
+        """JSON representation of a node, from a values() dict with the TREE_NODE_FIELDS."""
+        return {
+            'id': values['pk'],
+            'name': values['name'],
+            'rank': TaxonRank.objects.name_for(values['rank_id']),
+            'descendants_count': (values['rght'] - values['lft'] - 1) // 2,
+            'change_url': reverse('admin:specimens_taxon_change', args=[values['pk']]),
+        }
+
+    def tree_view(self, request):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+
+        context = dict(
+            self.admin_site.each_context(request),
+            title='Taxonomy tree',
+            opts=self.model._meta,
+            max_moved_subtree_size=self.MAX_MOVED_SUBTREE_SIZE,
+        )
+        return TemplateResponse(request, 'admin/specimens/taxon/tree.html', context)
+
+    @staticmethod
+    def _int_param(params, name):
+        try:
+            return int(params[name]) if params.get(name) else None
+        except ValueError:
+            return None
+
+    @method_decorator(require_GET)
+    def tree_children_view(self, request):
+        """Children of the "parent" node (the roots if not given), in a single query."""
+        if not self.has_change_permission(request):
+            return JsonResponse({'error': 'Permission denied'}, status=403)
+
+        parent_id = self._int_param(request.GET, 'parent')
+        nodes = Taxon.objects.filter(parent_id=parent_id) if parent_id else Taxon.objects.filter(parent__isnull=True)
+        nodes = nodes.order_by('name').values(*self.TREE_NODE_FIELDS)
+        return JsonResponse({'nodes': [self.tree_node(n) for n in nodes]})
+
+    @method_decorator(require_GET)
+    def tree_search_view(self, request):
+        """Taxa whose name starts with "q", each with its ancestors (two queries, thanks to lft/rght)."""
+        if not self.has_change_permission(request):
+            return JsonResponse({'error': 'Permission denied'}, status=403)
+
+        query = request.GET.get('q', '').strip()
+        if not query:
+            return JsonResponse({'results': []})
+
+        matches = list(Taxon.objects.filter(name__istartswith=query)
+                                    .order_by('name')
+                                    .values(*self.TREE_NODE_FIELDS)[:self.TREE_SEARCH_LIMIT])
+
+        ancestors_condition = Q()
+        for match in matches:
+            ancestors_condition |= Q(tree_id=match['tree_id'], lft__lt=match['lft'], rght__gt=match['rght'])
+        ancestors = list(Taxon.objects.filter(ancestors_condition).order_by('lft').values(*self.TREE_NODE_FIELDS)
+                         if matches else [])
+
+        results = []
+        for match in matches:
+            path = [a for a in ancestors
+                    if a['tree_id'] == match['tree_id'] and a['lft'] < match['lft'] and a['rght'] > match['rght']]
+            results.append({'node': self.tree_node(match), 'ancestors': [self.tree_node(a) for a in path]})
+
+        return JsonResponse({'results': results})
+
+    @method_decorator(require_POST)
+    def tree_move_view(self, request):
+        """Move the "node" relatively to the "target" node ("position": first-child, last-child, left or right)."""
+        if not self.has_change_permission(request):
+            return JsonResponse({'error': 'Permission denied'}, status=403)
+
+        node_id = self._int_param(request.POST, 'node')
+        target_id = self._int_param(request.POST, 'target')
+        position = request.POST.get('position', 'last-child')
+        if node_id is None or target_id is None or position not in ('first-child', 'last-child', 'left', 'right'):
+            return JsonResponse({'error': 'Invalid parameters'}, status=400)
+
+        try:
+            with transaction.atomic():
+                node = Taxon.objects.select_for_update().get(pk=node_id)
+                target = Taxon.objects.get(pk=target_id)
+
+                subtree_size = (node.rght - node.lft + 1) // 2
+                if subtree_size > self.MAX_MOVED_SUBTREE_SIZE:
+                    return JsonResponse({'error': 'Subtree too large to be moved ({size} taxa, max {max}).'.format(
+                        size=subtree_size, max=self.MAX_MOVED_SUBTREE_SIZE)}, status=400)
+
+                node.move_to(target, position)
+        except Taxon.DoesNotExist:
+            return JsonResponse({'error': 'Taxon not found'}, status=404)
+        except InvalidMove as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+        bump_version()  # move_to() doesn't send post_save
+        return JsonResponse({'moved': node_id})
+
+
+@admin.register(ExportJob)
+class ExportJobAdmin(admin.ModelAdmin):
+    list_display = ('__str__', 'requested_by', 'created_at', 'status', 'progress_str', 'download_link')
+    list_filter = ('status', 'format', 'model')
+    readonly_fields = ('model', 'format', 'fields', 'changelist_params', 'requested_by', 'status', 'created_at',
+                       'started_at', 'finished_at', 'attempts', 'rows_total', 'rows_done', 'download_link', 'error')
+    exclude = ('file', 'filters', 'heartbeat_at')  # filters can be a (long) list of ids
+    actions = None
+
+    def get_urls(self):
+        return [
+            url(r'^(?P<pk>\d+)/download/$', self.admin_site.admin_view(self.download_view),
+                name='specimens_exportjob_download'),
+        ] + super(ExportJobAdmin, self).get_urls()
+
+    def get_queryset(self, request):
+        # Users only see (and download) their own exports
+        queryset = super(ExportJobAdmin, self).get_queryset(request)
+        if not request.user.is_superuser:
+            queryset = queryset.filter(requested_by=request.user)
+        return queryset
+
+    def has_add_permission(self, request):
+        return False  # Jobs are created by the export actions
+
+    def download_view(self, request, pk):
+        """The export files are not in the public media: they are only served here."""
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        job = get_object_or_404(self.get_queryset(request), pk=pk, status=ExportJob.DONE)
+        try:
+            f = job.file.open('rb')
+        except (ValueError, FileNotFoundError):  # No file, or deleted
+            raise Http404('The file of this export is not available.')
+
+        response = FileResponse(f)
+        response['Content-Disposition'] = 'attachment; filename="{name}"'.format(name=os.path.basename(job.file.name))
+        return response
+
+    def progress_str(self, obj):
+        progress = obj.progress()
+        return '{percent}%'.format(percent=progress) if progress is not None else '-'
+    progress_str.short_description = 'Progress'
+
+    def download_link(self, obj):
+        if obj.status == ExportJob.DONE and obj.file:
+            return format_html('<a href="{url}">Download</a>',
+                               url=reverse('admin:specimens_exportjob_download', args=[obj.pk]))
+        return '-'
+    download_link.short_description = 'File'
 
 
 @admin.register(Bioregion)
 class BioreginAdmin(admin.ModelAdmin):
-    pass
+    list_display = ('name', 'has_area')
+    search_fields = ['^name']
+    ordering = ('name',)
+    exclude = ('area',)  # Loaded by the load_bioregions command
+
+    def get_queryset(self, request):
+        # Boundaries can be large, they're not loaded for the lists and autocompletes
+        return super(BioreginAdmin, self).get_queryset(request).defer('area').annotate(
+            area_exists=Case(When(area__isnull=True, then=Value(False)), default=Value(True),
+                             output_field=BooleanField()))
+
+    def has_area(self, obj):
+        return obj.area_exists
+    has_area.short_description = 'Has boundaries?'
+    has_area.boolean = True
 
 admin.site.site_header = 'Astapor administration'
\ No newline at end of file
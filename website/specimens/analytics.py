@@ -0,0 +1,175 @@
+"""Vectorized statistics on the isotope measurements of specimens.
+
+Values are fetched with values_list() in chunks (server-side cursor) straight into NumPy arrays, statistics per group
+(taxon, expedition, bioregion or the whole collection) are then computed for all groups at once.
+"""
+import csv
+import math
+
+import numpy as np
+from django.db.models import Q
+
+from .models import Specimen, Expedition, Bioregion
+from .taxonomy import get_taxonomy_snapshot
+
+ISOTOPE_FIELDS = ('isotope_d13C', 'isotope_d15N', 'isotope_d34S',
+                  'isotope_percentN', 'isotope_percentC', 'isotope_percentS')
+
+GROUP_BY_FIELDS = {
+    'taxon': 'taxon_id',
+    'expedition': 'station__expedition_id',
+    'bioregion': 'bioregion_id',
+}
+
+QUANTILES = (0.25, 0.5, 0.75)
+STATS = ('n', 'mean', 'sd', 'min', 'q25', 'median', 'q75', 'max')
+
+CHUNK_SIZE = 10000
+
+NO_GROUP = -1  # Group id used for specimens without taxon/bioregion (and for the whole collection)
+
+
+def isotope_arrays(queryset=None, group_by=None, chunk_size=CHUNK_SIZE):
+    """Load the isotope values of the specimens.
+
+    Returns (group_ids, values): group_ids is a 1D int array (NO_GROUP if no group_by or no value), values a 2D float
+    array with one column per field in ISOTOPE_FIELDS and NaN for missing data. Specimens without any isotope data are
+    skipped.
+    """
+    if queryset is None:
+        queryset = Specimen.objects.all()
+
+    has_isotope_data = Q()
+    for field in ISOTOPE_FIELDS:
+        has_isotope_data |= Q(**{field + '__isnull': False})
+
+    fields = ISOTOPE_FIELDS + ((GROUP_BY_FIELDS[group_by],) if group_by else ())
+    rows = queryset.filter(has_isotope_data).order_by().values_list(*fields).iterator(chunk_size=chunk_size)
+
+    chunks = []
+    buffer = []
+    for row in rows:
+        buffer.append(row)
+        if len(buffer) == chunk_size:
+            chunks.append(np.array(buffer, dtype=float))  # None becomes NaN
+            buffer = []
+    if buffer:
+        chunks.append(np.array(buffer, dtype=float))
+
+    data = np.concatenate(chunks) if chunks else np.empty((0, len(fields)))
+
+    values = data[:, :len(ISOTOPE_FIELDS)]
+    if group_by:
+        group_ids = np.where(np.isnan(data[:, -1]), NO_GROUP, data[:, -1]).astype(np.int64)
+    else:
+        group_ids = np.full(len(data), NO_GROUP, dtype=np.int64)
+
+    return group_ids, values
+
+
+def grouped_stats(group_ids, values, quantiles=QUANTILES):
+    """Compute statistics per group, for each column of values (NaN are ignored).
+
+    Returns (groups, stats): groups is the sorted array of distinct group ids, stats a dict stat name -> 2D array
+    (one row per group, one column per column in values). Stat names are 'n', 'mean', 'sd' (sample standard
+    deviation), 'min', 'max' and 'q<percent>' for each quantile.
+    """
+    groups, inverse = np.unique(group_ids, return_inverse=True)
+    n_groups, n_fields = len(groups), values.shape[1]
+
+    stats = {name: np.full((n_groups, n_fields), np.nan) for name in ('mean', 'sd', 'min', 'max')}
+    stats['n'] = np.zeros((n_groups, n_fields), dtype=np.int64)
+    for q in quantiles:
+        stats[_quantile_name(q)] = np.full((n_groups, n_fields), np.nan)
+    if not n_groups:  # No specimens with isotope data
+        return groups, stats
+
+    for j in range(n_fields):
+        column = values[:, j]
+        present = ~np.isnan(column)
+        g, v = inverse[present], column[present]
+
+        n = np.bincount(g, minlength=n_groups)
+        has_data = n > 0
+        stats['n'][:, j] = n
+
+        mean = np.bincount(g, weights=v, minlength=n_groups) / np.maximum(n, 1)
+        squared_deviations = np.bincount(g, weights=(v - mean[g]) ** 2, minlength=n_groups)
+        stats['mean'][has_data, j] = mean[has_data]
+        stats['sd'][n > 1, j] = np.sqrt(squared_deviations[n > 1] / (n[n > 1] - 1))
+
+        # Sorted by group, then by value: each group is a contiguous (sorted) slice
+        sorted_values = v[np.lexsort((v, g))]
+        starts = np.concatenate(([0], np.cumsum(n)[:-1]))
+        ends = starts + n - 1
+
+        stats['min'][has_data, j] = sorted_values[starts[has_data]]
+        stats['max'][has_data, j] = sorted_values[ends[has_data]]
+
+        for q in quantiles:  # Linear interpolation, like numpy.percentile()
+            position = starts[has_data] + q * (n[has_data] - 1)
+            lower = np.floor(position).astype(np.int64)
+            upper = np.ceil(position).astype(np.int64)
+            fraction = position - lower
+            stats[_quantile_name(q)][has_data, j] = (sorted_values[lower] * (1 - fraction) +
+                                                     sorted_values[upper] * fraction)
+
+    return groups, stats
+
+
+def _quantile_name(q):
+    return 'median' if q == 0.5 else 'q{percent}'.format(percent=int(round(q * 100)))
+
+
+def group_labels(groups, group_by):
+    """Human-readable names for the group ids."""
+    if group_by == 'taxon':
+        taxonomy = get_taxonomy_snapshot()
+        names = {group: taxonomy.full_name(group) for group in groups}
+    elif group_by == 'expedition':
+        names = dict(Expedition.objects.filter(pk__in=groups.tolist()).values_list('pk', 'name'))
+    elif group_by == 'bioregion':
+        names = dict(Bioregion.objects.filter(pk__in=groups.tolist()).values_list('pk', 'name'))
+    else:
+        return ['All specimens' for _ in groups]
+
+    return [names.get(group) or '-' for group in groups]
+
+
+class IsotopeStats(object):
+    """Isotope statistics per group, as returned by isotope_stats()."""
+    def __init__(self, group_by, groups, labels, stats, specimens_count):
+        self.group_by = group_by
+        self.specimens_count = specimens_count  # Specimens with isotope data
+        self.groups = groups
+        self.labels = labels
+        self.stats = stats
+
+    def write_csv(self, f):
+        """One line per group, one column per (field, stat)."""
+        writer = csv.writer(f)
+        writer.writerow(['group_id', 'group'] + ['{field}_{stat}'.format(field=field, stat=stat)
+                                                 for field in ISOTOPE_FIELDS for stat in STATS])
+        for i, (group, label) in enumerate(zip(self.groups, self.labels)):
+            row = [group if group != NO_GROUP else '', label]
+            for j in range(len(ISOTOPE_FIELDS)):
+                for stat in STATS:
+                    value = self.stats[stat][i, j]
+                    row.append('' if isinstance(value, float) and math.isnan(value) else value)
+            writer.writerow(row)
+
+    def write_npz(self, f):
+        """Compressed NumPy archive: groups, labels, fields, and one (groups x fields) array per stat."""
+        arrays = {stat: self.stats[stat] for stat in STATS}
+        np.savez_compressed(f, groups=self.groups, labels=np.array(self.labels), fields=np.array(ISOTOPE_FIELDS),
+                            **arrays)
+
+
+def isotope_stats(queryset=None, group_by=None, chunk_size=CHUNK_SIZE):
+    """Statistics on the isotope values of the specimens in queryset (all by default), per group.
+
+    group_by can be None (whole collection), 'taxon', 'expedition' or 'bioregion'.
+    """
+    group_ids, values = isotope_arrays(queryset, group_by=group_by, chunk_size=chunk_size)
+    groups, stats = grouped_stats(group_ids, values)
+    return IsotopeStats(group_by, groups, group_labels(groups, group_by), stats, len(values))
@@ -3,3 +3,6 @@ from django.apps import AppConfig
 
 class SpecimensConfig(AppConfig):
     name = 'specimens'
+
+    def ready(self):
+        from . import signals  # Connect the signal receivers
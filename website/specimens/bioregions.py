@@ -0,0 +1,103 @@
+"""Bioregion boundaries, and the assignment of specimens to the bioregion containing their station.
+
+Boundaries are loaded from a shapefile or GeoJSON file (load_bioregions()). Specimens are then assigned with a single
+UPDATE joining stations and bioregions on the spatial index (assign_bioregions()), so reassigning the whole collection
+after a boundary change is one query. Specimens whose station is outside all the boundaries (or has no coordinates)
+keep their bioregion, e.g. the one typed in the Region column of the import.
+
+Where boundaries overlap, the smallest bioregion wins.
+"""
+from collections import OrderedDict
+
+from django.contrib.gis.gdal import DataSource
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.db import connection, transaction
+from django.db.models import F, FloatField, Func
+
+from .models import Bioregion, Specimen, Station
+
+BIOREGION_SRID = 4326  # Same as the stations coordinates
+
+
+def read_boundaries(path, name_field, layer_index=0):
+    """Read a shapefile or GeoJSON file: return an OrderedDict bioregion name -> MultiPolygon (in BIOREGION_SRID).
+
+    Several features with the same name are merged in a single MultiPolygon.
+    """
+    layer = DataSource(path)[layer_index]
+    if name_field not in layer.fields:
+        raise ValueError('No {field} field in {path} (fields: {fields})'.format(field=name_field, path=path,
+                                                                               fields=', '.join(layer.fields)))
+
+    boundaries = OrderedDict()
+    for feature in layer:
+        geometry = feature.geom
+        if geometry.srs is not None:  # Otherwise, assumed to be in BIOREGION_SRID already
+            geometry.transform(BIOREGION_SRID)
+
+        geos_geometry = geometry.geos
+        if isinstance(geos_geometry, Polygon):
+            polygons = [geos_geometry]
+        elif isinstance(geos_geometry, MultiPolygon):
+            polygons = list(geos_geometry)
+        else:
+            raise ValueError('Feature {fid} is a {type}, not a polygon'.format(fid=feature.fid,
+                                                                              type=geos_geometry.geom_type))
+
+        name = str(feature.get(name_field)).strip()
+        boundaries.setdefault(name, []).extend(polygons)
+
+    return OrderedDict((name, MultiPolygon(*polygons, srid=BIOREGION_SRID)) for name, polygons in boundaries.items())
+
+
+def load_bioregions(boundaries):
+    """Set the area of the bioregions (creating the missing ones) from a name -> MultiPolygon mapping.
+
+    Existing bioregions are updated in place, so the specimens keep referencing them. Returns the number of bioregions
+    created.
+    """
+    created_count = 0
+    with transaction.atomic():
+        for name, area in boundaries.items():
+            updated_count = Bioregion.objects.filter(name=name).update(area=area)
+            if not updated_count:
+                Bioregion.objects.create(name=name, area=area)
+                created_count += 1
+    return created_count
+
+
+def bioregion_for_point(point):
+    """The (smallest) bioregion containing point, None if there isn't any."""
+    if point is None:
+        return None
+    return (Bioregion.objects.filter(area__covers=point)
+                             .annotate(area_size=Func(F('area'), function='ST_Area', output_field=FloatField()))
+                             .order_by('area_size', 'pk')
+                             .first())
+
+
+def assign_bioregions(station_ids=None):
+    """Set the bioregion of the specimens from the coordinates of their station, in a single UPDATE query.
+
+    station_ids restricts the assignment to the specimens of some stations. Only the specimens whose bioregion changes
+    are written. Returns their number.
+    """
+    condition = ''
+    params = []
+    if station_ids is not None:
+        condition = 'AND st.id = ANY(%s)'
+        params.append(list(station_ids))
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            UPDATE {specimens} sp SET bioregion_id = located.bioregion_id
+            FROM (
+                SELECT DISTINCT ON (st.id) st.id AS station_id, b.id AS bioregion_id
+                FROM {stations} st JOIN {bioregions} b ON ST_Covers(b.area, st.coordinates)
+                WHERE st.coordinates IS NOT NULL {condition}
+                ORDER BY st.id, ST_Area(b.area), b.id
+            ) AS located
+            WHERE sp.station_id = located.station_id AND sp.bioregion_id IS DISTINCT FROM located.bioregion_id
+        """.format(specimens=Specimen._meta.db_table, stations=Station._meta.db_table,
+                   bioregions=Bioregion._meta.db_table, condition=condition), params)
+        return cursor.rowcount
@@ -0,0 +1,132 @@
+"""Change-data feed of the main tables, for incremental syncs (mirror database, external portal).
+
+Specimen, Station and Taxon have created_at/updated_at columns and deletions are recorded as Tombstone rows, all
+maintained by database triggers (see migration 0008), so bulk updates and imports are tracked too. The specimens
+include their FASTA sequence, whose writes touch the specimen (see migration 0014).
+
+Timestamps are the start time of the writing transaction: a transaction running while a sync reads the feed can
+commit rows with a timestamp older than the sync. Syncs should therefore start from sync_cursor() (a bit in the past)
+rather than from the current time, and apply changes idempotently (upserts).
+
+Tombstones are only kept for TOMBSTONE_RETENTION (see purge_tombstones()): consumers that didn't sync for longer must
+resync from scratch (since=None). Reloads of the whole tables (full_import) are not fed as mass deletions followed by
+re-insertions, but as a RESET change (see tables_reload()).
+"""
+import datetime
+from collections import namedtuple
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from django.db.models import F
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from .models import FeedReset, Specimen, SpecimenSequence, Station, Taxon, Tombstone
+
+# Referenced models first, so objects can be inserted in order
+TRACKED_MODELS = (Taxon, Station, Specimen)
+
+UPSERT = 'upsert'
+DELETE = 'delete'
+RESET = 'reset'  # Drop everything, the objects follow
+
+CHUNK_SIZE = 2000
+
+# Longer than the transactions writing to the tracked tables
+SAFETY_MARGIN = datetime.timedelta(minutes=10)
+
+TOMBSTONE_RETENTION = datetime.timedelta(days=30)
+
+Change = namedtuple('Change', 'model action pk timestamp data')
+
+
+def tracked_fields(model):
+    """Concrete fields in the feed (ids for foreign keys), the search document excluded."""
+    return [field.attname for field in model._meta.concrete_fields if field.name != 'search_document']
+
+
+def _feed_rows(queryset, chunk_size):
+    """Data of the objects of queryset (dicts of the tracked fields, plus sequence_fasta for specimens)."""
+    model = queryset.model
+    if model is not Specimen:
+        return queryset.values(*tracked_fields(model)).iterator(chunk_size=chunk_size)
+
+    def with_sequences(rows):
+        for row in rows:
+            compressed_fasta = row.pop('compressed_fasta')
+            row['sequence_fasta'] = '' if compressed_fasta is None else SpecimenSequence.decompress(compressed_fasta)
+            yield row
+
+    return with_sequences(queryset.values(*tracked_fields(model), compressed_fasta=F('sequence__compressed_fasta'))
+                                  .iterator(chunk_size=chunk_size))
+
+
+def sync_cursor():
+    """Value to pass as since to the next sync."""
+    return timezone.now() - SAFETY_MARGIN
+
+
+def purge_tombstones(before=None):
+    """Delete the tombstones older than before (default: the retention). Return how many were deleted."""
+    if before is None:
+        before = timezone.now() - TOMBSTONE_RETENTION
+    return Tombstone.objects.filter(deleted_at__lt=before).delete()[0]
+
+
+def tombstones_purged_since(since):
+    """Whether deletions after since may have been purged already."""
+    return since < timezone.now() - TOMBSTONE_RETENTION
+
+
+@contextmanager
+def tables_reload():
+    """Block reloading the tracked tables, in a transaction: its deletions don't leave tombstones, and the feed starts
+    over from the start of the transaction, with a RESET change.
+
+    All the objects still there afterwards must have been written (updated_at) in the block or after it.
+    """
+    with transaction.atomic(), connection.cursor() as cursor:
+        FeedReset.objects.create(at=Now())  # The start time of the transaction, like the triggers' now()
+        # Read by the tombstone trigger (see migration 0015). Only for this transaction: the deletions of the others
+        # are still recorded, no need to lock them out.
+        cursor.execute("SET LOCAL astapor.reloading = 'on'")
+        yield
+        cursor.execute("SET LOCAL astapor.reloading = 'off'")  # Until the end of the outer transaction otherwise
+
+
+def changes_since(since, models=TRACKED_MODELS, chunk_size=CHUNK_SIZE):
+    """Yield a Change for each object created, updated or deleted after since (an aware datetime).
+
+    Models are processed in turn. For each of them, the current values of the objects modified (data is a dict of the
+    tracked fields) come first, then the deletions, each ordered by timestamp. Rows are streamed from server-side
+    cursors.
+
+    If the tables were reloaded after since (or since is None, for a full sync), a RESET change comes first (model, pk
+    and data are None): the consumer drops its copy, and the changes from the (last) reload follow.
+    """
+    lookup, start = 'gt', since
+    reset_at = None if since is None else (FeedReset.objects.filter(at__gt=since).order_by('-at')
+                                                            .values_list('at', flat=True).first())
+    if since is None or reset_at is not None:
+        yield Change(None, RESET, None, reset_at, None)
+        lookup, start = 'gte', reset_at  # Including the objects written by the reload transaction
+
+    for model in models:
+        label = model._meta.label_lower
+
+        rows = model._default_manager.all()
+        tombstones = Tombstone.objects.filter(model=label)
+        if start is not None:
+            rows = rows.filter(**{'updated_at__' + lookup: start})
+            tombstones = tombstones.filter(**{'deleted_at__' + lookup: start})
+
+        for row in _feed_rows(rows.order_by('updated_at', 'pk'), chunk_size):
+            yield Change(label, UPSERT, row['id'], row['updated_at'], row)
+
+        if since is None:
+            continue  # Nothing to delete in a full sync
+        tombstones = (tombstones.order_by('deleted_at', 'pk')
+                                .values_list('object_id', 'deleted_at')
+                                .iterator(chunk_size=chunk_size))
+        for object_id, deleted_at in tombstones:
+            yield Change(label, DELETE, object_id, deleted_at, None)
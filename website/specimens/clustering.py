@@ -0,0 +1,125 @@
+"""Precomputed station clusters, to show all stations on a map without sending them one by one to the browser.
+
+Stations are grouped on a regular grid in the map projection (Antarctic Polar Stereographic), with a cell size that
+depends on the zoom level. Each non-empty cell is stored as a StationCluster row. Rows keep the sum of the projected
+coordinates of their stations so they can be updated incrementally (a station added, moved or removed only touches
+one row per zoom level) instead of being recomputed.
+
+Bulk operations (imports, truncations, ...) should run inside deferred_refresh(): incremental updates are then
+suspended and the whole table is rebuilt once at the end.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.db import connection
+
+# Those values match the map configuration in templates/admin/specimens/station/change_form.html
+CLUSTERING_SRID = 3031
+MAX_RESOLUTION = 8192.0  # Meters per pixel at zoom level 0
+ZOOM_LEVELS = range(0, 6)
+CLUSTER_SIZE_PX = 64  # Size of a grid cell, in screen pixels
+
+_state = threading.local()
+
+
+def cell_size(zoom):
+    """Size (in meters, in the clustering projection) of a grid cell at the given zoom level."""
+    return MAX_RESOLUTION / 2 ** zoom * CLUSTER_SIZE_PX
+
+
+def _zoom_levels_sql():
+    return ', '.join('({zoom}, {size})'.format(zoom=zoom, size=cell_size(zoom)) for zoom in ZOOM_LEVELS)
+
+
+def _cluster_table():
+    from .models import StationCluster
+    return StationCluster._meta.db_table
+
+
+def refresh_is_deferred():
+    return getattr(_state, 'deferred_depth', 0) > 0
+
+
+@contextmanager
+def deferred_refresh():
+    """Suspend incremental updates and rebuild all the clusters once at the end of the block.
+
+    Blocks can be nested, the rebuild happens when the outermost one exits.
+    """
+    _state.deferred_depth = getattr(_state, 'deferred_depth', 0) + 1
+    try:
+        yield
+    finally:
+        _state.deferred_depth -= 1
+
+    if not refresh_is_deferred():
+        rebuild_station_clusters()
+
+
+def rebuild_station_clusters():
+    """Recompute all clusters, for all zoom levels, with a single query."""
+    from .models import Specimen, Station
+
+    with connection.cursor() as cursor:
+        cursor.execute('DELETE FROM {clusters}'.format(clusters=_cluster_table()))
+        cursor.execute("""
+            INSERT INTO {clusters} (zoom, cell_x, cell_y, sum_x, sum_y, stations_count, specimens_count, coordinates)
+            SELECT zoom, cell_x, cell_y, sum_x, sum_y, stations_count, specimens_count,
+                   ST_Transform(ST_SetSRID(ST_MakePoint(sum_x / stations_count, sum_y / stations_count), %(srid)s),
+                                4326)
+            FROM (
+                SELECT z.zoom, FLOOR(ST_X(located.projected) / z.size) AS cell_x,
+                       FLOOR(ST_Y(located.projected) / z.size) AS cell_y,
+                       SUM(ST_X(located.projected)) AS sum_x, SUM(ST_Y(located.projected)) AS sum_y,
+                       COUNT(*) AS stations_count, SUM(located.specimens_count) AS specimens_count
+                FROM (
+                    SELECT ST_Transform(st.coordinates, %(srid)s) AS projected,
+                           (SELECT COUNT(*) FROM {specimens} sp WHERE sp.station_id = st.id) AS specimens_count
+                    FROM {stations} st
+                    WHERE st.coordinates IS NOT NULL
+                ) AS located CROSS JOIN (VALUES {zoom_levels}) AS z(zoom, size)
+                GROUP BY z.zoom, 2, 3
+            ) AS cells
+        """.format(clusters=_cluster_table(),
+                   specimens=Specimen._meta.db_table,
+                   stations=Station._meta.db_table,
+                   zoom_levels=_zoom_levels_sql()), {'srid': CLUSTERING_SRID})
+
+
+def update_station_clusters(point, stations_delta, specimens_delta):
+    """Add (or remove, with negative deltas) stations/specimens located at point to the matching clusters.
+
+    Does nothing if point is None (station without coordinates) or if refresh is currently deferred.
+    """
+    if point is None or refresh_is_deferred() or (stations_delta == 0 and specimens_delta == 0):
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO {clusters} AS c (zoom, cell_x, cell_y, sum_x, sum_y, stations_count, specimens_count,
+                                         coordinates)
+            SELECT z.zoom, FLOOR(p.x / z.size), FLOOR(p.y / z.size), p.x * %(stations)s, p.y * %(stations)s,
+                   %(stations)s, %(specimens)s, ST_Transform(ST_SetSRID(ST_MakePoint(p.x, p.y), %(srid)s), 4326)
+            FROM (
+                SELECT ST_X(g) AS x, ST_Y(g) AS y
+                FROM ST_Transform(ST_SetSRID(ST_MakePoint(%(lon)s, %(lat)s), 4326), %(srid)s) AS g
+            ) AS p CROSS JOIN (VALUES {zoom_levels}) AS z(zoom, size)
+            ON CONFLICT (zoom, cell_x, cell_y) DO UPDATE SET
+                sum_x = c.sum_x + EXCLUDED.sum_x,
+                sum_y = c.sum_y + EXCLUDED.sum_y,
+                stations_count = c.stations_count + EXCLUDED.stations_count,
+                specimens_count = c.specimens_count + EXCLUDED.specimens_count,
+                coordinates = CASE WHEN c.stations_count + EXCLUDED.stations_count > 0 THEN
+                    ST_Transform(ST_SetSRID(ST_MakePoint(
+                        (c.sum_x + EXCLUDED.sum_x) / (c.stations_count + EXCLUDED.stations_count),
+                        (c.sum_y + EXCLUDED.sum_y) / (c.stations_count + EXCLUDED.stations_count)), %(srid)s), 4326)
+                ELSE c.coordinates END
+        """.format(clusters=_cluster_table(), zoom_levels=_zoom_levels_sql()), {
+            'srid': CLUSTERING_SRID,
+            'lon': point.x,
+            'lat': point.y,
+            'stations': stations_delta,
+            'specimens': specimens_delta
+        })
+
+        cursor.execute('DELETE FROM {clusters} WHERE stations_count <= 0'.format(clusters=_cluster_table()))
@@ -0,0 +1,154 @@
+"""Normalization of the raw latitude/longitude texts of the lab sheets, by batches (whole columns).
+
+Sheets use several formats: decimal degrees ('.' or ',' as decimal separator), degrees-minutes-seconds or
+degrees-decimal minutes, signed or with a hemisphere letter (N/S/E/W, before or after the value). Each distinct text
+is parsed once with a compiled pattern, then the conversion to decimal degrees, the range checks and the detection of
+swapped latitude/longitude are NumPy operations on the whole batch.
+
+Points are not built here: the import creates them when it writes the stations.
+"""
+import math
+import re
+from collections import namedtuple
+
+import numpy as np
+
+# Status of a coordinates pair
+VALID = 0
+EMPTY = 1  # No coordinates at all, that's fine
+MISSING = 2  # Only one of latitude/longitude
+INVALID = 3  # Not understood
+OUT_OF_RANGE = 4
+SWAPPED = 5  # Latitude and longitude very probably swapped
+
+STATUS_MESSAGES = {
+    MISSING: 'Either latitude or longitude is missing!',
+    INVALID: 'Coordinates cannot be understood',
+    OUT_OF_RANGE: 'Coordinates out of range',
+    SWAPPED: 'Latitude and longitude seem to be swapped',
+}
+
+# Separators are symbols only: letters would be ambiguous with the hemispheres (S for seconds or South?)
+_COORDINATE_PATTERN = re.compile(r"""
+    (?P<prefix>[NSEW])?\s*
+    (?P<sign>[-+])?\s*
+    (?P<degrees>\d+(?:[.,]\d+)?)\s*(?:[°º:]\s*)?
+    (?:(?P<minutes>\d+(?:[.,]\d+)?)\s*(?:['′’:]\s*)?
+       (?:(?P<seconds>\d+(?:[.,]\d+)?)\s*(?:''|["″”])?\s*)?)?
+    (?P<suffix>[NSEW])?
+""", re.VERBOSE | re.IGNORECASE)
+
+# Kind of hemisphere letter of a value
+NO_LETTER = 0
+LATITUDE_LETTER = 1  # N/S
+LONGITUDE_LETTER = 2  # E/W
+
+
+class NormalizedCoordinates(namedtuple('NormalizedCoordinates', 'latitudes longitudes statuses')):
+    """Arrays of decimal degrees (NaN unless the status is VALID) and statuses, one item per pair."""
+
+    def pairs(self):
+        """(latitude, longitude, status) Python tuples."""
+        return zip(self.latitudes.tolist(), self.longitudes.tolist(), self.statuses.tolist())
+
+
+def _number(text):
+    return float(text.replace(',', '.')) if text else 0.0
+
+
+def _parse_text(text):
+    """(degrees, minutes, seconds, sign, letter kind) of a stripped, non-empty text. None if not understood."""
+    if not text[-1].isalpha():  # Otherwise, a hemisphere suffix: not a plain number
+        try:
+            value = float(text.replace(',', '.'))  # Most values are decimal degrees: avoid the pattern
+        except ValueError:
+            pass
+        else:
+            if math.isfinite(value):
+                return abs(value), 0.0, 0.0, math.copysign(1.0, value), NO_LETTER
+
+    match = _COORDINATE_PATTERN.fullmatch(text)
+    if match is None:
+        return None
+
+    prefix, sign, degrees, minutes, seconds, suffix = match.groups()
+    if prefix and suffix:
+        return None
+    letter = (prefix or suffix or '').upper()
+    if letter in ('N', 'E') and sign == '-':
+        return None
+
+    negative = sign == '-' or letter in ('S', 'W')
+    if not letter:
+        kind = NO_LETTER
+    else:
+        kind = LATITUDE_LETTER if letter in ('N', 'S') else LONGITUDE_LETTER
+    return _number(degrees), _number(minutes), _number(seconds), -1.0 if negative else 1.0, kind
+
+
+def _parse_decimals(texts):
+    """Fast path: decimal degrees of an array of texts, all at once. None if some are not plain decimal numbers."""
+    try:
+        values = np.char.replace(texts, ',', '.').astype(np.float64)
+    except ValueError:
+        return None
+    if not np.isfinite(values).all():  # 'nan', 'inf', ...
+        return None
+
+    parsed = np.zeros((len(texts), 5))
+    parsed[:, 0] = np.abs(values)
+    parsed[:, 3] = np.where(np.signbit(values), -1.0, 1.0)
+    parsed[:, 4] = NO_LETTER
+    return parsed
+
+
+def _parse_column(texts):
+    """Parse raw texts: return (values in decimal degrees, letter kinds, empty mask, invalid mask) arrays."""
+    texts = np.array([(text or '').strip() for text in texts], dtype=np.str_)
+    uniques, inverse = np.unique(texts, return_inverse=True)
+    non_empty = uniques != ''
+
+    # One row per distinct text: degrees, minutes, seconds, sign, letter kind (NaN if empty or not understood)
+    decimals = _parse_decimals(uniques[non_empty])
+    if decimals is not None:
+        parsed = np.full((len(uniques), 5), np.nan)
+        parsed[non_empty] = decimals
+    else:  # Mixed formats: text by text
+        not_understood = (np.nan,) * 5
+        parsed = np.array([(_parse_text(text) or not_understood) if text else not_understood
+                           for text in uniques.tolist()], dtype=np.float64).reshape(-1, 5)
+
+    degrees, minutes, seconds, signs, kinds = parsed[inverse].T
+    empty = texts == ''
+    with np.errstate(invalid='ignore'):
+        invalid = ~empty & (np.isnan(degrees) | (minutes >= 60) | (seconds >= 60))
+    values = signs * (degrees + minutes / 60 + seconds / 3600)
+    return values, kinds, empty, invalid
+
+
+def normalize_coordinates(raw_latitudes, raw_longitudes):
+    """Parse and check sequences of raw latitude/longitude texts (None is like an empty text).
+
+    Returns a NormalizedCoordinates. The status of each pair is the most relevant problem: EMPTY, MISSING, INVALID,
+    SWAPPED (values valid once swapped, or N/S letter on the longitude, E/W on the latitude), OUT_OF_RANGE or VALID.
+    """
+    latitudes, latitude_kinds, latitude_empty, latitude_invalid = _parse_column(raw_latitudes)
+    longitudes, longitude_kinds, longitude_empty, longitude_invalid = _parse_column(raw_longitudes)
+
+    statuses = np.full(len(latitudes), VALID, dtype=np.int8)
+    with np.errstate(invalid='ignore'):
+        out_of_range = (np.abs(latitudes) > 90) | (np.abs(longitudes) > 180)
+        swapped = ((latitude_kinds == LONGITUDE_LETTER) | (longitude_kinds == LATITUDE_LETTER) |
+                   ((np.abs(latitudes) > 90) & (np.abs(longitudes) <= 90)))
+
+    # Later assignments win
+    statuses[out_of_range] = OUT_OF_RANGE
+    statuses[swapped] = SWAPPED
+    statuses[latitude_invalid | longitude_invalid] = INVALID
+    statuses[latitude_empty != longitude_empty] = MISSING
+    statuses[latitude_empty & longitude_empty] = EMPTY
+
+    not_valid = statuses != VALID
+    latitudes[not_valid] = np.nan
+    longitudes[not_valid] = np.nan
+    return NormalizedCoordinates(latitudes, longitudes, statuses)
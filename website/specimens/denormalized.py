@@ -0,0 +1,201 @@
+"""Denormalized specimen table (one row per specimen, with station, expedition, taxon lineage, ...) for data analysis.
+
+Rows are streamed from a server-side cursor and grouped in batches of columns, written as Parquet files (if pyarrow is
+installed) or gzipped CSV files. Files are partitioned by expedition, Hive-style: <directory>/expedition_id=<id>/, so
+pandas/pyarrow can load a subset of the collection (and of the columns) without reading everything.
+"""
+import csv
+import gzip
+import os
+from collections import OrderedDict
+
+from django.db.models import F, FloatField, Func
+
+from .models import (Specimen, SPECIES_RANK_NAME, SUBGENUS_RANK_NAME, GENUS_RANK_NAME, FAMILY_RANK_NAME)
+from .taxonomy import get_taxonomy_snapshot
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+PARQUET = 'parquet'
+CSV_GZ = 'csv.gz'
+
+BATCH_SIZE = 10000
+
+PARTITION_COLUMN = 'expedition_id'
+
+# Column name -> (source field or expression, type)
+SPECIMEN_COLUMNS = OrderedDict([
+    ('specimen_id', ('specimen_id', 'int64')),
+    ('initial_scientific_name', ('initial_scientific_name', 'string')),
+    ('taxon_id', ('taxon_id', 'int64')),
+    ('uncertain_identification', ('uncertain_identification', 'bool')),
+    ('identified_by', ('identified_by__last_name', 'string')),
+    ('specimen_location', ('specimen_location__name', 'string')),
+    ('fixation', ('fixation__name', 'string')),
+    ('bioregion', ('bioregion__name', 'string')),
+    ('vial', ('vial', 'string')),
+    ('mnhn_number', ('mnhn_number', 'string')),
+    ('bold_bin', ('bold_bin', 'string')),
+    ('station', ('station__name', 'string')),
+    ('expedition', ('station__expedition__name', 'string')),
+    ('gear', ('station__gear__name', 'string')),
+    ('longitude', (Func(F('station__coordinates'), function='ST_X', output_field=FloatField()), 'float64')),
+    ('latitude', (Func(F('station__coordinates'), function='ST_Y', output_field=FloatField()), 'float64')),
+    ('depth_min', (Func(F('station__depth'), function='lower', output_field=FloatField()), 'float64')),
+    ('depth_max', (Func(F('station__depth'), function='upper', output_field=FloatField()), 'float64')),
+    ('capture_date_start', ('station__capture_date_start', 'date32')),
+    ('capture_date_end', ('station__capture_date_end', 'date32')),
+    ('isotope_d13C', ('isotope_d13C', 'float64')),
+    ('isotope_d15N', ('isotope_d15N', 'float64')),
+    ('isotope_d34S', ('isotope_d34S', 'float64')),
+    ('isotope_percentN', ('isotope_percentN', 'float64')),
+    ('isotope_percentC', ('isotope_percentC', 'float64')),
+    ('isotope_percentS', ('isotope_percentS', 'float64')),
+    ('isotope_C_N_ratio', ('isotope_C_N_ratio', 'float64')),
+])
+
+# Taxon lineage columns (from the taxonomy snapshot rather than 8 self-joins): column name -> rank name
+LINEAGE_COLUMNS = OrderedDict([
+    ('kingdom', 'Kingdom'),
+    ('phylum', 'Phylum'),
+    ('class', 'Class'),
+    ('order', 'Order'),
+    ('family', FAMILY_RANK_NAME),
+    ('genus', GENUS_RANK_NAME),
+    ('subgenus', SUBGENUS_RANK_NAME),
+    ('species', SPECIES_RANK_NAME),
+])
+
+COLUMN_NAMES = list(SPECIMEN_COLUMNS) + list(LINEAGE_COLUMNS) + ['scientific_name']
+
+
+def _lineage(taxonomy, taxon_id):
+    """Values of the lineage columns (+ scientific name) for a taxon."""
+    names_by_rank = {}
+    taxon = taxonomy.get(taxon_id)
+    while taxon is not None:
+        names_by_rank[taxon.rank.name] = taxon.name
+        taxon = taxon.parent
+
+    return (tuple(names_by_rank.get(rank_name) for rank_name in LINEAGE_COLUMNS.values()) +
+            (taxonomy.full_name(taxon_id),))
+
+
+def specimen_batches(queryset=None, batch_size=BATCH_SIZE):
+    """Yield (expedition_id, columns) pairs, columns being a list of values per column (in COLUMN_NAMES order).
+
+    All the rows of a batch belong to the same expedition, and batches are ordered by expedition.
+    """
+    if queryset is None:
+        queryset = Specimen.objects.all()
+
+    annotations = {}
+    fields = []
+    for name, (source, _type) in SPECIMEN_COLUMNS.items():
+        if isinstance(source, str):
+            fields.append(source)
+        else:
+            annotations[name] = source
+            fields.append(name)
+
+    rows = (queryset.annotate(**annotations)
+                    .order_by('station__expedition_id', 'specimen_id')
+                    .values_list('station__expedition_id', *fields)
+                    .iterator(chunk_size=batch_size))
+
+    taxonomy = get_taxonomy_snapshot()
+    taxon_id_index = list(SPECIMEN_COLUMNS).index('taxon_id')
+    lineages = {}
+
+    batch = []
+    batch_expedition_id = None
+    for row in rows:
+        expedition_id, values = row[0], row[1:]
+        if batch and (expedition_id != batch_expedition_id or len(batch) == batch_size):
+            yield batch_expedition_id, [list(column) for column in zip(*batch)]
+            batch = []
+
+        taxon_id = values[taxon_id_index]
+        if taxon_id not in lineages:
+            lineages[taxon_id] = _lineage(taxonomy, taxon_id)
+
+        batch.append(values + lineages[taxon_id])
+        batch_expedition_id = expedition_id
+
+    if batch:
+        yield batch_expedition_id, [list(column) for column in zip(*batch)]
+
+
+class _ParquetFile(object):
+    extension = PARQUET
+
+    def __init__(self, path):
+        types = [column_type for _source, column_type in SPECIMEN_COLUMNS.values()]
+        types += ['string'] * (len(LINEAGE_COLUMNS) + 1)  # Lineage and scientific name
+        self.types = [getattr(pyarrow, 'bool_' if t == 'bool' else t)() for t in types]
+        self.schema = pyarrow.schema([pyarrow.field(name, t) for name, t in zip(COLUMN_NAMES, self.types)])
+        self.writer = pyarrow.parquet.ParquetWriter(path, self.schema, compression='snappy')
+
+    def write(self, columns):
+        arrays = [pyarrow.array(column, type=t) for column, t in zip(columns, self.types)]
+        self.writer.write_table(pyarrow.Table.from_batches([pyarrow.RecordBatch.from_arrays(arrays, COLUMN_NAMES)]))
+
+    def close(self):
+        self.writer.close()
+
+
+class _CsvGzFile(object):
+    extension = CSV_GZ
+
+    def __init__(self, path):
+        self.file = gzip.open(path, 'wt', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMN_NAMES)
+
+    def write(self, columns):
+        self.writer.writerows(zip(*columns))
+
+    def close(self):
+        self.file.close()
+
+
+def available_formats():
+    return [PARQUET, CSV_GZ] if pyarrow is not None else [CSV_GZ]
+
+
+def export_specimens(directory, format=None, queryset=None, batch_size=BATCH_SIZE):
+    """Write the denormalized specimens in directory, partitioned by expedition. Return the number of rows written.
+
+    format is PARQUET or CSV_GZ, by default Parquet if pyarrow is installed.
+    """
+    format = format or available_formats()[0]
+    if format not in available_formats():
+        raise ValueError("Format {format} is not available (is pyarrow installed?)".format(format=format))
+    file_class = _ParquetFile if format == PARQUET else _CsvGzFile
+
+    rows_count = 0
+    current_file = None
+    current_expedition_id = None
+    try:
+        for expedition_id, columns in specimen_batches(queryset, batch_size=batch_size):
+            if current_file is None or expedition_id != current_expedition_id:
+                if current_file is not None:
+                    current_file.close()
+
+                partition_directory = os.path.join(directory, '{column}={value}'.format(column=PARTITION_COLUMN,
+                                                                                          value=expedition_id))
+                os.makedirs(partition_directory, exist_ok=True)
+                current_file = file_class(os.path.join(partition_directory, 'part-0.' + file_class.extension))
+                current_expedition_id = expedition_id
+
+            current_file.write(columns)
+            rows_count += len(columns[0])
+    finally:
+        if current_file is not None:
+            current_file.close()
+
+    return rows_count
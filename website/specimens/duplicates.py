@@ -0,0 +1,142 @@
+"""Detection of duplicate specimens: same vial, station, scientific name, ... under different specimen IDs.
+
+Each specimen gets a fingerprint: the hash of its normalized (trimmed, lowercased, whitespace-collapsed) values of
+some fields. Exact duplicates are the fingerprints shared by several specimens, found by a single GROUP BY query
+(find_duplicates()).
+
+Near-duplicates (typos in the scientific name, ...) are found in memory (find_near_duplicates()): specimens are put in
+blocks by the exact values of some fields, and only the specimens of a same block are compared, by edit distance on
+the other fields. The whole collection is never compared pairwise.
+
+Specimens with a blank value in one of the fields (e.g. no vial) are ignored: nothing says they are the same.
+"""
+import hashlib
+from collections import defaultdict, namedtuple
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import connections, router
+
+from .matching import levenshtein, normalize
+from .models import Specimen
+
+DEFAULT_FIELDS = ('vial', 'station', 'initial_scientific_name')
+DEFAULT_FUZZY_FIELDS = ('initial_scientific_name',)
+
+TEXT_FIELD_TYPES = ('CharField', 'TextField')
+SEPARATOR = '\x1f'  # Between the values, in the fingerprint
+
+DuplicateGroup = namedtuple('DuplicateGroup', 'fingerprint specimen_ids')
+
+
+def specimen_fields(names):
+    """Model fields of Specimen for these names. Raise ValueError if they are not simple columns of Specimen."""
+    fields = []
+    for name in names:
+        try:
+            field = Specimen._meta.get_field(name)
+        except FieldDoesNotExist:
+            raise ValueError('Specimen has no {name} field'.format(name=name))
+        if not field.concrete or field.many_to_many or field.primary_key:
+            raise ValueError('{name} cannot be part of a fingerprint'.format(name=name))
+        fields.append(field)
+    return fields
+
+
+def _normalize_value(value):
+    if value is None:
+        return ''
+    return normalize(value) if isinstance(value, str) else str(value)
+
+
+def fingerprint(values):
+    """Hash of normalized values, the same as the one computed by find_duplicates()."""
+    return hashlib.md5(SEPARATOR.join(values).encode('utf-8')).hexdigest()
+
+
+def find_duplicates(field_names=DEFAULT_FIELDS):
+    """Groups of specimens with the same normalized values of the fields, in one query. Return DuplicateGroups."""
+    connection = connections[router.db_for_read(Specimen)]  # A raw query, but a read: can go to the replica
+    expressions = []
+    for field in specimen_fields(field_names):
+        column = connection.ops.quote_name(field.column)
+        if field.get_internal_type() in TEXT_FIELD_TYPES:
+            # Like matching.normalize()
+            expressions.append("lower(regexp_replace(btrim({column}), '\\s+', ' ', 'g'))".format(column=column))
+        else:
+            expressions.append('{column}::text'.format(column=column))
+
+    with connection.cursor() as cursor:
+        cursor.execute("""
+            SELECT md5(concat_ws(%s, {expressions})) AS fingerprint, array_agg(specimen_id ORDER BY specimen_id)
+            FROM {specimens}
+            WHERE {not_blank}
+            GROUP BY fingerprint
+            HAVING count(*) > 1
+            ORDER BY min(specimen_id)
+        """.format(expressions=', '.join(expressions), specimens=Specimen._meta.db_table,
+                   not_blank=' AND '.join("{e} <> ''".format(e=e) for e in expressions)), [SEPARATOR])
+        return [DuplicateGroup(*row) for row in cursor.fetchall()]
+
+
+def _similar(a, b, max_distance):
+    return all(levenshtein(value_a, value_b) <= max_distance for value_a, value_b in zip(a, b))
+
+
+def _block_groups(members, max_distance):
+    """Lists of specimen IDs of a block ((specimen_id, fuzzy values) pairs), similar ones together (transitively)."""
+    # Identical values are compared once
+    ids_by_values = defaultdict(list)
+    for specimen_id, values in members:
+        ids_by_values[values].append(specimen_id)
+    distinct_values = list(ids_by_values)
+
+    parents = list(range(len(distinct_values)))  # Union-find
+
+    def root(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, values in enumerate(distinct_values):
+        for j in range(i):
+            if _similar(values, distinct_values[j], max_distance):
+                parents[root(i)] = root(j)
+
+    groups = defaultdict(list)
+    for i, values in enumerate(distinct_values):
+        groups[root(i)].extend(ids_by_values[values])
+    return [sorted(specimen_ids) for specimen_ids in groups.values()]
+
+
+def find_near_duplicates(field_names=DEFAULT_FIELDS, fuzzy_field_names=DEFAULT_FUZZY_FIELDS, max_distance=2,
+                         queryset=None):
+    """Groups of specimens with the same normalized values of the fields, except for the fuzzy ones which can be up to
+    max_distance edits apart. Return DuplicateGroups, fingerprinted by the exact fields.
+    """
+    specimen_fields(field_names)
+    if not set(fuzzy_field_names) <= set(field_names):
+        raise ValueError('Fuzzy fields must be some of the fields')
+    block_indexes = [i for i, name in enumerate(field_names) if name not in fuzzy_field_names]
+    fuzzy_indexes = [i for i, name in enumerate(field_names) if name in fuzzy_field_names]
+    if not block_indexes:
+        raise ValueError('At least one field must be exact (not fuzzy), to make the blocks')
+
+    if queryset is None:
+        queryset = Specimen.objects.all()
+
+    blocks = defaultdict(list)
+    for specimen_id, *values in queryset.order_by().values_list('specimen_id', *field_names).iterator():
+        values = [_normalize_value(value) for value in values]
+        if '' in values:
+            continue
+        blocks[tuple(values[i] for i in block_indexes)].append((specimen_id, tuple(values[i] for i in fuzzy_indexes)))
+
+    groups = []
+    for key, members in blocks.items():
+        if len(members) > 1:
+            groups.extend(DuplicateGroup(fingerprint(key), specimen_ids)
+                          for specimen_ids in _block_groups(members, max_distance) if len(specimen_ids) > 1)
+
+    groups.sort(key=lambda group: group.specimen_ids[0])
+    return groups
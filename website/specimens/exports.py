@@ -0,0 +1,198 @@
+"""Background exports: the admin enqueues ExportJob rows, the run_export_worker command runs them.
+
+The queue is the ExportJob table itself: workers claim the oldest queued job with SELECT ... FOR UPDATE SKIP LOCKED, so
+several worker processes can share it without a broker. Rows are read in chunks (server-side cursor) and written to a
+temporary file, that is saved in the (private) export storage once complete.
+
+Running jobs record a heartbeat after each chunk (and before the other long steps): the jobs of workers that were
+killed are found by their old heartbeat and put back in the queue (see requeue_stale_jobs()). A worker only records the
+result of its job if it wasn't requeued meanwhile.
+"""
+import csv
+import datetime
+import decimal
+import io
+import tempfile
+import traceback
+
+from django.apps import apps
+from django.contrib import admin
+from django.contrib.auth.models import AnonymousUser
+from django.core.files import File
+from django.db import transaction
+from django.http import HttpRequest, QueryDict
+from django.utils import timezone
+from django.utils.http import urlencode
+from openpyxl import Workbook
+
+from .models import ExportJob
+from .routers import use_replica
+
+CHUNK_SIZE = 2000
+STALE_JOB_TIMEOUT = datetime.timedelta(minutes=15)  # Without heartbeat, a running job is considered abandoned
+MAX_ATTEMPTS = 3  # Runs of a job (e.g. one killing its worker by using too much memory) before it is marked as failed
+
+
+def default_export_fields(model):
+    """All the concrete fields of the model (ids for foreign keys)."""
+    return [field.attname for field in model._meta.concrete_fields]
+
+
+def enqueue_export(queryset, fields, format=ExportJob.CSV, user=None, changelist_params=None):
+    """Create (and return) an ExportJob for the objects in queryset.
+
+    To export all the objects of an admin changelist, pass the parameters of its query string (filters, search) in
+    changelist_params: the worker runs the same query. Otherwise, the primary keys of the objects are stored in the job,
+    so queryset should be small (e.g. the selected objects of a page).
+    """
+    model = queryset.model
+    if changelist_params is not None:
+        filters = {}
+    else:
+        filters = {'pk__in': list(queryset.values_list('pk', flat=True))}
+    return ExportJob.objects.create(model=model._meta.label,
+                                    filters=filters,
+                                    changelist_params=changelist_params,
+                                    fields=list(fields),
+                                    format=format,
+                                    requested_by=user)
+
+
+def job_queryset(job):
+    """The objects to export, with the changelist query of the ModelAdmin if the job has changelist_params."""
+    model = apps.get_model(job.model)
+    if job.changelist_params is None:
+        return model._default_manager.filter(**job.filters)
+
+    request = HttpRequest()
+    request.method = 'GET'
+    request.GET = QueryDict(urlencode(job.changelist_params))
+    request.user = job.requested_by or AnonymousUser()
+    model_admin = admin.site._registry[model]
+    return model_admin.get_changelist_instance(request).get_queryset(request).filter(**job.filters)
+
+
+def claim_next_job():
+    """Mark the oldest queued job as running and return it (None if the queue is empty).
+
+    Jobs locked by another worker are skipped, so each job is claimed only once.
+    """
+    with transaction.atomic():
+        job = (ExportJob.objects.select_for_update(skip_locked=True)
+                                .filter(status=ExportJob.QUEUED)
+                                .order_by('created_at', 'pk')
+                                .first())
+        if job is None:
+            return None
+
+        job.status = ExportJob.RUNNING
+        job.started_at = job.heartbeat_at = timezone.now()
+        job.attempts += 1
+        job.save(update_fields=['status', 'started_at', 'heartbeat_at', 'attempts'])
+
+    return job
+
+
+def requeue_job(job):
+    """Put back in the queue a job that was interrupted."""
+    ExportJob.objects.filter(pk=job.pk).update(status=ExportJob.QUEUED, started_at=None, heartbeat_at=None,
+                                               rows_total=None, rows_done=0)
+
+
+def requeue_stale_jobs(timeout=STALE_JOB_TIMEOUT):
+    """Put back in the queue the running jobs without heartbeat for timeout (their worker was killed).
+
+    Jobs that already ran MAX_ATTEMPTS times are marked as failed instead. Return the number of jobs requeued.
+    """
+    stale_jobs = ExportJob.objects.filter(status=ExportJob.RUNNING, heartbeat_at__lt=timezone.now() - timeout)
+    stale_jobs.filter(attempts__gte=MAX_ATTEMPTS).update(
+        status=ExportJob.FAILED, finished_at=timezone.now(),
+        error='The worker running the job stopped ({n} times).'.format(n=MAX_ATTEMPTS))
+    return stale_jobs.update(status=ExportJob.QUEUED, started_at=None, heartbeat_at=None, rows_total=None,
+                             rows_done=0)
+
+
+def _cell_value(value):
+    if value is None or isinstance(value, (str, int, float, decimal.Decimal, datetime.date, datetime.time)):
+        return value
+    return str(value)  # Geometries, ranges, ...
+
+
+def _write_csv(f, fields, rows_chunks):
+    text_file = io.TextIOWrapper(f, encoding='utf-8', newline='')
+    writer = csv.writer(text_file)
+    writer.writerow(fields)
+    for rows in rows_chunks:
+        writer.writerows([[_cell_value(value) for value in row] for row in rows])
+    text_file.flush()
+    text_file.detach()  # So closing the wrapper doesn't close f
+
+
+def _write_xlsx(f, fields, rows_chunks):
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet()
+    worksheet.append(fields)
+    for rows in rows_chunks:
+        for row in rows:
+            worksheet.append([_cell_value(value) for value in row])
+    workbook.save(f)
+
+
+WRITERS = {
+    ExportJob.CSV: _write_csv,
+    ExportJob.XLSX: _write_xlsx,
+}
+
+
+def _heartbeat(job, **fields):
+    """Record that the job is still running (and update the fields given)."""
+    ExportJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now(), **fields)
+
+
+def _rows_chunks(job, queryset, chunk_size):
+    """Yield the rows by chunks, updating the job progress after each one."""
+    chunk = []
+    rows_done = 0
+    for row in queryset.iterator(chunk_size=chunk_size):
+        chunk.append(row)
+        if len(chunk) == chunk_size:
+            yield chunk
+            rows_done += len(chunk)
+            _heartbeat(job, rows_done=rows_done)
+            chunk = []
+
+    if chunk:
+        yield chunk
+        rows_done += len(chunk)
+    _heartbeat(job, rows_done=rows_done)  # Before saving the file (a large XLSX takes a while)
+
+
+def run_job(job, chunk_size=CHUNK_SIZE):
+    """Run a (claimed) job: write the file and mark the job as done, or as failed if anything goes wrong."""
+    try:
+        model = apps.get_model(job.model)
+        with use_replica():  # The progress updates still go to the primary
+            queryset = job_queryset(job).values_list(*job.fields)
+            _heartbeat(job)
+            job.rows_total = queryset.count()
+        _heartbeat(job, rows_total=job.rows_total)
+
+        with tempfile.TemporaryFile() as f, use_replica():
+            WRITERS[job.format](f, job.fields, _rows_chunks(job, queryset, chunk_size))
+            f.seek(0)
+            _heartbeat(job)
+            job.file.save('{model}-{pk}.{format}'.format(model=model._meta.model_name, pk=job.pk, format=job.format),
+                          File(f), save=False)
+
+        job.status = ExportJob.DONE
+    except Exception:
+        job.status = ExportJob.FAILED
+        job.error = traceback.format_exc()
+
+    job.finished_at = timezone.now()
+    # Not if the job was requeued meanwhile (see requeue_stale_jobs()): another worker may be running it
+    recorded = ExportJob.objects.filter(pk=job.pk, status=ExportJob.RUNNING, attempts=job.attempts).update(
+        status=job.status, file=job.file, error=job.error, finished_at=job.finished_at, rows_total=job.rows_total)
+    if not recorded and job.file:
+        job.file.delete(save=False)
+    return job
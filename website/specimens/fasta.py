@@ -0,0 +1,197 @@
+"""FASTA files of the specimen sequences (see SpecimenSequence): streaming reader and writer, bulk import and export.
+
+Imported records are matched to specimens by the identifier of their header: its first word, or the first field of
+BOLD-style headers (">ANTAR123-10|Odontaster validus|COI-5P"). The identifier is looked up in the sequence names, then
+in the BOLD process and sample IDs. These are loaded once in an in-memory index (SequenceIndex), and the sequences are
+written by chunks: the import doesn't query the database for each record.
+"""
+import itertools
+from collections import namedtuple
+
+from django.db import transaction
+from django.db.models import Case, CharField, Value, When
+
+from .models import Specimen, SpecimenSequence
+
+CHUNK_SIZE = 1000
+LINE_LENGTH = 60  # Of the sequence lines written
+
+FastaRecord = namedtuple('FastaRecord', 'header sequence')
+Problem = namedtuple('Problem', 'header message')
+
+_AMBIGUOUS = object()  # Identifier of several specimens
+
+
+def read_fasta(f):
+    """Yield the FastaRecords of a (multi-)FASTA text file, read line by line. Sequence lines are joined."""
+    header = None
+    lines = []
+    for line_number, line in enumerate(f, start=1):
+        line = line.strip()
+        if not line or line.startswith(';'):  # Blank lines and comments
+            continue
+
+        if line.startswith('>'):
+            if header is not None:
+                yield FastaRecord(header, ''.join(lines))
+            header = line[1:].strip()
+            lines = []
+        elif header is None:
+            raise ValueError('Line {n}: sequence before the first header'.format(n=line_number))
+        else:
+            lines.append(line)
+
+    if header is not None:
+        yield FastaRecord(header, ''.join(lines))
+
+
+def fasta_text(header, sequence, line_length=LINE_LENGTH):
+    """A FASTA record, as stored in SpecimenSequence."""
+    lines = ['>' + header]
+    lines.extend(sequence[start:start + line_length] for start in range(0, len(sequence), line_length))
+    return '\n'.join(lines) + '\n'
+
+
+def record_identifier(header):
+    words = header.split(None, 1)
+    return words[0].split('|', 1)[0] if words else ''
+
+
+class SequenceIndex(object):
+    """Specimen pks by sequence name, BOLD process ID and sample ID, for the whole collection."""
+    FIELDS = ('sequence_name', 'bold_process_id', 'bold_sample_id')  # In matching order
+    LABELS = {'sequence_name': 'sequence name', 'bold_process_id': 'BOLD process ID',
+              'bold_sample_id': 'BOLD sample ID'}
+
+    def __init__(self, rows):
+        """rows: (pk, sequence_name, bold_process_id, bold_sample_id) tuples."""
+        self.pks = {field: {} for field in self.FIELDS}
+        for pk, *identifiers in rows:
+            for field, identifier in zip(self.FIELDS, identifiers):
+                identifier = identifier.strip()
+                if identifier:
+                    pks = self.pks[field]
+                    pks[identifier] = pk if pks.get(identifier, pk) == pk else _AMBIGUOUS
+
+        self.named_pks = {pk for pk in self.pks['sequence_name'].values() if pk is not _AMBIGUOUS}
+
+    @classmethod
+    def load(cls):
+        return cls(Specimen.objects.values_list('pk', *cls.FIELDS).iterator())
+
+    def match(self, identifier):
+        """(pk, field) of the specimen with this identifier. Raise LookupError if there's none, or several."""
+        for field in self.FIELDS:
+            pk = self.pks[field].get(identifier)
+            if pk is _AMBIGUOUS:
+                raise LookupError('Several specimens have this {label}'.format(label=self.LABELS[field]))
+            if pk is not None:
+                return pk, field
+        raise LookupError('No specimen with this sequence name or BOLD ID')
+
+    def has_sequence_name(self, pk):
+        return pk in self.named_pks
+
+    def add_sequence_name(self, pk, name):
+        """Record the new sequence name of a specimen. Return False (and change nothing) if another one has it."""
+        names = self.pks['sequence_name']
+        if names.get(name, pk) != pk:
+            return False
+        names[name] = pk
+        self.named_pks.add(pk)
+        return True
+
+
+def _write_chunk(fastas, sequence_names):
+    """fastas: pk -> FASTA text, sequence_names: pk -> new sequence name. Four queries at most.
+
+    The specimens of the written sequences get a new updated_at (by a trigger, see migration 0014), so the change feed
+    has the sequences.
+    """
+    with transaction.atomic():
+        SpecimenSequence.objects.filter(pk__in=list(fastas)).delete()
+        SpecimenSequence.objects.bulk_create(
+            SpecimenSequence(specimen_id=pk, compressed_fasta=SpecimenSequence.compress(fasta))
+            for pk, fasta in fastas.items())
+
+        if sequence_names:
+            Specimen.objects.filter(pk__in=list(sequence_names)).update(sequence_name=Case(
+                *[When(pk=pk, then=Value(name)) for pk, name in sequence_names.items()],
+                output_field=CharField()))
+
+
+def import_sequences(records, index=None, name_sequences=False, chunk_size=CHUNK_SIZE):
+    """Store the sequences of FastaRecords in the matching specimens, replacing their current one.
+
+    With name_sequences, the specimens matched by a BOLD ID and without sequence name get the identifier of the
+    header as sequence name, if no other specimen has it. Records that are empty, can't be matched or are for a
+    specimen already seen in the records are skipped. Return (number of sequences stored, list of Problems).
+    """
+    if index is None:
+        index = SequenceIndex.load()
+
+    stored_count = 0
+    problems = []
+    seen_pks = set()
+
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, chunk_size))
+        if not chunk:
+            break
+
+        fastas = {}
+        sequence_names = {}
+        for record in chunk:
+            if not record.sequence:
+                problems.append(Problem(record.header, 'Empty sequence'))
+                continue
+
+            identifier = record_identifier(record.header)
+            try:
+                pk, field = index.match(identifier)
+            except LookupError as e:
+                problems.append(Problem(record.header, str(e)))
+                continue
+
+            if pk in seen_pks:
+                problems.append(Problem(record.header, 'Specimen already has a sequence in this file'))
+                continue
+            seen_pks.add(pk)
+            fastas[pk] = fasta_text(record.header, record.sequence)
+
+            if name_sequences and field != 'sequence_name' and not index.has_sequence_name(pk):
+                if index.add_sequence_name(pk, identifier):
+                    sequence_names[pk] = identifier
+                else:
+                    problems.append(Problem(record.header, 'Sequence stored, but not named: another specimen has '
+                                                           'this sequence name'))
+
+        _write_chunk(fastas, sequence_names)
+        stored_count += len(fastas)
+
+    return stored_count, problems
+
+
+def export_sequences(f, queryset=None, chunk_size=CHUNK_SIZE):
+    """Write the sequences of the specimens of queryset (all by default) to a text file, in specimen_id order.
+
+    Rows are streamed from a server-side cursor. Sequences stored without a header get one: their sequence name, or
+    the specimen ID. Return the number of sequences written.
+    """
+    if queryset is None:
+        queryset = Specimen.objects.all()
+
+    rows = (SpecimenSequence.objects.filter(specimen__in=queryset)
+                                    .order_by('specimen__specimen_id')
+                                    .values_list('specimen__specimen_id', 'specimen__sequence_name', 'compressed_fasta')
+                                    .iterator(chunk_size=chunk_size))
+
+    count = 0
+    for specimen_id, sequence_name, compressed_fasta in rows:
+        fasta = SpecimenSequence.decompress(compressed_fasta).strip()
+        if not fasta.startswith('>'):  # Pasted in the admin without header
+            fasta = fasta_text(sequence_name or 'specimen_{id}'.format(id=specimen_id), ''.join(fasta.split()))
+        f.write(fasta.rstrip('\n') + '\n')
+        count += 1
+    return count
@@ -1,4 +1,22 @@
+import cProfile
+import csv
+import datetime
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from openpyxl import load_workbook
+
+from specimens.routers import use_replica
+
+# Date cells of XLSX files are converted to text like in the CSV exports of the lab's sheets, but with four-digit years
+# (the importer reads two-digit ones above 17 as 19xx): (D)D-(M)M-YYYY
+XLSX_DATE_FORMAT = '%d-%m-%Y'
+
+NO_STYLE = str  # For self.stderr.write(): not in the error color
 
 
 def validate_number_cols(row, expected_cols_count):
@@ -8,8 +26,218 @@ def validate_number_cols(row, expected_cols_count):
         raise CommandError("The source file has {actual_count} columns ({expected_count} expected)".format(
             actual_count=num_cols, expected_count=expected_cols_count))
 
+
+def xlsx_cell_to_str(value):
+    """Text representation of an XLSX cell value, as it would appear in a CSV export of the sheet."""
+    if value is None:
+        return ''
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))  # IDs, years, ... are sometimes stored as floats
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.strftime(XLSX_DATE_FORMAT)
+    return str(value)
+
+
+def xlsx_dict_reader(f, sheet_name=None):
+    """Iterate over the rows of a worksheet (the active one by default) like csv.DictReader does for CSV files.
+
+    The first row is the header. Values are strings, missing cells are '', values outside the header are in a list
+    under the None key. The workbook is read in openpyxl's read-only (streaming) mode.
+    """
+    workbook = load_workbook(f, read_only=True, data_only=True)
+    try:
+        worksheet = workbook[sheet_name] if sheet_name else workbook.active
+
+        rows = worksheet.iter_rows()
+        try:
+            header = [xlsx_cell_to_str(cell.value) for cell in next(rows)]
+        except StopIteration:
+            return
+        while header and not header[-1]:  # The sheet dimensions can include empty columns
+            header.pop()
+
+        for row in rows:
+            values = [xlsx_cell_to_str(cell.value) for cell in row]
+            if not any(values):
+                continue  # Like csv.DictReader, skip blank rows
+
+            d = OrderedDict(zip(header, values + [''] * (len(header) - len(values))))
+            extra_values = values[len(header):]
+            if any(extra_values):
+                d[None] = extra_values
+            yield d
+    finally:
+        workbook.close()  # Read-only workbooks keep their file open
+
+
+@contextmanager
+def source_rows(path):
+    """Rows (dicts keyed by the header) of a CSV or XLSX file, depending on its extension."""
+    if path.lower().endswith('.xlsx'):
+        with open(path, 'rb') as f:
+            yield xlsx_dict_reader(f)
+    else:
+        with open(path) as f:
+            yield csv.DictReader(f, delimiter=',')
+
+
+class CommandStats(object):
+    """Timings, database queries and throughput of a command run.
+
+    Time and queries are attributed to all the stages active when they happen (stages can be nested).
+    """
+    def __init__(self, command_name):
+        self.command_name = command_name
+        self.rows_count = 0
+        self.queries_count = 0
+        self.queries_time = 0.0
+        self.stages = OrderedDict()
+        self.subcommands = OrderedDict()
+
+        self._active_stages = []
+        self._start = time.perf_counter()
+        self._duration = None
+
+    def _get_stage(self, name):
+        return self.stages.setdefault(name, {'calls': 0, 'time': 0.0, 'queries_count': 0, 'queries_time': 0.0})
+
+    def query_wrapper(self, execute, sql, params, many, context):
+        """To be installed with connection.execute_wrapper()."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.queries_count += 1
+            self.queries_time += elapsed
+            for name in set(self._active_stages):
+                stage = self._get_stage(name)
+                stage['queries_count'] += 1
+                stage['queries_time'] += elapsed
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block (and its queries) under the given stage name."""
+        stage = self._get_stage(name)
+        self._active_stages.append(name)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stage['calls'] += 1
+            stage['time'] += time.perf_counter() - start
+            self._active_stages.pop()
+
+    def record_stage(self, name, duration):
+        """Add an externally measured duration to a stage."""
+        stage = self._get_stage(name)
+        stage['calls'] += 1
+        stage['time'] += duration
+
+    def count_row(self, n=1):
+        self.rows_count += n
+
+    def stop(self):
+        self._duration = time.perf_counter() - self._start
+
+    @property
+    def duration(self):
+        if self._duration is not None:
+            return self._duration
+        return time.perf_counter() - self._start
+
+    def summary(self):
+        duration = self.duration
+        summary = OrderedDict([
+            ('command', self.command_name),
+            ('duration', round(duration, 3)),
+            ('rows', self.rows_count),
+            ('rows_per_second', round(self.rows_count / duration, 1) if duration else None),
+            ('queries_count', self.queries_count),
+            ('queries_time', round(self.queries_time, 3)),
+            ('stages', OrderedDict((name, OrderedDict([
+                ('calls', stage['calls']),
+                ('time', round(stage['time'], 3)),
+                ('queries_count', stage['queries_count']),
+                ('queries_time', round(stage['queries_time'], 3))
+            ])) for name, stage in self.stages.items())),
+        ])
+        if self.subcommands:
+            summary['subcommands'] = self.subcommands
+        return summary
+
+
 class AstaporCommand(BaseCommand):
+    """Base class for our commands.
+
+    It instruments the command run: time spent in named stages (see self.stats.stage()), number and duration of SQL
+    queries, processed rows per second. A JSON summary is written at the end (to the standard error, not to mix with
+    the data of commands writing to the standard output), and --profile allows to get a full cProfile dump.
+
+    Commands that only read (exports, analytics) set replica_reads: they then read from the replica database, if there
+    is one (see routers.py).
+    """
+    replica_reads = False
+
     def __init__(self, *args, **kwargs):
         super(AstaporCommand, self).__init__(*args, **kwargs)
 
-        self.w = self.stdout.write  # Alias to save keystrokes :)
\ No newline at end of file
+        self.stats = CommandStats(self.command_name)
+
+    @property
+    def command_name(self):
+        return self.__module__.rsplit('.', 1)[-1]
+
+    def w(self, *args, **kwargs):  # Shortcut to save keystrokes :)
+        return self.stdout.write(*args, **kwargs)
+
+    def create_parser(self, prog_name, subcommand):
+        parser = super(AstaporCommand, self).create_parser(prog_name, subcommand)
+
+        parser.add_argument(
+            '--profile',
+            dest='profile',
+            metavar='FILE',
+            help='Run the command under cProfile and write the stats to FILE (readable with pstats)',
+        )
+        parser.add_argument(
+            '--summary-file',
+            dest='summary_file',
+            metavar='FILE',
+            help='Write the JSON summary (timings, queries, throughput) to FILE instead of the standard error',
+        )
+        return parser
+
+    def execute(self, *args, **options):
+        self.stats = CommandStats(self.command_name)
+
+        profiler = cProfile.Profile() if options.get('profile') else None
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(self.stats.query_wrapper))
+                if self.replica_reads:
+                    stack.enter_context(use_replica())
+
+                if profiler:
+                    profiler.enable()
+                try:
+                    return super(AstaporCommand, self).execute(*args, **options)
+                finally:
+                    if profiler:
+                        profiler.disable()
+        finally:
+            self.stats.stop()
+            if profiler:
+                profiler.dump_stats(options['profile'])
+            self.write_summary(options)
+
+    def write_summary(self, options):
+        summary = json.dumps(self.stats.summary(), indent=2)
+
+        if options.get('summary_file'):
+            with open(options['summary_file'], 'w') as summary_file:
+                summary_file.write(summary)
+        elif options.get('verbosity', 1) >= 1:
+            self.stderr.write('Summary for {name}:'.format(name=self.command_name), style_func=NO_STYLE)
+            self.stderr.write(summary, style_func=NO_STYLE)
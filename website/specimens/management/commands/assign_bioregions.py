@@ -0,0 +1,15 @@
+from specimens.bioregions import assign_bioregions
+
+from ._utils import AstaporCommand
+
+
+class Command(AstaporCommand):
+    help = ('Set the bioregion of the specimens from the coordinates of their station and the bioregion boundaries '
+            '(see load_bioregions). Specimens of stations outside all boundaries are left untouched.')
+
+    def handle(self, *args, **options):
+        self.w('Assigning bioregions to specimens...', ending='')
+        with self.stats.stage('assign'):
+            updated_count = assign_bioregions()
+        self.stats.count_row(updated_count)
+        self.w(self.style.SUCCESS('{count} specimens updated.'.format(count=updated_count)))
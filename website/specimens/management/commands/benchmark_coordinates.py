@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+
+from specimens.coordinates import normalize_coordinates, STATUS_MESSAGES, VALID, EMPTY
+
+from ._utils import AstaporCommand
+
+FORMATS = ('decimal', 'dms', 'dm')
+
+STATUS_LABELS = dict(STATUS_MESSAGES)
+STATUS_LABELS.update({VALID: 'Valid', EMPTY: 'Empty'})
+
+
+def _hemisphere_texts(values, positive_letter, negative_letter, format):
+    """Texts of decimal degrees in the dms or dm format, with a hemisphere letter."""
+    letters = np.where(values < 0, negative_letter, positive_letter).tolist()
+    values = np.abs(values)
+
+    # Rounded first, so that the printed minutes/seconds are never 60
+    if format == 'dm':
+        thousandths = np.round(values * 60000).astype(int)
+        degrees, minutes = np.divmod(thousandths, 60000)
+        return ['{d} {m:.3f}'.format(d=d, m=m / 1000).replace('.', ',') + ' ' + letter
+                for d, m, letter in zip(degrees.tolist(), minutes.tolist(), letters)]
+
+    tenths = np.round(values * 36000).astype(int)
+    degrees, tenths = np.divmod(tenths, 36000)
+    minutes, tenths = np.divmod(tenths, 600)
+    return ['{d}°{m}\'{s:.1f}" {letter}'.format(d=d, m=m, s=s / 10, letter=letter)
+            for d, m, s, letter in zip(degrees.tolist(), minutes.tolist(), tenths.tolist(), letters)]
+
+
+def generate_pairs(count, format, seed=0):
+    """Random (latitudes, longitudes) texts, like in the lab sheets. format is one of FORMATS or 'mixed'."""
+    random = np.random.RandomState(seed)
+    latitudes = random.uniform(-90, -40, count)  # Southern Ocean
+    longitudes = random.uniform(-180, 180, count)
+
+    if format == 'mixed':
+        parts = np.array_split(np.arange(count), len(FORMATS))
+        raw_latitudes, raw_longitudes = [], []
+        for part, part_format in zip(parts, FORMATS):
+            part_latitudes, part_longitudes = _format_pairs(latitudes[part], longitudes[part], part_format)
+            raw_latitudes += part_latitudes
+            raw_longitudes += part_longitudes
+        return raw_latitudes, raw_longitudes
+
+    return _format_pairs(latitudes, longitudes, format)
+
+
+def _format_pairs(latitudes, longitudes, format):
+    """Texts of the coordinates (decimal degrees) in one of FORMATS."""
+    if format == 'decimal':
+        return ([text.replace('.', ',') for text in np.char.mod('%.5f', latitudes).tolist()],
+                np.char.mod('%.5f', longitudes).tolist())
+    return _hemisphere_texts(latitudes, 'N', 'S', format), _hemisphere_texts(longitudes, 'E', 'W', format)
+
+
+class Command(AstaporCommand):
+    help = 'Measure the throughput of the coordinates normalization (see specimens/coordinates.py) on random data.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--pairs',
+            dest='pairs',
+            type=int,
+            default=1000000,
+            help='Number of latitude/longitude pairs (default: 1000000)',
+        )
+
+        parser.add_argument(
+            '--format',
+            dest='format',
+            choices=FORMATS + ('mixed',),
+            default='mixed',
+            help='Format of the generated coordinates (default: mixed, a third of each format)',
+        )
+
+    def handle(self, *args, **options):
+        self.w('Generating {n} pairs ({format})...'.format(n=options['pairs'], format=options['format']))
+        with self.stats.stage('generate'):
+            raw_latitudes, raw_longitudes = generate_pairs(options['pairs'], options['format'])
+
+        self.w('Normalizing...')
+        with self.stats.stage('normalize'):
+            start = time.perf_counter()
+            normalized = normalize_coordinates(raw_latitudes, raw_longitudes)
+            duration = time.perf_counter() - start
+        self.stats.count_row(options['pairs'])
+
+        self.w(self.style.SUCCESS('{n} pairs normalized in {d:.2f}s ({rate:.0f} pairs/s).'.format(
+            n=options['pairs'], d=duration, rate=options['pairs'] / duration if duration else float('inf'))))
+        for status, count in enumerate(np.bincount(normalized.statuses).tolist()):
+            if count:
+                self.w('{label}: {count}'.format(label=STATUS_LABELS[status], count=count))
@@ -0,0 +1,90 @@
+import json
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.core.management.base import CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from psycopg2.extras import Range
+
+from specimens.changes import (changes_since, purge_tombstones, sync_cursor, tombstones_purged_since,
+                               TOMBSTONE_RETENTION, TRACKED_MODELS)
+
+from ._utils import AstaporCommand
+
+
+class ChangeEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        if isinstance(o, GEOSGeometry):
+            return json.loads(o.geojson)
+        if isinstance(o, Range):
+            return [o.lower, o.upper]
+        return super(ChangeEncoder, self).default(o)
+
+
+class Command(AstaporCommand):
+    help = ('Export the specimens, stations and taxa created, updated or deleted since a given time, as JSON lines '
+            '(one change per line), for incremental syncs. Also purge the deletions older than the retention.')
+    # Not from the replica: changes committed before the sync cursor, but not replicated yet, would be missed
+    replica_reads = False
+
+    def add_arguments(self, parser):
+        parser.add_argument('since', nargs='?', help='ISO 8601 date and time (e.g. 2018-02-19T02:00:00+01:00), '
+                                                     'usually the cursor given by the previous export')
+        parser.add_argument('output_file')
+
+        parser.add_argument(
+            '--models',
+            dest='models',
+            nargs='+',
+            choices=[model._meta.model_name for model in TRACKED_MODELS],
+            help='Only export the changes of these models (default: all)',
+        )
+
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            dest='full',
+            default=False,
+            help='Export everything (for a resync from scratch) instead of the changes since a given time',
+        )
+
+    def parse_since(self, options):
+        if options['full']:
+            if options['since']:
+                raise CommandError("Give either a time or --full, not both")
+            return None
+        if not options['since']:
+            raise CommandError("Give the time to export the changes since, or --full")
+
+        since = parse_datetime(options['since'])
+        if since is None:
+            raise CommandError("{since} is not a valid date and time".format(since=options['since']))
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+        if tombstones_purged_since(since):
+            raise CommandError("The deletions are only kept {days} days: resync from scratch with --full".format(
+                days=TOMBSTONE_RETENTION.days))
+        return since
+
+    def handle(self, *args, **options):
+        since = self.parse_since(options)
+
+        models = [model for model in TRACKED_MODELS
+                  if not options['models'] or model._meta.model_name in options['models']]
+
+        cursor = sync_cursor()  # Before reading, so nothing committed meanwhile is missed next time
+        if since is None:
+            self.w('Exporting everything...')
+        else:
+            self.w('Exporting changes since {since}...'.format(since=since.isoformat()))
+        with open(options['output_file'], 'w') as f, self.stats.stage('export'):
+            for change in changes_since(since, models=models):
+                f.write(json.dumps(change._asdict(), cls=ChangeEncoder) + '\n')
+                self.stats.count_row()
+
+        self.w(self.style.SUCCESS('{count} change(s) exported. Next export: since {cursor}'.format(
+            count=self.stats.rows_count, cursor=cursor.isoformat())))
+
+        with self.stats.stage('purge'):
+            self.w('{count} tombstone(s) purged.'.format(count=purge_tombstones()))
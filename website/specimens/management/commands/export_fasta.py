@@ -0,0 +1,52 @@
+from django.core.exceptions import FieldError
+from django.core.management.base import CommandError
+
+from specimens.fasta import export_sequences, CHUNK_SIZE
+from specimens.models import Specimen
+
+from ._utils import AstaporCommand
+
+
+class Command(AstaporCommand):
+    help = 'Export the sequences of the specimens (all, or those matching some filters) as a multi-FASTA file.'
+    replica_reads = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_file')
+
+        parser.add_argument(
+            '--filter',
+            dest='filters',
+            action='append',
+            default=[],
+            metavar='LOOKUP=VALUE',
+            help='Only export the specimens matching this lookup, e.g. station__expedition__name="ANT XXVII/3 '
+                 '(CAMBIO)" or taxon__name__startswith=Odontaster. Can be repeated.',
+        )
+
+        parser.add_argument(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=CHUNK_SIZE,
+            help='Number of sequences fetched at once (default: {size})'.format(size=CHUNK_SIZE),
+        )
+
+    def handle(self, *args, **options):
+        filters = {}
+        for specimen_filter in options['filters']:
+            lookup, separator, value = specimen_filter.partition('=')
+            if not separator:
+                raise CommandError("{filter} is not like LOOKUP=VALUE".format(filter=specimen_filter))
+            filters[lookup.strip()] = value
+
+        try:
+            queryset = Specimen.objects.filter(**filters)
+        except FieldError as e:
+            raise CommandError(str(e))
+
+        self.w('Exporting sequences to {path}...'.format(path=options['output_file']), ending='')
+        with open(options['output_file'], 'w') as f, self.stats.stage('export'):
+            count = export_sequences(f, queryset=queryset, chunk_size=options['chunk_size'])
+        self.stats.count_row(count)
+        self.w(self.style.SUCCESS('{count} sequence(s) exported.'.format(count=count)))
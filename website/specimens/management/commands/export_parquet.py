@@ -0,0 +1,61 @@
+import os
+import shutil
+
+from django.core.management.base import CommandError
+
+from specimens.denormalized import export_specimens, available_formats, BATCH_SIZE, PARQUET, CSV_GZ
+
+from ._utils import AstaporCommand
+
+
+class Command(AstaporCommand):
+    help = ('Export the denormalized specimens (with station, expedition, taxon lineage, ...) as Parquet files '
+            'partitioned by expedition, or gzipped CSV files if pyarrow is not installed.')
+    replica_reads = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('output_directory')
+
+        parser.add_argument(
+            '--format',
+            dest='format',
+            choices=[PARQUET, CSV_GZ],
+            help='Output format (default: parquet if pyarrow is installed, csv.gz otherwise)',
+        )
+
+        parser.add_argument(
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=BATCH_SIZE,
+            help='Number of rows fetched and written at once (default: {size})'.format(size=BATCH_SIZE),
+        )
+
+        parser.add_argument(
+            '--overwrite',
+            action='store_true',
+            dest='overwrite',
+            default=False,
+            help='Delete the content of the output directory first',
+        )
+
+    def handle(self, *args, **options):
+        directory = options['output_directory']
+        format = options['format'] or available_formats()[0]
+
+        if format not in available_formats():
+            raise CommandError("The {format} format requires pyarrow".format(format=format))
+        if not options['format'] and format != PARQUET:
+            self.w(self.style.WARNING('pyarrow is not installed, exporting as gzipped CSV.'))
+
+        if os.path.isdir(directory) and os.listdir(directory):
+            if not options['overwrite']:
+                raise CommandError("{directory} is not empty (use --overwrite)".format(directory=directory))
+            shutil.rmtree(directory)
+        os.makedirs(directory, exist_ok=True)
+
+        self.w('Exporting specimens to {directory}...'.format(directory=directory), ending='')
+        with self.stats.stage('export'):
+            rows_count = export_specimens(directory, format=format, batch_size=options['batch_size'])
+        self.stats.count_row(rows_count)
+        self.w(self.style.SUCCESS('{count} specimens exported.'.format(count=rows_count)))
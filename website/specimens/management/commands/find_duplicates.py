@@ -0,0 +1,90 @@
+import csv
+
+from django.core.management.base import CommandError
+
+from specimens.duplicates import find_duplicates, find_near_duplicates, DEFAULT_FIELDS, DEFAULT_FUZZY_FIELDS
+from specimens.models import Specimen
+
+from ._utils import AstaporCommand
+
+# Always in the report, to help the review
+REPORT_FIELDS = ('specimen_id', 'station__expedition__name', 'station__name', 'vial', 'initial_scientific_name',
+                 'taxon__name', 'mnhn_number', 'comment')
+REPORT_CHUNK_SIZE = 1000
+
+
+class Command(AstaporCommand):
+    help = ('Find the specimens that are probably duplicates: same normalized values of some fields (by default vial, '
+            'station and initial scientific name) under different specimen IDs, and write a report to review them.')
+    replica_reads = True
+
+    def add_arguments(self, parser):
+        parser.add_argument('report', help='CSV file, one line per specimen of each group of duplicates')
+
+        parser.add_argument(
+            '--fields',
+            dest='fields',
+            nargs='+',
+            default=list(DEFAULT_FIELDS),
+            help='Fields of the fingerprint (default: {fields})'.format(fields=' '.join(DEFAULT_FIELDS)),
+        )
+
+        parser.add_argument(
+            '--fuzzy',
+            dest='fuzzy_fields',
+            nargs='*',
+            metavar='FIELD',
+            help='Also find near-duplicates, these fields (default: {fields}) being compared by edit distance '
+                 'instead of exactly'.format(fields=' '.join(DEFAULT_FUZZY_FIELDS)),
+        )
+
+        parser.add_argument(
+            '--max-distance',
+            dest='max_distance',
+            type=int,
+            default=2,
+            help='Maximum edit distance between the values of fuzzy fields (default: 2)',
+        )
+
+    def report_rows(self, groups, fields):
+        extra_fields = [field for field in fields if field not in REPORT_FIELDS]
+        group_numbers = {}
+        for group_number, group in enumerate(groups, start=1):
+            for specimen_id in group.specimen_ids:
+                group_numbers[specimen_id] = (group_number, group.fingerprint)
+
+        yield ('group', 'fingerprint') + REPORT_FIELDS + tuple(extra_fields)
+
+        specimen_ids = [specimen_id for group in groups for specimen_id in group.specimen_ids]
+        for start in range(0, len(specimen_ids), REPORT_CHUNK_SIZE):
+            chunk = specimen_ids[start:start + REPORT_CHUNK_SIZE]
+            rows = {row[0]: row for row in Specimen.objects.filter(specimen_id__in=chunk).values_list(
+                *(REPORT_FIELDS + tuple(extra_fields)))}
+            for specimen_id in chunk:
+                yield group_numbers[specimen_id] + rows[specimen_id]
+
+    def handle(self, *args, **options):
+        fields = options['fields']
+        fuzzy_fields = options['fuzzy_fields']
+
+        try:
+            if fuzzy_fields is None:
+                self.w('Grouping specimens by fingerprint...')
+                with self.stats.stage('exact'):
+                    groups = find_duplicates(fields)
+            else:
+                self.w('Comparing specimens by blocks...')
+                with self.stats.stage('near'):
+                    groups = find_near_duplicates(fields, fuzzy_fields or DEFAULT_FUZZY_FIELDS,
+                                                  max_distance=options['max_distance'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        with open(options['report'], 'w', newline='') as f, self.stats.stage('report'):
+            csv.writer(f).writerows(self.report_rows(groups, fields))
+
+        specimens_count = sum(len(group.specimen_ids) for group in groups)
+        self.stats.count_row(specimens_count)
+        message = '{groups} group(s) of duplicates, {specimens} specimen(s).'.format(groups=len(groups),
+                                                                                     specimens=specimens_count)
+        self.w(self.style.WARNING(message) if groups else self.style.SUCCESS(message))
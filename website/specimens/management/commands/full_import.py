@@ -1,22 +1,261 @@
+import multiprocessing
+import time
+import traceback
+from multiprocessing.connection import wait
+
 from django.core import management
+from django.core.management.base import CommandError
+from django.db import connection, connections, transaction
+from django.db.models import CASCADE
+from django.db.models.functions import Now
+
+from specimens.changes import tables_reload, TRACKED_MODELS
+from specimens.clustering import deferred_refresh
+from specimens.models import TaxonRank
+from specimens.taxonomy import bulk_taxonomy_changes
 
 from ._utils import AstaporCommand
+from . import import_specimens, import_taxonomy
+
+
+class Stage(object):
+    """A management command to run as part of the import, after the stages it depends on.
+
+    Stages that don't depend on each other are run concurrently (in separate processes, with separate database
+    connections), so they should not touch the same tables.
+    """
+    def __init__(self, name, args=(), depends_on=()):
+        self.name = name  # Also the name of the command
+        self.args = list(args)
+        self.depends_on = set(depends_on)
+
+
+class StageFailed(Exception):
+    pass
+
+
+class _Rollback(Exception):
+    pass
+
+
+class TableBackup(object):
+    """Copy of the tables emptied by the import, to put the previous data back if a stage fails.
+
+    Each stage commits in its own process, and the later waves need the data committed by the earlier ones: a database
+    rollback alone can't undo a failed import. The copies double the size of the tables until the import is over.
+    """
+    PREFIX = 'full_import_backup_'
+
+    def __init__(self, models):
+        self.tables = [model._meta.db_table for model in models]
+
+    def _names(self, table):
+        return {'table': connection.ops.quote_name(table), 'backup': connection.ops.quote_name(self.PREFIX + table)}
+
+    def exists(self, cursor):
+        existing = set(connection.introspection.table_names(cursor))
+        return any(self.PREFIX + table in existing for table in self.tables)
+
+    def save(self, cursor):
+        for table in self.tables:
+            cursor.execute('CREATE TABLE {backup} AS SELECT * FROM {table}'.format_map(self._names(table)))
+
+    def restore(self, cursor):
+        """Replace the content of the tables by the copies (foreign keys are only checked at commit)."""
+        for table in self.tables:
+            names = self._names(table)
+            # Without the tombstone and timestamp triggers: the rows come back as they were
+            cursor.execute('ALTER TABLE {table} DISABLE TRIGGER USER'.format_map(names))
+            cursor.execute('DELETE FROM {table}'.format_map(names))
+            cursor.execute('INSERT INTO {table} SELECT * FROM {backup}'.format_map(names))
+            cursor.execute('ALTER TABLE {table} ENABLE TRIGGER USER'.format_map(names))
+
+    def drop(self, cursor):
+        for table in self.tables:
+            cursor.execute('DROP TABLE {backup}'.format_map(self._names(table)))
+
+
+def cascaded_models(models):
+    """The models and, recursively, the ones whose rows are deleted along with theirs (on_delete=CASCADE)."""
+    found = []
+    pending = list(models)
+    while pending:
+        model = pending.pop(0)
+        if model not in found:
+            found.append(model)
+            pending.extend(relation.related_model for relation in model._meta.related_objects
+                           if relation.on_delete is CASCADE)
+    return found
+
+
+def plan_waves(stages):
+    """Group stages in successive waves: each wave only depends on the previous ones."""
+    remaining = list(stages)
+    done = set()
+    waves = []
+
+    while remaining:
+        wave = [stage for stage in remaining if stage.depends_on <= done]
+        if not wave:
+            raise CommandError("Circular or unknown dependencies between stages: {names}".format(
+                names=', '.join(stage.name for stage in remaining)))
+        waves.append(wave)
+        done.update(stage.name for stage in wave)
+        remaining = [stage for stage in remaining if stage not in wave]
+
+    return waves
+
+
+def _run_stage(stage, conn):
+    """Run a stage (in a child process) in a transaction, and only commit when the parent says so."""
+    try:
+        command = management.load_command_class('specimens', stage.name)
+        with transaction.atomic():
+            management.call_command(command, *stage.args, verbosity=0)
+
+            conn.send(('ready', command.stats.summary()))
+            if conn.recv() != 'commit':
+                raise _Rollback()
+    except _Rollback:
+        conn.send(('rolled_back', None))
+    except BaseException:
+        conn.send(('error', traceback.format_exc()))
+    else:
+        conn.send(('committed', None))
+    finally:
+        connections.close_all()
 
 
 class Command(AstaporCommand):
-    help = 'Call other commands in sequence to perform the full data import and initial processing.'
+    help = ('Perform the full data import and initial processing: truncate the tables, import specimens and taxonomy '
+            '(concurrently), reconcile taxonomy then assign bioregions. If a stage fails, the previous data is put '
+            'back.')
 
     def add_arguments(self, parser):
-        parser.add_argument('specimen_csv_file')
-        parser.add_argument('taxonomy_csv_file')
+        parser.add_argument('specimen_csv_file', nargs='?', help='CSV or XLSX file')
+        parser.add_argument('taxonomy_csv_file', nargs='?', help='CSV or XLSX file')
+
+        parser.add_argument(
+            '--restore-backup',
+            action='store_true',
+            dest='restore_backup',
+            default=False,
+            help='Only put back the data kept aside by an interrupted import',
+        )
+
+    def truncate(self, backup):
+        # Done beforehand rather than by each import: deleting taxa would also delete the related specimens, so the
+        # two imports wouldn't touch disjoint tables anymore. Fed to the sync consumers as a reset, not as deletions.
+        with self.stats.stage('truncate'), tables_reload(), deferred_refresh(), bulk_taxonomy_changes():
+            with connection.cursor() as cursor:
+                backup.save(cursor)
+            for model in import_specimens.MODELS_TO_TRUNCATE + import_taxonomy.MODELS_TO_TRUNCATE:
+                self.w('Truncate model {name}...'.format(name=model.__name__), ending='')
+                model.objects.all().delete()
+                self.w(self.style.SUCCESS('Done.'))
+
+    def restore(self, backup):
+        with self.stats.stage('restore'), tables_reload(), deferred_refresh(), bulk_taxonomy_changes():
+            with connection.cursor() as cursor:
+                backup.restore(cursor)
+                backup.drop(cursor)
+            # The consumers may have synced since the truncate: they get the previous data again, after a new reset
+            for model in TRACKED_MODELS:
+                model.objects.update(updated_at=Now())
+        TaxonRank.objects.clear_cache()
+
+    def run_wave(self, wave):
+        """Run the stages of the wave concurrently, commit all of them or none (fail fast)."""
+        # Children must not share the parent connection: they'll open their own.
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+
+        running = {}  # connection -> (stage, process, start time)
+        for stage in wave:
+            parent_conn, child_conn = context.Pipe()
+            process = context.Process(target=_run_stage, args=(stage, child_conn), name=stage.name)
+            process.start()
+            running[parent_conn] = (stage, process, time.perf_counter())
+
+        ready = set()
+        try:
+            while len(ready) < len(wave):
+                for conn in wait([conn for conn in running if conn not in ready]):
+                    stage, process, start = running[conn]
+                    try:
+                        status, payload = conn.recv()
+                    except EOFError:
+                        status, payload = 'error', 'Process exited unexpectedly (code {c})'.format(c=process.exitcode)
+
+                    if status != 'ready':
+                        raise StageFailed('Stage {name} failed:\n{error}'.format(name=stage.name, error=payload))
+
+                    duration = time.perf_counter() - start
+                    self.stats.record_stage(stage.name, duration)
+                    self.stats.subcommands[stage.name] = payload
+                    self.w(self.style.SUCCESS('Stage {name} done in {d:.1f}s.'.format(name=stage.name, d=duration)))
+                    ready.add(conn)
+        except BaseException:
+            # Fail fast: the finished stages roll back, the running ones are stopped right away (the database rolls
+            # back their transaction when the connection drops).
+            for conn, (stage, process, start) in running.items():
+                if conn in ready:
+                    conn.send('rollback')
+                else:
+                    process.terminate()
+            for stage, process, start in running.values():
+                process.join()
+            raise
+
+        for conn in running:
+            conn.send('commit')
+        for conn, (stage, process, start) in running.items():
+            status, payload = conn.recv()
+            process.join()
+            if status != 'committed':
+                raise StageFailed('Stage {name} could not commit:\n{error}'.format(name=stage.name, error=payload))
 
     def handle(self, *args, **options):
-        self.w('1. Importing specimens')
-        management.call_command('import_specimens', '--truncate', '{f}'.format(f=options['specimen_csv_file']))
+        backup = TableBackup(cascaded_models(import_specimens.MODELS_TO_TRUNCATE +
+                                             import_taxonomy.MODELS_TO_TRUNCATE))
+        with connection.cursor() as cursor:
+            backup_exists = backup.exists(cursor)
+
+        if options['restore_backup']:
+            if not backup_exists:
+                raise CommandError('There is no backup to restore')
+            self.w('Restoring the data kept aside by the interrupted import')
+            self.restore(backup)
+            return
+
+        if not (options['specimen_csv_file'] and options['taxonomy_csv_file']):
+            raise CommandError('The specimen and taxonomy files are required')
+        if backup_exists:
+            raise CommandError('A previous import was interrupted, its backup tables ({prefix}*) are still there. Put '
+                               'the data back with --restore-backup, or drop them.'.format(prefix=TableBackup.PREFIX))
+
+        stages = [
+            Stage('import_specimens', args=[options['specimen_csv_file']]),
+            Stage('import_taxonomy', args=[options['taxonomy_csv_file']]),
+            Stage('reconcile_taxonomy', args=['--all'], depends_on=['import_specimens', 'import_taxonomy']),
+            # Also updates specimens: not concurrently with reconcile_taxonomy
+            Stage('assign_bioregions', depends_on=['reconcile_taxonomy']),
+        ]
+        waves = plan_waves(stages)
 
-        self.w('2. Importing taxonomy')
-        management.call_command('import_taxonomy', '--truncate', '{f}'.format(f=options['taxonomy_csv_file']))
+        self.w('Truncating tables (the current data is kept aside until all stages succeeded)')
+        self.truncate(backup)
 
-        self.w('3. Reconcile taxonomy')
-        management.call_command('reconcile_taxonomy', '--all')
+        try:
+            for i, wave in enumerate(waves, 1):
+                self.w('{i}. Running {names}'.format(i=i, names=', '.join(stage.name for stage in wave)))
+                self.run_wave(wave)
+        except BaseException as e:
+            self.w(self.style.ERROR('Import failed, putting the previous data back...'))
+            self.restore(backup)
+            if isinstance(e, StageFailed):
+                raise CommandError(e)
+            raise
 
+        with connection.cursor() as cursor:
+            backup.drop(cursor)
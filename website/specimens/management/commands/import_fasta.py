@@ -0,0 +1,73 @@
+import csv
+import gzip
+
+from django.core.management.base import CommandError
+
+from specimens.fasta import import_sequences, read_fasta, Problem, SequenceIndex, CHUNK_SIZE
+
+from ._utils import AstaporCommand
+
+
+class Command(AstaporCommand):
+    help = ('Import the sequences of a (multi-)FASTA file. Records are matched to specimens by the identifier of '
+            'their header (sequence name, BOLD process ID or BOLD sample ID), and replace their current sequence.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('fasta_file', help='FASTA file, possibly gzipped (.gz)')
+
+        parser.add_argument(
+            '--name-sequences',
+            action='store_true',
+            dest='name_sequences',
+            default=False,
+            help="Specimens matched by a BOLD ID, without sequence name, get the header's identifier as sequence name",
+        )
+
+        parser.add_argument(
+            '--chunk-size',
+            dest='chunk_size',
+            type=int,
+            default=CHUNK_SIZE,
+            help='Number of sequences written at once (default: {size})'.format(size=CHUNK_SIZE),
+        )
+
+        parser.add_argument(
+            '--report',
+            dest='report',
+            metavar='FILE',
+            help='Also write the skipped records to a CSV file',
+        )
+
+    def records(self, f):
+        for record in read_fasta(f):
+            self.stats.count_row()
+            yield record
+
+    def handle(self, *args, **options):
+        path = options['fasta_file']
+
+        self.w('Indexing specimens...')
+        with self.stats.stage('index'):
+            index = SequenceIndex.load()
+
+        self.w('Importing sequences...')
+        opener = gzip.open if path.lower().endswith('.gz') else open
+        with opener(path, 'rt') as f, self.stats.stage('import'):
+            try:
+                stored_count, problems = import_sequences(self.records(f), index=index,
+                                                          name_sequences=options['name_sequences'],
+                                                          chunk_size=options['chunk_size'])
+            except ValueError as e:
+                raise CommandError(str(e))
+
+        for problem in problems:
+            self.w(self.style.WARNING('{p.header}: {p.message}'.format(p=problem)))
+
+        if options['report']:
+            with open(options['report'], 'w', newline='') as report:
+                writer = csv.writer(report)
+                writer.writerow(Problem._fields)
+                writer.writerows(problems)
+
+        self.w(self.style.SUCCESS('{count} sequence(s) imported, {skipped} record(s) with a problem.'.format(
+            count=stored_count, skipped=len(problems))))
@@ -1,7 +1,6 @@
-import csv
-
 import calendar
 import datetime
+import itertools
 import dateparser
 from psycopg2.extras import NumericRange
 
@@ -11,13 +10,17 @@ from django.contrib.gis.geos import Point
 
 from django.conf import settings
 
+from specimens import coordinates
+from specimens.clustering import deferred_refresh
 from specimens.models import (Person, SpecimenLocation, Specimen, Fixation, Expedition, Station, Bioregion,
                               Gear, UNKNOWN_STATION_NAME)
 
-from ._utils import AstaporCommand, validate_number_cols
+from ._utils import AstaporCommand, validate_number_cols, source_rows
 
 MODELS_TO_TRUNCATE = [Gear, Station, Expedition, Fixation, Person, SpecimenLocation, Specimen]
 
+COORDINATES_CHUNK_SIZE = 5000
+
 
 def last_day_of_month(month, year):
     return calendar.monthrange(year, month)[1]
@@ -28,10 +31,10 @@ class IncomprehensibleDateException(Exception):
 
 
 class Command(AstaporCommand):
-    help = 'Import specimens from a CSV file'
+    help = 'Import specimens from a CSV or XLSX file'
 
     def add_arguments(self, parser):
-        parser.add_argument('csv_file')
+        parser.add_argument('csv_file', help='CSV or XLSX (first sheet) file')
 
         parser.add_argument(
             '--truncate',
@@ -45,10 +48,12 @@ class Command(AstaporCommand):
         """ Returns y, m, d (ints). d is None if we only know the month"""
 
         if d.count('-') == 2:
-            self.w("\tDate assumed to be in (D)D-(M)M-YY format")
+            self.w("\tDate assumed to be in (D)D-(M)M-YY(YY) format")
             d, m, y = d.split("-")
 
-            if int(y) > 17:
+            if len(y.strip()) == 4:  # E.g. dates of XLSX files
+                year = int(y)
+            elif int(y) > 17:
                 year = int(y) + 1900
             else:
                 year = int(y) + 2000
@@ -137,7 +142,8 @@ class Command(AstaporCommand):
         if station_name == '':
             station_name = UNKNOWN_STATION_NAME
 
-        capture_date_start, capture_date_end = self.interpret_dates_and_year(initial_year, initial_date)
+        with self.stats.stage('dates'):
+            capture_date_start, capture_date_end = self.interpret_dates_and_year(initial_year, initial_date)
 
         try:  # A station that match the characteristics already exists
             return Station.objects.get(name=station_name,
@@ -181,19 +187,35 @@ class Command(AstaporCommand):
             return station
 
     @staticmethod
-    def raw_lat_lon_to_point(raw_lat, raw_lon):
-        # Decimal separator: ','
+    def coordinates_to_point(lat, lon, status):
+        # From normalized coordinates (see specimens/coordinates.py)
         # Raise CommandError if inconsistency
-
-        raw_lat = raw_lat.strip()
-        raw_lon = raw_lon.strip()
-
-        if raw_lat and raw_lon:
-            lat = float(raw_lat.replace(',', '.'))
-            lon = float(raw_lon.replace(',', '.'))
-            return Point(lon, lat)
-        elif raw_lat or raw_lon:
-            raise CommandError('Either latitude or longitude is missing!')
+        if status == coordinates.EMPTY:
+            return None
+        if status != coordinates.VALID:
+            raise CommandError(coordinates.STATUS_MESSAGES[status])
+        return Point(lon, lat)
+
+    @classmethod
+    def raw_lat_lon_to_point(cls, raw_lat, raw_lon):
+        # Decimal degrees (separator: ',' or '.'), DMS or DM, with a sign or N/S/E/W
+        # Raise CommandError if inconsistency
+        (lat, lon, status), = coordinates.normalize_coordinates([raw_lat], [raw_lon]).pairs()
+        return cls.coordinates_to_point(lat, lon, status)
+
+    def rows_with_coordinates(self, rows):
+        """Yield (row, (lat, lon, status)): coordinates are normalized by chunks of rows, much faster than one by one."""
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, COORDINATES_CHUNK_SIZE))
+            if not chunk:
+                return
+
+            with self.stats.stage('coordinates'):
+                # Missing columns are caught later, by validate_number_cols()
+                normalized = coordinates.normalize_coordinates([row.get('Latitude') for row in chunk],
+                                                               [row.get('Longitude') for row in chunk])
+            yield from zip(chunk, normalized.pairs())
 
     @staticmethod
     def raw_depth_to_numericrange(raw_depth):
@@ -208,16 +230,18 @@ class Command(AstaporCommand):
 
     def handle(self, *args, **options):
         self.w('Importing data from file...')
-        with open(options['csv_file']) as csv_file:
+        # Station clusters are rebuilt once at the end rather than updated after each row
+        with source_rows(options['csv_file']) as rows, deferred_refresh():
             if options['truncate']:
                 for model in MODELS_TO_TRUNCATE:
                     self.w('Truncate model {name}...'.format(name=model.__name__), ending='')
-                    model.objects.all().delete()
+                    with self.stats.stage('truncate'):
+                        model.objects.all().delete()
                     self.w(self.style.SUCCESS('Done.'))
 
             self.w('Gears will be added later, ignored for now...')
 
-            for i, row in enumerate(csv.DictReader(csv_file, delimiter=',')):
+            for i, (row, (lat, lon, coordinates_status)) in enumerate(self.rows_with_coordinates(rows)):
                 validate_number_cols(row, settings.EXPECTED_NUMBER_COLS_SPECIMEN)
 
                 specimen = Specimen()
@@ -225,49 +249,51 @@ class Command(AstaporCommand):
 
                 self.w('Processing row #{i} with ID {id}'.format(i=i, id=specimen.specimen_id), ending='')
 
-                point = self.raw_lat_lon_to_point(row['Latitude'], row['Longitude'])
+                point = self.coordinates_to_point(lat, lon, coordinates_status)
 
                 # Load raw/messy/imprecise dates:
                 initial_year = row['Year'].strip()
                 initial_date = row['Date'].strip()
 
-                specimen.station = self.get_or_create_station_and_expedition(row['Station'].strip(),
-                                                                             row['Expedition'].strip(),
-                                                                             coordinates = point,
-                                                                             depth=self.raw_depth_to_numericrange(row['Depth']),
-                                                                             initial_year=initial_year,
-                                                                             initial_date=initial_date)
-
-                # Identifiers
-                identified_by = row['Identified_by'].strip()
-                id_first_name, id_last_name = identified_by.split()
-                identifier, created = Person.objects.get_or_create(first_name=id_first_name, last_name=id_last_name)
-                if created:
-                    self.w(self.style.SUCCESS('\n\tCreated new Person: {0}'.format(identifier)), ending='')
-
-                specimen.identified_by = identifier
-
-                # Specimen locations
-                specimen_location, created = SpecimenLocation.objects.get_or_create(name=row['Specimen_location'])
-                if created:
-                    self.w(self.style.SUCCESS('\n\tCreated new Specimen Location: {0}'.format(specimen_location)), ending='')
-
-                specimen.specimen_location = specimen_location
-
-                # Fixation
-                fixation = row['Fixation'].strip()
-                if fixation:
-                    specimen.fixation, created = Fixation.objects.get_or_create(name=fixation)
+                with self.stats.stage('station'):
+                    specimen.station = self.get_or_create_station_and_expedition(row['Station'].strip(),
+                                                                                 row['Expedition'].strip(),
+                                                                                 coordinates = point,
+                                                                                 depth=self.raw_depth_to_numericrange(row['Depth']),
+                                                                                 initial_year=initial_year,
+                                                                                 initial_date=initial_date)
+
+                with self.stats.stage('lookups'):
+                    # Identifiers
+                    identified_by = row['Identified_by'].strip()
+                    id_first_name, id_last_name = identified_by.split()
+                    identifier, created = Person.objects.get_or_create(first_name=id_first_name, last_name=id_last_name)
                     if created:
-                        self.w(
-                            self.style.SUCCESS('\n\tCreated new Fixation: {0}'.format(specimen.fixation)), ending='')
+                        self.w(self.style.SUCCESS('\n\tCreated new Person: {0}'.format(identifier)), ending='')
 
-                bioregion = row['Region'].strip()
-                if bioregion:
-                    specimen.bioregion, created = Bioregion.objects.get_or_create(name=bioregion)
+                    specimen.identified_by = identifier
+
+                    # Specimen locations
+                    specimen_location, created = SpecimenLocation.objects.get_or_create(name=row['Specimen_location'])
                     if created:
-                        self.w(
-                            self.style.SUCCESS('\n\tCreated new Bioregion: {0}'.format(specimen.bioregion)), ending='')
+                        self.w(self.style.SUCCESS('\n\tCreated new Specimen Location: {0}'.format(specimen_location)), ending='')
+
+                    specimen.specimen_location = specimen_location
+
+                    # Fixation
+                    fixation = row['Fixation'].strip()
+                    if fixation:
+                        specimen.fixation, created = Fixation.objects.get_or_create(name=fixation)
+                        if created:
+                            self.w(
+                                self.style.SUCCESS('\n\tCreated new Fixation: {0}'.format(specimen.fixation)), ending='')
+
+                    bioregion = row['Region'].strip()
+                    if bioregion:
+                        specimen.bioregion, created = Bioregion.objects.get_or_create(name=bioregion)
+                        if created:
+                            self.w(
+                                self.style.SUCCESS('\n\tCreated new Bioregion: {0}'.format(specimen.bioregion)), ending='')
 
                 specimen.vial = row['Vial_nb'].strip()
                 specimen.mnhn_number = row['Numero_mnhn'].strip()
@@ -278,7 +304,7 @@ class Command(AstaporCommand):
 
                 # sequences will be loaded later
                 # specimen.sequence_name = row['Sequence_name'].strip()
-                self.w('Sequence will be added later, ignored for now...')
+                self.w('Sequence will be added later (see import_fasta), ignored for now...')
 
                 specimen.initial_scientific_name = row['Scientific_name'].strip()
 
@@ -286,7 +312,9 @@ class Command(AstaporCommand):
 
                 specimen.comment = row['Comment'].strip()
 
-                specimen.save()
+                with self.stats.stage('save'):
+                    specimen.save()
+                self.stats.count_row()
                 self.w(self.style.SUCCESS('\n\t => Specimen created.'))
 
                 # creer champ souple "measurements"
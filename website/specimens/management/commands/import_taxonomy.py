@@ -1,32 +1,27 @@
-import csv
-
 from django.conf import settings
 
-from ._utils import AstaporCommand, validate_number_cols
+from ._utils import AstaporCommand, validate_number_cols, source_rows
 
 from specimens.models import TaxonRank, Taxon, TaxonStatus, SPECIES_RANK_NAME, SUBGENUS_RANK_NAME
+from specimens.taxonomy import bulk_taxonomy_changes
 
 MODELS_TO_TRUNCATE = [Taxon, TaxonRank, TaxonStatus]
 
+INITIAL_RANK_NAMES = ['Kingdom', 'Phylum', 'Class', 'Order', 'Family', 'Genus', SUBGENUS_RANK_NAME, SPECIES_RANK_NAME]
+
 
 def create_initial_ranks():
-    TaxonRank.objects.bulk_create([
-        TaxonRank(name='Kingdom'),
-        TaxonRank(name='Phylum'),
-        TaxonRank(name='Class'),
-        TaxonRank(name='Order'),
-        TaxonRank(name='Family'),
-        TaxonRank(name='Genus'),
-        TaxonRank(name=SUBGENUS_RANK_NAME),
-        TaxonRank(name=SPECIES_RANK_NAME)
-    ])
+    """Create the ranks that don't exist yet (so importing without --truncate doesn't duplicate them)."""
+    existing = set(TaxonRank.objects.filter(name__in=INITIAL_RANK_NAMES).values_list('name', flat=True))
+    TaxonRank.objects.bulk_create([TaxonRank(name=name) for name in INITIAL_RANK_NAMES if name not in existing])
+    TaxonRank.objects.clear_cache()  # bulk_create() doesn't send signals
 
 
 class Command(AstaporCommand):
-    help = 'Import taxonomy from a CSV file.'
+    help = 'Import taxonomy from a CSV or XLSX file.'
 
     def add_arguments(self, parser):
-        parser.add_argument('csv_file')
+        parser.add_argument('csv_file', help='CSV or XLSX (first sheet) file')
 
         parser.add_argument(
             '--truncate',
@@ -39,17 +34,19 @@ class Command(AstaporCommand):
     def handle(self, *args, **options):
         self.w('Importing data from file...')
 
-        with open(options['csv_file']) as csv_file:
+        # The taxonomy version (see taxonomy.py) is bumped once at the end, not for each new Taxon
+        with source_rows(options['csv_file']) as rows, bulk_taxonomy_changes():
             if options['truncate']:
                 for model in MODELS_TO_TRUNCATE:
                     self.w('Truncate model {name} ...'.format(name=model.__name__), ending='')
-                    model.objects.all().delete()
+                    with self.stats.stage('truncate'):
+                        model.objects.all().delete()
                     self.w(self.style.SUCCESS('OK'))
 
             self.w('Creating initial ranks...')
             create_initial_ranks()
 
-            for i, row in enumerate(csv.DictReader(csv_file, delimiter=',')):
+            for i, row in enumerate(rows):
                 validate_number_cols(row, settings.EXPECTED_NUMBER_COLS_SCIENTIFICNAMES)
 
                 self.w('Processing row #{i}...'.format(i=i), ending='')
@@ -58,36 +55,37 @@ class Command(AstaporCommand):
 
                 # Starting from the higher ranks
                 kingdom, _ = Taxon.objects.get_or_create(name=row['Kingdom'].strip(),
-                                                         rank=TaxonRank.objects.get(name="Kingdom"))
+                                                         rank_id=TaxonRank.objects.id_for("Kingdom"))
                 phylum, _ = Taxon.objects.get_or_create(name=row['Phylum'].strip(),
-                                                        rank=TaxonRank.objects.get(name="Phylum"),
+                                                        rank_id=TaxonRank.objects.id_for("Phylum"),
                                                         parent=kingdom)
                 class_taxon, _ = Taxon.objects.get_or_create(name=row['Class'].strip(),
-                                                          rank=TaxonRank.objects.get(name="Class"),
+                                                          rank_id=TaxonRank.objects.id_for("Class"),
                                                           parent=phylum)
                 order_taxon, _ = Taxon.objects.get_or_create(name=row['Order'].strip(),
-                                                             rank=TaxonRank.objects.get(name="Order"),
+                                                             rank_id=TaxonRank.objects.id_for("Order"),
                                                              parent=class_taxon)
                 family, _ = Taxon.objects.get_or_create(name=row['Family'].strip(),
-                                                        rank=TaxonRank.objects.get(name="Family"),
+                                                        rank_id=TaxonRank.objects.id_for("Family"),
                                                         parent=order_taxon)
                 genus, _ = Taxon.objects.get_or_create(name=row['Genus'].strip(),
-                                                        rank=TaxonRank.objects.get(name="Genus"),
+                                                        rank_id=TaxonRank.objects.id_for("Genus"),
                                                         parent=family)
                 # Subgenus rank is optional
                 subgenus_source = row['Subgenus'].strip()
                 if subgenus_source:
                     subgenus, _ = Taxon.objects.get_or_create(name=subgenus_source,
-                                                              rank=TaxonRank.objects.get(name=SUBGENUS_RANK_NAME),
+                                                              rank_id=TaxonRank.objects.id_for(SUBGENUS_RANK_NAME),
                                                               parent=genus)
 
                 species_parent = subgenus if subgenus_source else genus
                 species, _ = Taxon.objects.get_or_create(name=row['Species'].strip(),
-                                                         rank=TaxonRank.objects.get(name=SPECIES_RANK_NAME),
+                                                         rank_id=TaxonRank.objects.id_for(SPECIES_RANK_NAME),
                                                          parent=species_parent,
                                                          status=species_status,
                                                          aphia_id=row['Aphia_ID'].strip(),
                                                          authority=row['Authority'].strip())
 
+                self.stats.count_row()
                 self.w(self.style.SUCCESS('OK'))
 
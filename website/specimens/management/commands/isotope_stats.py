@@ -0,0 +1,51 @@
+from django.core.management.base import CommandError
+
+from specimens.analytics import isotope_stats, GROUP_BY_FIELDS
+
+from ._utils import AstaporCommand
+
+
+class Command(AstaporCommand):
+    help = 'Compute statistics (n, mean, sd, quantiles, ...) on the isotope values, per taxon, expedition or bioregion.'
+    replica_reads = True
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--group-by',
+            dest='group_by',
+            choices=sorted(GROUP_BY_FIELDS),
+            help='Compute statistics per group (default: whole collection)',
+        )
+
+        parser.add_argument(
+            '--format',
+            dest='format',
+            choices=['csv', 'npz'],
+            default='csv',
+            help='Output format: CSV or compressed NumPy archive (default: csv)',
+        )
+
+        parser.add_argument(
+            '--output',
+            dest='output',
+            metavar='FILE',
+            help='Output file (default: standard output, only for CSV)',
+        )
+
+    def handle(self, *args, **options):
+        if options['format'] == 'npz' and not options['output']:
+            raise CommandError("--output is required with --format=npz")
+
+        with self.stats.stage('compute'):
+            result = isotope_stats(group_by=options['group_by'])
+        self.stats.count_row(result.specimens_count)
+
+        with self.stats.stage('write'):
+            if options['format'] == 'npz':
+                with open(options['output'], 'wb') as f:
+                    result.write_npz(f)
+            elif options['output']:
+                with open(options['output'], 'w') as f:
+                    result.write_csv(f)
+            else:
+                result.write_csv(self.stdout)
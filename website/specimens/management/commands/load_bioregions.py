@@ -0,0 +1,56 @@
+from django.core.management.base import CommandError
+
+from specimens.bioregions import read_boundaries, load_bioregions, assign_bioregions
+
+from ._utils import AstaporCommand
+
+
+class Command(AstaporCommand):
+    help = ('Load the bioregion boundaries from a shapefile or GeoJSON file (bioregions are matched by name, missing '
+            'ones are created).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('boundaries_file', help='Shapefile (.shp) or GeoJSON file, with polygons')
+
+        parser.add_argument(
+            '--name-field',
+            dest='name_field',
+            default='name',
+            help='Attribute containing the bioregion name (default: name)',
+        )
+
+        parser.add_argument(
+            '--layer',
+            dest='layer',
+            type=int,
+            default=0,
+            help='Index of the layer to read (default: 0)',
+        )
+
+        parser.add_argument(
+            '--assign',
+            action='store_true',
+            dest='assign',
+            default=False,
+            help='Then reassign the bioregion of all the specimens (see assign_bioregions)',
+        )
+
+    def handle(self, *args, **options):
+        self.w('Reading {path}...'.format(path=options['boundaries_file']), ending='')
+        with self.stats.stage('read'):
+            try:
+                boundaries = read_boundaries(options['boundaries_file'], options['name_field'], options['layer'])
+            except ValueError as e:
+                raise CommandError(e)
+        self.w(self.style.SUCCESS('{count} bioregions.'.format(count=len(boundaries))))
+
+        with self.stats.stage('load'):
+            created_count = load_bioregions(boundaries)
+        self.stats.count_row(len(boundaries))
+        self.w(self.style.SUCCESS('Boundaries loaded ({count} new bioregions).'.format(count=created_count)))
+
+        if options['assign']:
+            self.w('Assigning bioregions to specimens...', ending='')
+            with self.stats.stage('assign'):
+                updated_count = assign_bioregions()
+            self.w(self.style.SUCCESS('{count} specimens updated.'.format(count=updated_count)))
@@ -0,0 +1,12 @@
+from specimens.clustering import rebuild_station_clusters
+
+from ._utils import AstaporCommand
+
+
+class Command(AstaporCommand):
+    help = 'Recompute all the station clusters (used by the stations map) from scratch.'
+
+    def handle(self, *args, **options):
+        self.w('Rebuilding station clusters...', ending='')
+        rebuild_station_clusters()
+        self.w(self.style.SUCCESS('OK'))
@@ -1,26 +1,23 @@
+import csv
 import re
+from collections import OrderedDict
 
 from ._utils import AstaporCommand
 
-from specimens.models import Specimen, Taxon
+from specimens.models import Specimen
+from specimens.reconciliation import match_name
+from specimens.taxonomy import get_taxonomy_snapshot
 
-SPXXX_REGEXP = " sp\d+$"
+# What we drop from a name before fuzzy matching (keeping track of "cf" to flag the identification as uncertain)
+CF_REGEXP = r"\bcf\.? "
+SP_SUFFIX_REGEXP = r" sp(\.|\d+)?$"
 
-all_genus = Taxon.genus_objects.all()
-all_species = Taxon.species_objects.all()
-all_families = Taxon.family_objects.all()
-
-
-def get_genus_with_name(name_to_match):
-    return next((genus for genus in all_genus if genus.name == name_to_match), None)
-
-
-def get_species_with_name(name_to_match):
-    return next((species for species in all_species if species.species_name() == name_to_match), None)
-
-
-def get_family_with_name(name_to_match):
-    return next((family for family in all_families if family.name == name_to_match), None)
+def clean_name_for_fuzzy_matching(name):
+    """Return the name without cf/sp markers, and a boolean indicating if the identification is uncertain (cf)."""
+    uncertain = bool(re.search(CF_REGEXP, name))
+    name = re.sub(CF_REGEXP, '', name)
+    name = re.sub(SP_SUFFIX_REGEXP, '', name)
+    return name.strip(), uncertain
 
 
 class Command(AstaporCommand):
@@ -35,9 +32,43 @@ class Command(AstaporCommand):
             help='Also reconcile Specimens that are already linked to a Taxon',
         )
 
+        parser.add_argument(
+            '--fuzzy',
+            action='store_true',
+            dest='fuzzy',
+            default=False,
+            help='Look for approximate matches (typos, ...) for the names that cannot be matched exactly',
+        )
+
+        parser.add_argument(
+            '--apply-fuzzy',
+            action='store_true',
+            dest='apply_fuzzy',
+            default=False,
+            help='Attach the confident approximate matches to the specimens (implies --fuzzy)',
+        )
+
+        parser.add_argument(
+            '--fuzzy-max-distance',
+            type=int,
+            dest='fuzzy_max_distance',
+            default=2,
+            help='Maximum edit distance for an approximate match to be considered confident (default: 2)',
+        )
+
+        parser.add_argument(
+            '--fuzzy-report',
+            dest='fuzzy_report',
+            metavar='FILE',
+            help='Write all approximate matches (confident or to review) to this CSV file',
+        )
+
     def handle(self, *args, **options):
         self.w('Attempting to attach taxa to specimens...')
 
+        with self.stats.stage('taxonomy_snapshot'):
+            self.taxonomy = get_taxonomy_snapshot()
+
         if options['reconcile_all']:
             self.w("--all: we will also reconcile Specimens that are already linked to a Taxon.")
 
@@ -45,100 +76,41 @@ class Command(AstaporCommand):
         matched_specimens_count = 0
         undet_specimens_count = 0
 
+        unmatched_specimens = OrderedDict()  # name -> [specimens], for fuzzy matching
+
         for specimen in Specimen.objects.all():
             name_to_match = specimen.initial_scientific_name
-            initial_sn_length = len(specimen.initial_scientific_name.split())
-            name_contains_parentheses = '(' in name_to_match or ')' in name_to_match
             taxon_found = False
 
-            if (not specimen.taxon) or options['reconcile_all']:
+            if (not specimen.taxon_id) or options['reconcile_all']:
                 total_specimens_count += 1
                 self.w('Specimen {s} (initial scientific name: {sn})...'.format(s=specimen, sn=name_to_match),
                        ending='')
 
-                if name_to_match.lower() == "undet":
-                    #  It's normal to not match, we just count it separately for stats
+                match = match_name(self.taxonomy, name_to_match)
+                if match.undet:
                     undet_specimens_count += 1
-                    self.w(self.style.WARNING('Case 1: INITIAL SCIENTIFIC NAME IS UNDET, SKIPPING'))
-                # Best case: exact match on species name
-                elif get_species_with_name(name_to_match):
-                    taxon_found = True
-                    self.w(self.style.SUCCESS('Case 2: FOUND EXACT SPECIES MATCH ON INITIAL SCIENTIFIC NAME'))
-                    specimen.taxon = get_species_with_name(name_to_match)
-                elif 'cf ' in name_to_match and get_species_with_name(name_to_match.replace('cf ', '')):
+                    self.w(self.style.WARNING(match.message))
+                elif match.taxon:
                     taxon_found = True
-                    self.w(self.style.SUCCESS('Case 2b: FOUND EXACT SPECIES MATCH ON INITIAL SCIENTIFIC NAME - cf'))
-                    specimen.taxon = get_species_with_name(name_to_match.replace('cf ', ''))
-                    specimen.uncertain_identification = True
-                elif 'cf. ' in name_to_match and get_species_with_name(name_to_match.replace('cf. ', '')):
-                    taxon_found = True
-                    self.w(self.style.SUCCESS('Case 2c: FOUND EXACT SPECIES MATCH ON INITIAL SCIENTIFIC NAME - cf.'))
-                    specimen.taxon = get_species_with_name(name_to_match.replace('cf. ', ''))
-                    specimen.uncertain_identification = True
-                elif name_to_match.endswith('sp') or name_to_match.endswith('sp.'):
-                    # No species match, we look for a Genus
-                    self.w("Case 3: Dropping 'sp'/'sp.' and looking for a genus or subgenus...", ending='')
-                    if name_to_match.endswith('sp'):
-                        name_to_match = name_to_match[:-3]
-                    elif name_to_match.endswith('sp.'):
-                        name_to_match = name_to_match[:-4]
-
-                    genus_found = get_genus_with_name(name_to_match)
-                    if genus_found:
-                        taxon_found = True
-                        self.w(self.style.SUCCESS('EXACT MATCH ON GENUS NAME after dropping sp/sp.'))
-                        specimen.taxon = genus_found
-                    elif name_contains_parentheses:
-                        # If we have the form 'Cheiraster (Luidiaster) sp', we can try to match it to the subgenus
-                        sg_found = Taxon.objects.get_subgenus_from_parentheses_form(name_to_match)
-                        if sg_found:
-                            taxon_found = True
-                            self.w(self.style.SUCCESS('EXACT MATCH ON SUBGENUS NAME after dropping sp/sp.'))
-                            specimen.taxon = sg_found
-                        else:
-                            self.w(self.style.ERROR('NO MATCHING SUBGENUS FOUND'))
-                    else:
-                        self.w(self.style.ERROR('NO MATCH FOUND IN CASE 3.'))
-
-                # two words, string ends with " sp" followed by digits
-                elif initial_sn_length == 2 and (re.search(SPXXX_REGEXP, name_to_match)):
-                    name_to_match = re.sub(SPXXX_REGEXP, '', name_to_match)
-                    self.w("Case 4: 2 words + sp + digits: looking for a '{0}' Genus...".format(name_to_match),
-                                      ending='')
-
-                    genus_found = get_genus_with_name(name_to_match)
-                    if genus_found:
-                        taxon_found = True
-                        self.w(self.style.SUCCESS('EXACT MATCH ON GENUS NAME after dropping spXXX'))
-                        specimen.taxon = genus_found
-                    else:
-                        self.w(self.style.ERROR('NO MATCHING GENUS FOUND'))
-
-                elif initial_sn_length == 1:
-                    self.w("Case 5: Initial scientific name is only one word ({0})...".format(name_to_match),
-                                      ending='')
-
-                    # Maybe it's a genus?
-                    genus_found = get_genus_with_name(name_to_match)
-                    family_found = get_family_with_name(name_to_match)
-
-                    if genus_found:
-                        taxon_found = True
-                        self.w(self.style.SUCCESS('EXACT MATCH ON GENUS NAME'))
-                        specimen.taxon = genus_found
-                    elif family_found:
-                        taxon_found = True
-                        self.w(self.style.SUCCESS('EXACT MATCH ON FAMILY NAME'))
-                        specimen.taxon = family_found
-                    else:
-                        self.w(self.style.ERROR('NO MATCHING GENUS/FAMILY FOUND'))
-
+                    self.w(self.style.SUCCESS(match.message))
+                    specimen.taxon = match.taxon
+                    if match.uncertain:
+                        specimen.uncertain_identification = True
                 else:
-                    self.w(self.style.ERROR('Not matching any case...'))
+                    self.w(self.style.ERROR(match.message))
 
                 if taxon_found:
                     matched_specimens_count += 1
-                    specimen.save()
+                    with self.stats.stage('save'):
+                        specimen.save()
+                elif not match.undet:
+                    unmatched_specimens.setdefault(specimen.initial_scientific_name, []).append(specimen)
+
+                self.stats.count_row()
+
+        if options['fuzzy'] or options['apply_fuzzy']:
+            matched_specimens_count += self.fuzzy_reconcile(unmatched_specimens, options)
 
         self.w("End: matched {cm}/{ct} taxon ({pc} percent).".format(cm=matched_specimens_count,
                                                                      ct=total_specimens_count,
@@ -147,6 +119,58 @@ class Command(AstaporCommand):
                                                                                    ct=total_specimens_count,
                                                                                    pc=str(float(matched_specimens_count + undet_specimens_count) / total_specimens_count * 100)))
 
+    def fuzzy_reconcile(self, unmatched_specimens, options):
+        """Look for approximate matches for the unmatched names. Return the number of specimens matched."""
+        self.w('Fuzzy matching of {n} distinct unmatched names...'.format(n=len(unmatched_specimens)))
+
+        with self.stats.stage('fuzzy_index'):
+            index = self.taxonomy.fuzzy_index()
+
+        matched_specimens_count = 0
+        report_rows = []
+
+        for name, specimens in unmatched_specimens.items():
+            cleaned_name, uncertain = clean_name_for_fuzzy_matching(name)
+
+            with self.stats.stage('fuzzy_matching'):
+                matches = index.best_matches(cleaned_name)
+                confident = index.confident_match(cleaned_name, max_distance=options['fuzzy_max_distance'],
+                                                  matches=matches)
+
+            if not matches:
+                self.w(self.style.ERROR('{name}: no candidate found.'.format(name=name)))
+                continue
+
+            if confident:
+                self.w(self.style.SUCCESS('{name}: confident match with {match} (distance: {d}).'.format(
+                    name=name, match=confident.name, d=confident.distance)))
+                if options['apply_fuzzy']:
+                    for specimen in specimens:
+                        specimen.taxon = confident.obj
+                        if uncertain:  # Never reset: the flag may have been set by a curator
+                            specimen.uncertain_identification = True
+                        with self.stats.stage('save'):
+                            specimen.save()
+                    matched_specimens_count += len(specimens)
+            else:
+                self.w(self.style.WARNING('{name}: to review, best candidate is {match} (distance: {d}).'.format(
+                    name=name, match=matches[0].name, d=matches[0].distance)))
+
+            for match in matches:
+                if match is confident:
+                    status = 'applied' if options['apply_fuzzy'] else 'confident'
+                else:
+                    status = 'review'
 
+                report_rows.append([name, len(specimens), ' '.join(str(s.specimen_id) for s in specimens),
+                                    match.name, match.obj.pk, match.distance, round(match.similarity, 3), status])
 
+        if options['fuzzy_report']:
+            with open(options['fuzzy_report'], 'w') as report_file:
+                writer = csv.writer(report_file)
+                writer.writerow(['initial_scientific_name', 'specimens_count', 'specimen_ids', 'candidate',
+                                 'candidate_taxon_id', 'distance', 'similarity', 'status'])
+                writer.writerows(report_rows)
+            self.w('Fuzzy matching report written to {f}'.format(f=options['fuzzy_report']))
 
+        return matched_specimens_count
@@ -0,0 +1,92 @@
+import datetime
+import multiprocessing
+import time
+
+from django.db import connections
+
+from specimens.exports import claim_next_job, requeue_job, requeue_stale_jobs, run_job, STALE_JOB_TIMEOUT
+
+from ._utils import AstaporCommand
+
+
+def _work(poll_interval, once, stale_timeout):
+    """Run the queued export jobs, one at a time (in a child process)."""
+    job = None
+    try:
+        while True:
+            requeue_stale_jobs(stale_timeout)  # Left running by killed workers
+            job = claim_next_job()
+            if job is None:
+                if once:
+                    return
+                time.sleep(poll_interval)
+            else:
+                run_job(job)
+                job = None
+    except KeyboardInterrupt:
+        if job is not None:
+            requeue_job(job)  # Another worker will start it again
+    finally:
+        connections.close_all()
+
+
+class Command(AstaporCommand):
+    help = 'Run the export jobs queued from the admin, with a pool of worker processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--processes',
+            dest='processes',
+            type=int,
+            default=2,
+            help='Number of worker processes (default: 2)',
+        )
+
+        parser.add_argument(
+            '--poll-interval',
+            dest='poll_interval',
+            type=float,
+            default=5.0,
+            help='Seconds to wait before checking the queue again when it is empty (default: 5)',
+        )
+
+        parser.add_argument(
+            '--stale-after',
+            dest='stale_after',
+            type=float,
+            default=STALE_JOB_TIMEOUT.total_seconds(),
+            help='Seconds after which a running job without progress is considered abandoned by a killed worker, and '
+                 'queued again (default: {default:.0f})'.format(default=STALE_JOB_TIMEOUT.total_seconds()),
+        )
+
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            dest='once',
+            default=False,
+            help='Exit as soon as the queue is empty (useful from cron)',
+        )
+
+    def handle(self, *args, **options):
+        # Workers must not share the parent connection: they'll open their own.
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+
+        stale_timeout = datetime.timedelta(seconds=options['stale_after'])
+        workers = [context.Process(target=_work, args=(options['poll_interval'], options['once'], stale_timeout),
+                                   name='export-worker-{i}'.format(i=i))
+                   for i in range(options['processes'])]
+
+        self.w('Starting {n} export worker(s)...'.format(n=len(workers)))
+        for worker in workers:
+            worker.start()
+
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            # Workers got the interruption too: let them requeue their current job
+            for worker in workers:
+                worker.join()
+
+        self.w(self.style.SUCCESS('Export workers stopped.'))
@@ -0,0 +1,206 @@
+import csv
+from collections import defaultdict, namedtuple
+from io import StringIO
+
+from django.conf import settings
+from django.core.management.base import CommandError
+from django.db.models import Q
+
+from specimens.models import Specimen
+
+from ._utils import AstaporCommand, validate_number_cols, source_rows
+from . import import_specimens
+
+# Not (yet) imported by import_specimens, but checked if the file has them
+SEQUENCE_NAME_COLUMN = 'Sequence_name'
+PERCENT_C_COLUMN = '%C'
+PERCENT_N_COLUMN = '%N'
+
+Problem = namedtuple('Problem', 'line column value message')
+
+
+class Command(AstaporCommand):
+    help = ('Check a specimens file (CSV or XLSX) before importing it, and report all the problems at once: column '
+            'count, dates, coordinates, depths and the uniqueness rules of specimens (within the file and against '
+            'the database).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('csv_file', help='CSV or XLSX (first sheet) file')
+
+        parser.add_argument(
+            '--truncate',
+            action='store_true',
+            dest='truncate',
+            default=False,
+            help="The file will be imported with --truncate: don't check it against the specimens in the database",
+        )
+
+        parser.add_argument(
+            '--report',
+            dest='report',
+            metavar='FILE',
+            help='Also write the problems to a CSV file',
+        )
+
+    def add_problem(self, line, column, value, message):
+        self.problems.append(Problem(line, column, value, message))
+
+    def check_rows(self, rows):
+        """First pass: check each row independently, and index the values that must be unique."""
+        # The parsing code of the import, silenced
+        importer = import_specimens.Command(stdout=StringIO())
+
+        indexes = {name: defaultdict(list) for name in ('specimen_id', 'vial', 'mnhn_number', 'sequence_name')}
+
+        for i, row in enumerate(rows):
+            line = i + 2  # Line 1 is the header
+            self.stats.count_row()
+
+            try:
+                validate_number_cols(row, settings.EXPECTED_NUMBER_COLS_SPECIMEN)
+            except CommandError as e:
+                self.add_problem(line, None, '', str(e))
+                continue  # Values are probably shifted, other problems would be noise
+
+            specimen_id = row['Specimen_id'].strip()
+            try:
+                indexes['specimen_id'][int(specimen_id)].append(line)
+            except ValueError:
+                self.add_problem(line, 'Specimen_id', specimen_id, 'Not an integer')
+
+            try:
+                point = importer.raw_lat_lon_to_point(row['Latitude'], row['Longitude'])
+            except (CommandError, ValueError) as e:
+                self.add_problem(line, 'Latitude/Longitude', '{lat} {lon}'.format(lat=row['Latitude'],
+                                                                                  lon=row['Longitude']), str(e))
+            else:
+                if point and not (-90 <= point.y <= 90 and -180 <= point.x <= 180):
+                    self.add_problem(line, 'Latitude/Longitude', '{lat} {lon}'.format(lat=point.y, lon=point.x),
+                                     'Coordinates out of range')
+
+            try:
+                depth = importer.raw_depth_to_numericrange(row['Depth'])
+            except ValueError as e:
+                self.add_problem(line, 'Depth', row['Depth'], str(e))
+            else:
+                if depth and depth.lower > depth.upper:
+                    self.add_problem(line, 'Depth', row['Depth'], 'Minimum depth is greater than maximum depth')
+
+            try:
+                importer.interpret_dates_and_year(row['Year'].strip(), row['Date'].strip())
+            except (CommandError, import_specimens.IncomprehensibleDateException, ValueError) as e:
+                self.add_problem(line, 'Year/Date', '{y} {d}'.format(y=row['Year'], d=row['Date']),
+                                 str(e) or 'Date cannot be understood')
+
+            if len(row['Identified_by'].split()) != 2:
+                self.add_problem(line, 'Identified_by', row['Identified_by'], 'Should be "First_name Last_name"')
+
+            self.check_isotopes(line, row)
+
+            vial = row['Vial_nb'].strip()
+            if vial:
+                indexes['vial'][(row['Expedition'].strip(), vial)].append(line)
+            mnhn_number = row['Numero_mnhn'].strip()
+            if mnhn_number:
+                indexes['mnhn_number'][mnhn_number].append(line)
+            sequence_name = (row.get(SEQUENCE_NAME_COLUMN) or '').strip()
+            if sequence_name:
+                indexes['sequence_name'][sequence_name].append(line)
+
+        return indexes
+
+    def check_isotopes(self, line, row):
+        raw_c = (row.get(PERCENT_C_COLUMN) or '').strip()
+        raw_n = (row.get(PERCENT_N_COLUMN) or '').strip()
+        if raw_c and raw_n:
+            try:
+                percent_c = float(raw_c.replace(',', '.'))
+                percent_n = float(raw_n.replace(',', '.'))
+            except ValueError as e:
+                self.add_problem(line, '%C/%N', '{c} {n}'.format(c=raw_c, n=raw_n), str(e))
+            else:
+                if percent_c < percent_n:
+                    self.add_problem(line, '%C/%N', '{c} {n}'.format(c=raw_c, n=raw_n), '%C is lower than %N')
+
+    def unique_rules(self):
+        """(index name, column, description) of the values that must be unique."""
+        rules = [('specimen_id', 'Specimen_id', 'Specimen_id')]
+        if not settings.DISABLE_VIAL_UNIQUENESS_VALIDATION:
+            rules.append(('vial', 'Vial_nb', 'Vial (for this expedition)'))
+        if not settings.DISABLE_MNHN_UNIQUENESS_VALIDATION:
+            rules.append(('mnhn_number', 'Numero_mnhn', 'MNHN number'))
+        rules.append(('sequence_name', SEQUENCE_NAME_COLUMN, 'Sequence name'))
+        return rules
+
+    def check_duplicates_in_file(self, indexes):
+        """Second pass: values used on several lines of the file."""
+        for index_name, column, description in self.unique_rules():
+            for value, lines in indexes[index_name].items():
+                for line in lines[1:]:
+                    self.add_problem(line, column, value, '{d} already used on line {first}'.format(d=description,
+                                                                                                   first=lines[0]))
+
+    def check_against_database(self, indexes):
+        """Third pass: values already used by specimens in the database (a single query for all of them)."""
+        condition = Q()
+        if indexes['specimen_id']:
+            condition |= Q(specimen_id__in=list(indexes['specimen_id']))
+        if indexes['vial']:
+            condition |= Q(vial__in=list({vial for _expedition, vial in indexes['vial']}))
+        if indexes['mnhn_number']:
+            condition |= Q(mnhn_number__in=list(indexes['mnhn_number']))
+        if indexes['sequence_name']:
+            condition |= Q(sequence_name__in=list(indexes['sequence_name']))
+        if not condition:
+            return
+
+        existing = defaultdict(set)
+        for specimen_id, vial, expedition_name, mnhn_number, sequence_name in Specimen.objects.filter(
+                condition).values_list('specimen_id', 'vial', 'station__expedition__name', 'mnhn_number',
+                                       'sequence_name').iterator():
+            existing['specimen_id'].add(specimen_id)
+            existing['vial'].add((expedition_name, vial))
+            existing['mnhn_number'].add(mnhn_number)
+            existing['sequence_name'].add(sequence_name)
+
+        for index_name, column, description in self.unique_rules():
+            for value, lines in indexes[index_name].items():
+                if value in existing[index_name]:
+                    for line in lines:
+                        self.add_problem(line, column, value, '{d} already used in the database'.format(d=description))
+
+    def write_report(self, path):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(Problem._fields)
+            writer.writerows(self.problems)
+
+    def handle(self, *args, **options):
+        self.problems = []
+
+        self.w('Checking rows...')
+        with source_rows(options['csv_file']) as rows, self.stats.stage('rows'):
+            indexes = self.check_rows(rows)
+
+        self.w('Checking uniqueness in the file...')
+        with self.stats.stage('file_duplicates'):
+            self.check_duplicates_in_file(indexes)
+
+        if not options['truncate']:
+            self.w('Checking uniqueness against the database...')
+            with self.stats.stage('database'):
+                self.check_against_database(indexes)
+
+        self.problems.sort(key=lambda problem: problem.line)
+        for problem in self.problems:
+            self.w(self.style.ERROR('Line {p.line} [{column}] {p.value!r}: {p.message}'.format(
+                p=problem, column=problem.column or '-')))
+
+        if options['report']:
+            self.write_report(options['report'])
+
+        if self.problems:
+            raise CommandError('{count} problem(s) found on {lines} line(s).'.format(
+                count=len(self.problems), lines=len({problem.line for problem in self.problems})))
+
+        self.w(self.style.SUCCESS('No problem found.'))
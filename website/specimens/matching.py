@@ -0,0 +1,121 @@
+"""Approximate string matching, mostly for scientific names that don't exactly match a taxon (typos, ...).
+
+Comparing a name to all the candidates with an edit distance is too slow for the whole collection, so a trigram index
+is used to shortlist a few candidates that are then scored with the (exact) Levenshtein distance.
+"""
+from collections import defaultdict
+
+
+def normalize(s):
+    return ' '.join(s.lower().split())
+
+
+def trigrams(s):
+    """Set of the trigrams of the words in s (padded like PostgreSQL's pg_trgm does)."""
+    result = set()
+    for word in normalize(s).split():
+        padded = '  ' + word + ' '
+        result.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return result
+
+
+def levenshtein(a, b):
+    """Edit distance between a and b (insertions, deletions and substitutions all cost 1)."""
+    if len(a) < len(b):
+        a, b = b, a
+
+    previous_row = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current_row = [i]
+        for j, char_b in enumerate(b, 1):
+            current_row.append(min(previous_row[j] + 1,  # deletion
+                                   current_row[j - 1] + 1,  # insertion
+                                   previous_row[j - 1] + (char_a != char_b)))  # substitution
+        previous_row = current_row
+
+    return previous_row[-1]
+
+
+class Match(object):
+    def __init__(self, obj, name, distance, similarity):
+        self.obj = obj
+        self.name = name
+        self.distance = distance
+        self.similarity = similarity
+
+    def __repr__(self):
+        return '<Match {name} (distance={distance}, similarity={similarity:.2f})>'.format(
+            name=self.name, distance=self.distance, similarity=self.similarity)
+
+
+class TrigramIndex(object):
+    """Inverted index trigram -> entries, to quickly find names that look like a given one.
+
+    Entries are (obj, name) pairs, obj can be anything (a Taxon, its id, ...).
+    """
+    def __init__(self, entries):
+        self._entries = []
+        self._trigrams_counts = []
+        self._postings = defaultdict(list)
+
+        for obj, name in entries:
+            entry_trigrams = trigrams(name)
+            entry_index = len(self._entries)
+
+            self._entries.append((obj, name))
+            self._trigrams_counts.append(len(entry_trigrams))
+            for trigram in entry_trigrams:
+                self._postings[trigram].append(entry_index)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def candidates(self, name, limit=5, min_dice=0.3):
+        """Return up to limit (obj, name) entries sharing the most trigrams with name (Dice coefficient)."""
+        name_trigrams = trigrams(name)
+        if not name_trigrams:
+            return []
+
+        shared_counts = defaultdict(int)
+        for trigram in name_trigrams:
+            for entry_index in self._postings.get(trigram, ()):
+                shared_counts[entry_index] += 1
+
+        scored = []
+        for entry_index, shared in shared_counts.items():
+            dice = 2.0 * shared / (len(name_trigrams) + self._trigrams_counts[entry_index])
+            if dice >= min_dice:
+                scored.append((dice, entry_index))
+        scored.sort(reverse=True)
+
+        return [self._entries[entry_index] for _, entry_index in scored[:limit]]
+
+    def best_matches(self, name, limit=5):
+        """Shortlisted candidates for name, scored by edit distance (best first)."""
+        normalized_name = normalize(name)
+        matches = []
+        for obj, candidate_name in self.candidates(name, limit=limit):
+            normalized_candidate = normalize(candidate_name)
+            distance = levenshtein(normalized_name, normalized_candidate)
+            longest = max(len(normalized_name), len(normalized_candidate))
+            matches.append(Match(obj, candidate_name, distance, 1.0 - float(distance) / longest))
+
+        matches.sort(key=lambda m: (m.distance, -m.similarity))
+        return matches
+
+    def confident_match(self, name, max_distance=2, min_similarity=0.85, limit=5, matches=None):
+        """Return the best Match if it's close enough and clearly better than the runner-up, None otherwise.
+
+        matches: the result of best_matches() for name, if already computed.
+        """
+        if matches is None:
+            matches = self.best_matches(name, limit=limit)
+        if not matches:
+            return None
+
+        best = matches[0]
+        unambiguous = len(matches) == 1 or matches[1].distance > best.distance
+        if best.distance <= max_distance and best.similarity >= min_similarity and unambiguous:
+            return best
+
+        return None
@@ -0,0 +1,32 @@
+# Generated by Django 2.0.1 on 2018-02-05 10:12
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StationCluster',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.PositiveSmallIntegerField()),
+                ('cell_x', models.IntegerField()),
+                ('cell_y', models.IntegerField()),
+                ('sum_x', models.FloatField()),
+                ('sum_y', models.FloatField()),
+                ('stations_count', models.IntegerField()),
+                ('specimens_count', models.IntegerField()),
+                ('coordinates', django.contrib.gis.db.models.fields.PointField(srid=4326)),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='stationcluster',
+            unique_together={('zoom', 'cell_x', 'cell_y')},
+        ),
+    ]
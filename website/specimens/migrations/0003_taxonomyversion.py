@@ -0,0 +1,26 @@
+# Generated by Django 2.0.1 on 2018-02-07 14:31
+
+from django.db import migrations, models
+
+
+def create_version_row(apps, schema_editor):
+    TaxonomyVersion = apps.get_model('specimens', 'TaxonomyVersion')
+    TaxonomyVersion.objects.get_or_create(pk=1)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0002_stationcluster'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TaxonomyVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('number', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(create_version_row, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.0.1 on 2018-02-12 09:48
+
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F, Q
+
+
+def compute_ratios(apps, schema_editor):
+    Specimen = apps.get_model('specimens', 'Specimen')
+    with_ratio = (Q(isotope_percentC__isnull=False) & Q(isotope_percentN__isnull=False) &
+                  ~Q(isotope_percentC=0) & ~Q(isotope_percentN=0))
+    Specimen.objects.filter(with_ratio).update(
+        isotope_C_N_ratio=ExpressionWrapper(F('isotope_percentC') / F('isotope_percentN'),
+                                            output_field=models.FloatField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0003_taxonomyversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='specimen',
+            name='isotope_C_N_ratio',
+            field=models.FloatField(blank=True, db_index=True, editable=False, null=True, verbose_name=' C/N proportion'),
+        ),
+        migrations.RunPython(compute_ratios, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.0.1 on 2018-02-15 11:02
+
+from django.db import migrations
+
+# Admin autocompletes search by prefix (search_fields = ['^name']), which Django translates to
+# UPPER("name"::text) LIKE UPPER('abc%'): these expression indexes make it an index range scan.
+INDEXED_COLUMNS = [
+    ('specimens_taxon', 'name'),
+    ('specimens_station', 'name'),
+    ('specimens_expedition', 'name'),
+    ('specimens_person', 'first_name'),
+    ('specimens_person', 'last_name'),
+    ('specimens_specimenlocation', 'name'),
+    ('specimens_bioregion', 'name'),
+    ('specimens_fixation', 'name'),
+    ('specimens_gear', 'name'),
+]
+
+
+def index_name(table, column):
+    return '{table}_{column}_upper_prefix'.format(table=table, column=column)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0005_exportjob'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            'CREATE INDEX {index} ON {table} (UPPER({column}::text) text_pattern_ops);'.format(
+                index=index_name(table, column), table=table, column=column),
+            'DROP INDEX {index};'.format(index=index_name(table, column))
+        ) for table, column in INDEXED_COLUMNS
+    ]
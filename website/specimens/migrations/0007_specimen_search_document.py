@@ -0,0 +1,109 @@
+# Generated by Django 2.0.1 on 2018-02-16 09:37
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations
+
+# The search document of a specimen is computed by a BEFORE INSERT/UPDATE trigger on the specimen. The triggers on
+# station, expedition and taxon "touch" (UPDATE ... SET x = x) the specimens whose document depends on the changed
+# row, so they are recomputed too. Being in the database, this also works for bulk updates (QuerySet.update(), raw
+# SQL, imports).
+CREATE_TRIGGERS = """
+CREATE FUNCTION specimens_specimen_search_document() RETURNS trigger AS $$
+DECLARE
+    station_text text;
+    taxon_text text;
+BEGIN
+    SELECT concat_ws(' ', s.name, e.name) INTO station_text
+    FROM specimens_station s JOIN specimens_expedition e ON e.id = s.expedition_id
+    WHERE s.id = NEW.station_id;
+
+    -- The taxon and all its ancestors
+    SELECT string_agg(a.name, ' ') INTO taxon_text
+    FROM specimens_taxon t JOIN specimens_taxon a ON a.tree_id = t.tree_id AND a.lft <= t.lft AND a.rght >= t.rght
+    WHERE t.id = NEW.taxon_id;
+
+    NEW.search_document :=
+        setweight(to_tsvector('simple', concat_ws(' ', NEW.specimen_id::text, NEW.vial, NEW.mnhn_number, NEW.mna_code,
+                                                  NEW.bold_process_id, NEW.bold_sample_id, NEW.bold_bin)), 'A') ||
+        setweight(to_tsvector('simple', concat_ws(' ', NEW.initial_scientific_name, taxon_text)), 'A') ||
+        setweight(to_tsvector('simple', coalesce(station_text, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(NEW.comment, '')), 'C');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER specimens_specimen_search_document BEFORE INSERT OR UPDATE ON specimens_specimen
+    FOR EACH ROW EXECUTE PROCEDURE specimens_specimen_search_document();
+
+CREATE FUNCTION specimens_station_search_document() RETURNS trigger AS $$
+BEGIN
+    UPDATE specimens_specimen SET station_id = station_id WHERE station_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER specimens_station_search_document AFTER UPDATE OF name, expedition_id ON specimens_station
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.expedition_id IS DISTINCT FROM NEW.expedition_id)
+    EXECUTE PROCEDURE specimens_station_search_document();
+
+CREATE FUNCTION specimens_expedition_search_document() RETURNS trigger AS $$
+BEGIN
+    UPDATE specimens_specimen SET station_id = station_id
+    WHERE station_id IN (SELECT id FROM specimens_station WHERE expedition_id = NEW.id);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER specimens_expedition_search_document AFTER UPDATE OF name ON specimens_expedition
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE PROCEDURE specimens_expedition_search_document();
+
+-- Renaming or moving a taxon changes the document of the specimens attached to it or to its descendants
+CREATE FUNCTION specimens_taxon_search_document() RETURNS trigger AS $$
+BEGIN
+    UPDATE specimens_specimen SET taxon_id = taxon_id
+    WHERE taxon_id IN (SELECT d.id FROM specimens_taxon d
+                       WHERE d.tree_id = NEW.tree_id AND d.lft >= NEW.lft AND d.rght <= NEW.rght);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER specimens_taxon_search_document AFTER UPDATE OF name, parent_id ON specimens_taxon
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name OR OLD.parent_id IS DISTINCT FROM NEW.parent_id)
+    EXECUTE PROCEDURE specimens_taxon_search_document();
+
+-- Compute the documents of the existing specimens
+UPDATE specimens_specimen SET id = id;
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER specimens_taxon_search_document ON specimens_taxon;
+DROP FUNCTION specimens_taxon_search_document();
+DROP TRIGGER specimens_expedition_search_document ON specimens_expedition;
+DROP FUNCTION specimens_expedition_search_document();
+DROP TRIGGER specimens_station_search_document ON specimens_station;
+DROP FUNCTION specimens_station_search_document();
+DROP TRIGGER specimens_specimen_search_document ON specimens_specimen;
+DROP FUNCTION specimens_specimen_search_document();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0006_autocomplete_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='specimen',
+            name='search_document',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='specimen',
+            index=django.contrib.postgres.indexes.GinIndex(fields=['search_document'], name='specimen_search_document_gin'),
+        ),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+    ]
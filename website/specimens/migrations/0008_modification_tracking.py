@@ -0,0 +1,98 @@
+# Generated by Django 2.0.1 on 2018-02-19 14:02
+
+from django.db import migrations, models
+import django.utils.timezone
+
+TRACKED_TABLES = (
+    # (table, model label, condition for updated_at to change)
+    ('specimens_specimen', 'specimens.specimen', 'OLD.* IS DISTINCT FROM NEW.*'),
+    ('specimens_station', 'specimens.station', 'OLD.* IS DISTINCT FROM NEW.*'),
+    # Not when MPTT renumbers a tree (lft, rght, tree_id and level change for a lot of taxa when one is added)
+    ('specimens_taxon', 'specimens.taxon', '(OLD.name, OLD.rank_id, OLD.status_id, OLD.aphia_id, OLD.authority, '
+                                           'OLD.parent_id) IS DISTINCT FROM (NEW.name, NEW.rank_id, NEW.status_id, '
+                                           'NEW.aphia_id, NEW.authority, NEW.parent_id)'),
+)
+
+# created_at/updated_at are set from the database clock, whatever the write path (save(), QuerySet.update(), raw SQL),
+# and deleted rows (including cascades) are recorded in the tombstone table. The timestamp triggers are named so they
+# run after the search document trigger (BEFORE triggers run in name order).
+CREATE_FUNCTIONS = """
+CREATE FUNCTION specimens_timestamps() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        NEW.created_at := now();
+    ELSE
+        NEW.created_at := OLD.created_at;
+    END IF;
+    NEW.updated_at := now();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE FUNCTION specimens_tombstone() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO specimens_tombstone (model, object_id, deleted_at) VALUES (TG_ARGV[0], OLD.id, now());
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+CREATE_TRIGGERS = """
+CREATE TRIGGER {table}_timestamps_insert BEFORE INSERT ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE specimens_timestamps();
+CREATE TRIGGER {table}_timestamps_update BEFORE UPDATE ON {table}
+    FOR EACH ROW WHEN ({condition}) EXECUTE PROCEDURE specimens_timestamps();
+CREATE TRIGGER {table}_tombstone AFTER DELETE ON {table}
+    FOR EACH ROW EXECUTE PROCEDURE specimens_tombstone('{label}');
+"""
+
+DROP_TRIGGERS = """
+DROP TRIGGER {table}_tombstone ON {table};
+DROP TRIGGER {table}_timestamps_update ON {table};
+DROP TRIGGER {table}_timestamps_insert ON {table};
+"""
+
+DROP_FUNCTIONS = """
+DROP FUNCTION specimens_tombstone();
+DROP FUNCTION specimens_timestamps();
+"""
+
+
+def timestamp_fields(model_name):
+    return [
+        migrations.AddField(
+            model_name=model_name,
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True, default=django.utils.timezone.now),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name=model_name,
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0007_specimen_search_document'),
+    ]
+
+    operations = timestamp_fields('specimen') + timestamp_fields('station') + timestamp_fields('taxon') + [
+        migrations.CreateModel(
+            name='Tombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100)),
+                ('object_id', models.IntegerField()),
+                ('deleted_at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+        migrations.RunSQL(
+            CREATE_FUNCTIONS + ''.join(CREATE_TRIGGERS.format(table=table, label=label, condition=condition)
+                                       for table, label, condition in TRACKED_TABLES),
+            ''.join(DROP_TRIGGERS.format(table=table) for table, _label, _condition in TRACKED_TABLES) + DROP_FUNCTIONS,
+        ),
+    ]
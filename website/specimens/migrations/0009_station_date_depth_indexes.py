@@ -0,0 +1,39 @@
+# Generated by Django 2.0.1 on 2018-02-20 11:15
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import specimens.validators
+
+# For StationQuerySet.captured_in_months(): same expression as the SQL of the __month lookup
+CREATE_MONTH_INDEX = """
+CREATE INDEX specimens_station_capture_month ON specimens_station ((EXTRACT('month' FROM capture_date_start)));
+"""
+
+DROP_MONTH_INDEX = """
+DROP INDEX specimens_station_capture_month;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0008_modification_tracking'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='station',
+            name='capture_date_end',
+            field=models.DateField(blank=True, db_index=True, null=True, validators=[specimens.validators.plausible_specimen_date]),
+        ),
+        migrations.AlterField(
+            model_name='station',
+            name='capture_date_start',
+            field=models.DateField(blank=True, db_index=True, null=True, validators=[specimens.validators.plausible_specimen_date]),
+        ),
+        migrations.AddIndex(
+            model_name='station',
+            index=django.contrib.postgres.indexes.GistIndex(fields=['depth'], name='station_depth_gist'),
+        ),
+        migrations.RunSQL(CREATE_MONTH_INDEX, DROP_MONTH_INDEX),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 2.0.1 on 2018-02-21 10:48
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0009_station_date_depth_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='bioregion',
+            name='area',
+            field=django.contrib.gis.db.models.fields.MultiPolygonField(blank=True, null=True, srid=4326),
+        ),
+    ]
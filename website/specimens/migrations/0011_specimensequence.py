@@ -0,0 +1,57 @@
+# Generated by Django 2.0.1 on 2018-02-22 14:05
+
+import itertools
+import zlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+BATCH_SIZE = 1000
+
+
+def move_sequences_out(apps, schema_editor):
+    # Historical models don't have SpecimenSequence.compress()
+    Specimen = apps.get_model('specimens', 'Specimen')
+    SpecimenSequence = apps.get_model('specimens', 'SpecimenSequence')
+
+    sequences = Specimen.objects.exclude(sequence_fasta='').values_list('pk', 'sequence_fasta').iterator()
+    while True:
+        batch = list(itertools.islice(sequences, BATCH_SIZE))
+        if not batch:
+            break
+        SpecimenSequence.objects.bulk_create(
+            SpecimenSequence(specimen_id=pk, compressed_fasta=zlib.compress(fasta.encode('utf-8')))
+            for pk, fasta in batch)
+
+
+def move_sequences_back(apps, schema_editor):
+    Specimen = apps.get_model('specimens', 'Specimen')
+    SpecimenSequence = apps.get_model('specimens', 'SpecimenSequence')
+
+    for specimen_id, compressed_fasta in SpecimenSequence.objects.values_list('specimen_id',
+                                                                             'compressed_fasta').iterator():
+        Specimen.objects.filter(pk=specimen_id).update(
+            sequence_fasta=zlib.decompress(bytes(compressed_fasta)).decode('utf-8'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0010_bioregion_area'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpecimenSequence',
+            fields=[
+                ('specimen', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='sequence', serialize=False, to='specimens.Specimen')),
+                ('compressed_fasta', models.BinaryField()),
+            ],
+        ),
+        migrations.RunPython(move_sequences_out, move_sequences_back),
+        # The space of the column is only given back by a rewrite of the table (e.g. VACUUM FULL specimens_specimen)
+        migrations.RemoveField(
+            model_name='specimen',
+            name='sequence_fasta',
+        ),
+    ]
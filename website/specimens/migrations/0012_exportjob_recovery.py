@@ -0,0 +1,35 @@
+# Generated by Django 2.0.1 on 2018-02-23 09:47
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import specimens.models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0011_specimensequence'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exportjob',
+            name='attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='changelist_params',
+            field=django.contrib.postgres.fields.jsonb.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='exportjob',
+            name='heartbeat_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='exportjob',
+            name='file',
+            field=models.FileField(blank=True, storage=specimens.models.ExportStorage(), upload_to=''),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 2.0.1 on 2018-02-26 10:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0012_exportjob_recovery'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FeedReset',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('at', models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
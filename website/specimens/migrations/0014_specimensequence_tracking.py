@@ -0,0 +1,37 @@
+# Generated by Django 2.0.1 on 2018-02-27 09:30
+
+from django.db import migrations
+
+# The sequences are part of the specimens in the change feed (see changes.py): writing one touches the specimen, so
+# its updated_at changes (through the specimen timestamp triggers of migration 0008).
+CREATE_TRIGGER = """
+CREATE FUNCTION specimens_touch_sequence_specimen() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        UPDATE specimens_specimen SET updated_at = now() WHERE id = OLD.specimen_id;
+    ELSE
+        UPDATE specimens_specimen SET updated_at = now() WHERE id = NEW.specimen_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER specimens_specimensequence_touch AFTER INSERT OR UPDATE OR DELETE ON specimens_specimensequence
+    FOR EACH ROW EXECUTE PROCEDURE specimens_touch_sequence_specimen();
+"""
+
+DROP_TRIGGER = """
+DROP TRIGGER specimens_specimensequence_touch ON specimens_specimensequence;
+DROP FUNCTION specimens_touch_sequence_specimen();
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0013_feedreset'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_TRIGGER, DROP_TRIGGER),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 2.0.1 on 2018-02-27 11:20
+
+from django.db import migrations
+
+# No tombstones for the deletions of a transaction reloading the tables (see changes.tables_reload()). A setting of
+# the transaction rather than ALTER TABLE ... DISABLE TRIGGER, which locks out the readers and needs to own the tables.
+TOMBSTONE_FUNCTION = """
+CREATE OR REPLACE FUNCTION specimens_tombstone() RETURNS trigger AS $$
+BEGIN
+    IF coalesce(current_setting('astapor.reloading', true), '') <> 'on' THEN
+        INSERT INTO specimens_tombstone (model, object_id, deleted_at) VALUES (TG_ARGV[0], OLD.id, now());
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+PREVIOUS_TOMBSTONE_FUNCTION = """
+CREATE OR REPLACE FUNCTION specimens_tombstone() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO specimens_tombstone (model, object_id, deleted_at) VALUES (TG_ARGV[0], OLD.id, now());
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('specimens', '0014_specimensequence_tracking'),
+    ]
+
+    operations = [
+        migrations.RunSQL(TOMBSTONE_FUNCTION, PREVIOUS_TOMBSTONE_FUNCTION),
+    ]
@@ -1,11 +1,23 @@
+import os
+import time
+import zlib
+from collections import OrderedDict
+
 from django.contrib.gis.db import models
-from django.contrib.postgres.fields import FloatRangeField, HStoreField
+from django.contrib.postgres.fields import FloatRangeField, HStoreField, JSONField
+from django.contrib.postgres.indexes import GinIndex, GistIndex
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVectorField
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from django.core.files.storage import FileSystemStorage
 from django.core.validators import MaxValueValidator, MinValueValidator
+from django.db import transaction
+from django.db.models import Case, ExpressionWrapper, F, Q, When
+from django.utils.deconstruct import deconstructible
 
 from django.conf import settings
 
 from mptt.models import MPTTModel, TreeForeignKey
+from psycopg2.extras import NumericRange
 
 from .validators import plausible_specimen_date, StrictlyMinValueValidator
 
@@ -18,9 +30,57 @@ GENUS_RANK_NAME = "Genus"
 FAMILY_RANK_NAME = "Family"
 
 
+class TaxonRankManager(models.Manager):
+    """Also a process-wide registry of the rank ids/names, so rank checks don't need a query or a join.
+
+    Like the taxonomy snapshot (see taxonomy.py), the registry is keyed by the TaxonomyVersion number, which is bumped
+    when ranks change in any process: it is reloaded when that number changed (checked at most every
+    VERSION_CHECK_INTERVAL seconds). The cache is also cleared right away when ranks are saved or deleted in this
+    process (see signals.py). Bulk operations (bulk_create, update, ...) should call clear_cache() explicitly.
+    """
+    def __init__(self, *args, **kwargs):
+        super(TaxonRankManager, self).__init__(*args, **kwargs)
+        self._ids_by_name = None
+        self._names_by_id = None
+        self._version = None
+        self._last_version_check = 0.0
+
+    def _load(self):
+        from .taxonomy import current_version, VERSION_CHECK_INTERVAL  # taxonomy.py imports the models
+
+        now = time.monotonic()
+        if self._ids_by_name is None or now - self._last_version_check >= VERSION_CHECK_INTERVAL:
+            version = current_version()  # Before the ranks: they can't be older than the version
+            self._last_version_check = now
+            if self._ids_by_name is None or version != self._version:
+                self.set_cache(self.get_queryset(), version)
+
+    def set_cache(self, ranks, version):
+        ranks = list(ranks)
+        self._names_by_id = {rank.pk: rank.name for rank in ranks}
+        self._ids_by_name = {rank.name: rank.pk for rank in ranks}
+        self._version = version
+        self._last_version_check = time.monotonic()
+
+    def clear_cache(self):
+        self._ids_by_name = None
+        self._names_by_id = None
+
+    def id_for(self, name):
+        """Return the id of the rank with that name (None if it doesn't exist)."""
+        self._load()
+        return self._ids_by_name.get(name)
+
+    def name_for(self, rank_id):
+        self._load()
+        return self._names_by_id.get(rank_id)
+
+
 class TaxonRank(models.Model):
     name = models.CharField(max_length=100)
 
+    objects = TaxonRankManager()
+
     def __str__(self):
         return self.name
 
@@ -31,17 +91,17 @@ class TaxonStatus(models.Model):
 
 class SpeciesManager(models.Manager):
     def get_queryset(self):
-        return super(SpeciesManager, self).get_queryset().filter(rank__name=SPECIES_RANK_NAME)
+        return super(SpeciesManager, self).get_queryset().filter(rank_id=TaxonRank.objects.id_for(SPECIES_RANK_NAME))
 
 
 class GenusManager(models.Manager):
     def get_queryset(self):
-        return super(GenusManager, self).get_queryset().filter(rank__name=GENUS_RANK_NAME)
+        return super(GenusManager, self).get_queryset().filter(rank_id=TaxonRank.objects.id_for(GENUS_RANK_NAME))
 
 
 class FamilyManager(models.Manager):
     def get_queryset(self):
-        return super(FamilyManager, self).get_queryset().filter(rank__name=FAMILY_RANK_NAME)
+        return super(FamilyManager, self).get_queryset().filter(rank_id=TaxonRank.objects.id_for(FAMILY_RANK_NAME))
 
 
 class TaxonManager(models.Manager):
@@ -49,7 +109,7 @@ class TaxonManager(models.Manager):
         # Given a string such as "Cheiraster (Luidiaster)", returns the matching subgenus, if exists
         genus_name, subgenus_name = parentheses_string.replace('(', '').replace(')', '').split()
         try:
-            return self.get_queryset().get(rank__name=SUBGENUS_RANK_NAME,
+            return self.get_queryset().get(rank_id=TaxonRank.objects.id_for(SUBGENUS_RANK_NAME),
                                            parent__name=genus_name,
                                            name=subgenus_name)
         except ObjectDoesNotExist:
@@ -66,6 +126,10 @@ class Taxon(MPTTModel):
     parent = TreeForeignKey('self', null=True, blank=True, related_name='children', db_index=True,
                             on_delete=models.CASCADE)
 
+    # Maintained by database triggers on every write path, bulk updates included (see migration 0008 and changes.py)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
     objects = TaxonManager()
 
     species_objects = SpeciesManager()
@@ -73,13 +137,13 @@ class Taxon(MPTTModel):
     family_objects = FamilyManager()
 
     def is_species(self):
-        return self.rank.name == SPECIES_RANK_NAME
+        return self.rank_id == TaxonRank.objects.id_for(SPECIES_RANK_NAME)
 
     def is_subgenus(self):
-        return self.rank.name == SUBGENUS_RANK_NAME
+        return self.rank_id == TaxonRank.objects.id_for(SUBGENUS_RANK_NAME)
 
     def is_genus(self):
-        return self.rank.name == GENUS_RANK_NAME
+        return self.rank_id == TaxonRank.objects.id_for(GENUS_RANK_NAME)
 
     def species_name(self):  # Only work for species!!
         if self.parent.is_subgenus():
@@ -97,14 +161,26 @@ class Taxon(MPTTModel):
         else:
             name = self.name
 
-        return "{name} [{rank}]".format(name=name, rank=self.rank)
+        return "{name} [{rank}]".format(name=name, rank=TaxonRank.objects.name_for(self.rank_id))
 
     class MPTTMeta:
         order_insertion_by = ['name']
 
 
+class TaxonomyVersion(models.Model):
+    """Single row, incremented each time the taxonomy changes so in-process caches know when to reload (see taxonomy.py)"""
+    SINGLETON_PK = 1
+
+    number = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return "Taxonomy version {number}".format(number=self.number)
+
+
 class Bioregion(models.Model):
     name = models.CharField(max_length=100)
+    # Boundaries, spatially indexed (see bioregions.py)
+    area = models.MultiPolygonField(null=True, blank=True)
 
     def __str__(self):
         return self.name
@@ -150,6 +226,41 @@ class Gear(models.Model):
         return self.name
 
 
+# Months of the austral seasons
+AUSTRAL_SEASONS = OrderedDict([
+    ('summer', (12, 1, 2)),
+    ('autumn', (3, 4, 5)),
+    ('winter', (6, 7, 8)),
+    ('spring', (9, 10, 11)),
+])
+
+
+class StationQuerySet(models.QuerySet):
+    """Date and depth queries, all index-driven (see migration 0009). Stations without the dates/depth are excluded.
+
+    They can be combined, and used for specimens with Specimen.objects.filter(station__in=...).
+    """
+    def captured_between(self, start, end):
+        """Stations whose capture dates overlap the [start, end] window."""
+        return self.filter(capture_date_start__lte=end, capture_date_end__gte=start)
+
+    def captured_in_months(self, months):
+        """Stations whose capture started in one of the months (1-12), whatever the year."""
+        return self.filter(capture_date_start__month__in=months)
+
+    def captured_in_season(self, season):
+        """Stations captured during an austral season (a key of AUSTRAL_SEASONS), whatever the year."""
+        return self.captured_in_months(AUSTRAL_SEASONS[season])
+
+    def depth_overlaps(self, min_depth, max_depth):
+        """Stations whose depth range overlaps [min_depth, max_depth] (None for no bound)."""
+        return self.filter(depth__overlap=NumericRange(min_depth, max_depth, bounds='[]'))
+
+    def depth_within(self, min_depth, max_depth):
+        """Stations whose depth range is entirely within [min_depth, max_depth] (None for no bound)."""
+        return self.filter(depth__contained_by=NumericRange(min_depth, max_depth, bounds='[]'))
+
+
 class StationManager(models.Manager):
     def possible_inconsistent_duplicate(self, name, expedition, coordinates, depth, gear, capture_date_start,
                                         capture_date_end):
@@ -186,15 +297,24 @@ class Station(models.Model):
     # For DarwinCore export, we'll probably show a single date when capture_date_start == capture_date_end.
     initial_capture_year = models.CharField(max_length=5, blank=True)
     initial_capture_date = models.CharField(max_length=100, blank=True)
-    capture_date_start = models.DateField(null=True, blank=True, validators=[plausible_specimen_date])
-    capture_date_end = models.DateField(null=True, blank=True, validators=[plausible_specimen_date])
+    capture_date_start = models.DateField(null=True, blank=True, validators=[plausible_specimen_date], db_index=True)
+    capture_date_end = models.DateField(null=True, blank=True, validators=[plausible_specimen_date], db_index=True)
 
     coordinates = models.PointField(blank=True, null=True)
     depth = FloatRangeField(blank=True, null=True, help_text="Unit: meters.")
 
     gear = models.ForeignKey(Gear, blank=True, null=True, on_delete=models.CASCADE)
 
-    objects = StationManager()
+    # Trigger-maintained, like those of Taxon
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = StationManager.from_queryset(StationQuerySet)()
+
+    class Meta:
+        indexes = [
+            GistIndex(fields=['depth'], name='station_depth_gist'),  # For the range operators (overlap, ...)
+        ]
 
     def __str__(self):
         return "{station_name} ({expedition_name})".format(station_name=self.name, expedition_name=self.expedition.name)
@@ -245,6 +365,50 @@ class Station(models.Model):
     coordinates_str.short_description = 'Coordinates'
 
 
+class StationCluster(models.Model):
+    """A group of neighbouring stations at a given map zoom level. Precomputed, see clustering.py."""
+    zoom = models.PositiveSmallIntegerField()
+    # Position of the cell in the clustering grid
+    cell_x = models.IntegerField()
+    cell_y = models.IntegerField()
+    # Sum of the (projected) coordinates of the stations, so the centroid can be updated incrementally
+    sum_x = models.FloatField()
+    sum_y = models.FloatField()
+
+    stations_count = models.IntegerField()
+    specimens_count = models.IntegerField()
+    coordinates = models.PointField()  # Centroid of the stations
+
+    class Meta:
+        unique_together = ('zoom', 'cell_x', 'cell_y')
+
+
+# Text search configuration of the specimens search document (no stemming: mostly names and identifiers)
+SEARCH_CONFIG = 'simple'
+
+
+class SpecimenQuerySet(models.QuerySet):
+    def search(self, terms):
+        """Specimens matching all the terms (see Specimen.search_document), the most relevant first.
+
+        The relevance is available as search_rank.
+        """
+        query = SearchQuery(terms, config=SEARCH_CONFIG)
+        return (self.filter(search_document=query)
+                    .annotate(search_rank=SearchRank(F('search_document'), query))
+                    .order_by('-search_rank', 'specimen_id'))
+
+    def update_isotope_C_N_ratio(self):
+        """Recompute the stored C/N ratio of the specimens (in a single UPDATE query)."""
+        with_ratio = (Q(isotope_percentC__isnull=False) & Q(isotope_percentN__isnull=False) &
+                      ~Q(isotope_percentC=0) & ~Q(isotope_percentN=0))
+        return self.update(isotope_C_N_ratio=Case(
+            When(with_ratio, then=ExpressionWrapper(F('isotope_percentC') / F('isotope_percentN'),
+                                                    output_field=models.FloatField())),
+            default=None,
+            output_field=models.FloatField()))
+
+
 class Specimen(models.Model):
     specimen_id = models.IntegerField(unique=True)  # ID from the lab, not Django's PK
     initial_scientific_name = models.CharField(max_length=100)
@@ -267,7 +431,7 @@ class Specimen(models.Model):
     bold_sample_id = models.CharField(max_length=100, blank=True)
     bold_bin = models.CharField(max_length=100, blank=True)
     sequence_name = models.CharField(max_length=100, blank=True)
-    sequence_fasta = models.TextField(blank=True)
+    # The sequence itself is in a separate table, see SpecimenSequence and sequence_fasta
     bioregion = models.ForeignKey(Bioregion, null=True, blank=True, on_delete=models.CASCADE)
 
     isotope_d13C = models.FloatField(' d13C', null=True, blank=True,   # Whitespace to avoid capitalization in forms
@@ -282,14 +446,62 @@ class Specimen(models.Model):
                                          validators=[StrictlyMinValueValidator(0), MaxValueValidator(30)])  # 0 excluded
     isotope_percentS = models.FloatField(' %S', null=True, blank=True,
                                          validators=[StrictlyMinValueValidator(0)])
+    # Stored (and indexed) so it can be sorted, filtered and exported without computing it for each object.
+    # Maintained by save(), use Specimen.objects.update_isotope_C_N_ratio() after bulk updates.
+    isotope_C_N_ratio = models.FloatField(' C/N proportion', null=True, blank=True, editable=False, db_index=True)
 
     additional_data = HStoreField(blank=True, null=True)
 
-    def isotope_C_N_proportion(self):
+    # Full-text search document: identifiers, names (initial, taxon and its ancestors, station, expedition) and
+    # comment. Maintained by database triggers (see migration 0007), also when related objects change.
+    search_document = SearchVectorField(null=True, editable=False)
+
+    # Trigger-maintained, like those of Taxon
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = SpecimenQuerySet.as_manager()
+
+    _pending_sequence_fasta = None  # Set by sequence_fasta, written by save()
+
+    @property
+    def sequence_fasta(self):
+        """The FASTA sequence ('' if none). Loaded on first access: use select_related('sequence') for many specimens.
+
+        Can be assigned, the sequence is written (or deleted if blank) by save().
+        """
+        if self._pending_sequence_fasta is not None:
+            return self._pending_sequence_fasta
+        try:
+            return self.sequence.fasta
+        except SpecimenSequence.DoesNotExist:
+            return ''
+
+    @sequence_fasta.setter
+    def sequence_fasta(self, value):
+        self._pending_sequence_fasta = value or ''
+
+    def _save_sequence(self):
+        fasta = self._pending_sequence_fasta
+        self._pending_sequence_fasta = None
+
+        if fasta:
+            self.sequence, _ = SpecimenSequence.objects.update_or_create(
+                specimen=self, defaults={'compressed_fasta': SpecimenSequence.compress(fasta)})
+        else:
+            SpecimenSequence.objects.filter(specimen=self).delete()
+            if Specimen.sequence.related.is_cached(self):
+                Specimen.sequence.related.delete_cached_value(self)
+
+    def compute_isotope_C_N_ratio(self):
         if self.isotope_percentC and self.isotope_percentN:
             return self.isotope_percentC / self.isotope_percentN
         else:
-            return '/'
+            return None
+
+    def isotope_C_N_proportion(self):
+        ratio = self.compute_isotope_C_N_ratio()
+        return ratio if ratio is not None else '/'
 
     isotope_C_N_proportion.short_description = 'C/N proportions'
 
@@ -339,16 +551,136 @@ class Specimen(models.Model):
 
     def save(self, *args, **kwargs):
         self.full_clean()  # We want our custom clean method to be called at save()
-        return super(Specimen, self).save(*args, **kwargs)
+        self.isotope_C_N_ratio = self.compute_isotope_C_N_ratio()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and {'isotope_percentC', 'isotope_percentN'} & set(update_fields):
+            kwargs['update_fields'] = set(update_fields) | {'isotope_C_N_ratio'}
+        if self._pending_sequence_fasta is None:
+            return super(Specimen, self).save(*args, **kwargs)
+
+        with transaction.atomic():
+            super(Specimen, self).save(*args, **kwargs)
+            self._save_sequence()
 
     def __str__(self):
         return "Specimen #{specimen_id}".format(specimen_id=self.specimen_id)
 
     class Meta:
         ordering = ['specimen_id']
+        indexes = [
+            GinIndex(fields=['search_document'], name='specimen_search_document_gin'),
+        ]
+
+
+class SpecimenSequence(models.Model):
+    """The FASTA sequence of a specimen, zlib-compressed.
+
+    Sequences are several kilobytes and rarely read: in their own table, they are not loaded (nor scanned) by the
+    specimen queries. Use Specimen.sequence_fasta to read or change them.
+    """
+    specimen = models.OneToOneField(Specimen, primary_key=True, related_name='sequence', on_delete=models.CASCADE)
+    compressed_fasta = models.BinaryField()
+
+    @staticmethod
+    def compress(fasta):
+        return zlib.compress(fasta.encode('utf-8'))
+
+    @staticmethod
+    def decompress(compressed_fasta):
+        return zlib.decompress(bytes(compressed_fasta)).decode('utf-8')
+
+    @property
+    def fasta(self):
+        return self.decompress(self.compressed_fasta)
+
+    @fasta.setter
+    def fasta(self, value):
+        self.compressed_fasta = self.compress(value)
+
+    def __str__(self):
+        return "Sequence of specimen #{specimen_id}".format(specimen_id=self.specimen.specimen_id)
 
 
 class SpecimenPicture(models.Model):
     image = models.ImageField(upload_to='specimen_pictures')
     high_interest = models.BooleanField("High resolution/species representative")
     specimen = models.ForeignKey(Specimen, on_delete=models.CASCADE)
+
+
+class Tombstone(models.Model):
+    """A deleted Specimen, Station or Taxon, recorded by a database trigger (see changes.py)."""
+    model = models.CharField(max_length=100)  # Label, e.g. specimens.specimen
+    object_id = models.IntegerField()
+    deleted_at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return "{model} #{object_id} (deleted {deleted_at})".format(model=self.model, object_id=self.object_id,
+                                                                    deleted_at=self.deleted_at)
+
+
+class FeedReset(models.Model):
+    """A reload of the tracked tables (full import): the change feed starts over from there (see changes.py)."""
+    at = models.DateTimeField(db_index=True)
+
+    def __str__(self):
+        return "Reload at {at}".format(at=self.at)
+
+
+@deconstructible
+class ExportStorage(FileSystemStorage):
+    """Storage of the export files, in settings.EXPORTS_ROOT: not public, the admin serves them to who requested them."""
+    @property
+    def base_location(self):
+        return settings.EXPORTS_ROOT
+
+    @property
+    def location(self):
+        return os.path.abspath(self.base_location)
+
+
+class ExportJob(models.Model):
+    """An export requested in the admin, run in the background by the run_export_worker command (see exports.py)."""
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((QUEUED, 'Queued'), (RUNNING, 'Running'), (DONE, 'Done'), (FAILED, 'Failed'))
+
+    CSV = 'csv'
+    XLSX = 'xlsx'
+    FORMAT_CHOICES = ((CSV, 'CSV'), (XLSX, 'Excel (xlsx)'))
+
+    model = models.CharField(max_length=100)  # "app_label.ModelName"
+    filters = JSONField(default=dict)  # Passed to filter()
+    # Query string of the admin changelist (filters, search) when all its objects are exported, None otherwise
+    changelist_params = JSONField(null=True, blank=True)
+    fields = JSONField(default=list)  # Passed to values_list(), can follow relations ("station__name")
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES, default=CSV)
+
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    requested_by = models.ForeignKey(settings.AUTH_USER_MODEL, null=True, blank=True, on_delete=models.SET_NULL)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    heartbeat_at = models.DateTimeField(null=True, blank=True)  # Last sign of life of the worker running the job
+    attempts = models.PositiveSmallIntegerField(default=0)
+
+    rows_total = models.PositiveIntegerField(null=True, blank=True)
+    rows_done = models.PositiveIntegerField(default=0)
+
+    file = models.FileField(storage=ExportStorage(), blank=True)
+    error = models.TextField(blank=True)
+
+    def progress(self):
+        """Percentage of the rows exported (None if not started yet)."""
+        if self.status == self.DONE:
+            return 100
+        if not self.rows_total:
+            return None
+        return int(100 * self.rows_done / self.rows_total)
+
+    def __str__(self):
+        return "Export #{pk} ({model}, {format})".format(pk=self.pk, model=self.model, format=self.format)
+
+    class Meta:
+        ordering = ['-created_at']
@@ -0,0 +1,98 @@
+"""Matching of the initial scientific names of specimens to taxa (used by reconcile_taxonomy and the admin actions)."""
+import re
+from collections import defaultdict
+
+from django.db import transaction
+
+SPXXX_REGEXP = r" sp\d+$"
+
+
+class NameMatch(object):
+    """Result of the matching of a name: taxon is None if no match has been found."""
+    def __init__(self, message, taxon=None, uncertain=False, undet=False):
+        self.message = message
+        self.taxon = taxon
+        self.uncertain = uncertain  # "cf" identification
+        self.undet = undet
+
+
+def match_name(taxonomy, name):
+    """Look for the taxon corresponding to an initial scientific name, in a TaxonomySnapshot (exact matches only)."""
+    initial_sn_length = len(name.split())
+    name_contains_parentheses = '(' in name or ')' in name
+
+    if name.lower() == "undet":
+        #  It's normal to not match, we just count it separately for stats
+        return NameMatch('Case 1: INITIAL SCIENTIFIC NAME IS UNDET, SKIPPING', undet=True)
+
+    # Best case: exact match on species name
+    if taxonomy.species_named(name):
+        return NameMatch('Case 2: FOUND EXACT SPECIES MATCH ON INITIAL SCIENTIFIC NAME', taxonomy.species_named(name))
+    if 'cf ' in name and taxonomy.species_named(name.replace('cf ', '')):
+        return NameMatch('Case 2b: FOUND EXACT SPECIES MATCH ON INITIAL SCIENTIFIC NAME - cf',
+                         taxonomy.species_named(name.replace('cf ', '')), uncertain=True)
+    if 'cf. ' in name and taxonomy.species_named(name.replace('cf. ', '')):
+        return NameMatch('Case 2c: FOUND EXACT SPECIES MATCH ON INITIAL SCIENTIFIC NAME - cf.',
+                         taxonomy.species_named(name.replace('cf. ', '')), uncertain=True)
+
+    if name.endswith('sp') or name.endswith('sp.'):
+        # No species match, we look for a Genus
+        message = "Case 3: Dropping 'sp'/'sp.' and looking for a genus or subgenus..."
+        name = name[:-3] if name.endswith('sp') else name[:-4]
+
+        genus_found = taxonomy.genus_named(name)
+        if genus_found:
+            return NameMatch(message + 'EXACT MATCH ON GENUS NAME after dropping sp/sp.', genus_found)
+        if name_contains_parentheses:
+            # If we have the form 'Cheiraster (Luidiaster) sp', we can try to match it to the subgenus
+            sg_found = taxonomy.subgenus_named(name)
+            if sg_found:
+                return NameMatch(message + 'EXACT MATCH ON SUBGENUS NAME after dropping sp/sp.', sg_found)
+            return NameMatch(message + 'NO MATCHING SUBGENUS FOUND')
+        return NameMatch(message + 'NO MATCH FOUND IN CASE 3.')
+
+    # two words, string ends with " sp" followed by digits
+    if initial_sn_length == 2 and re.search(SPXXX_REGEXP, name):
+        name = re.sub(SPXXX_REGEXP, '', name)
+        message = "Case 4: 2 words + sp + digits: looking for a '{0}' Genus...".format(name)
+
+        genus_found = taxonomy.genus_named(name)
+        if genus_found:
+            return NameMatch(message + 'EXACT MATCH ON GENUS NAME after dropping spXXX', genus_found)
+        return NameMatch(message + 'NO MATCHING GENUS FOUND')
+
+    if initial_sn_length == 1:
+        message = "Case 5: Initial scientific name is only one word ({0})...".format(name)
+
+        # Maybe it's a genus?
+        genus_found = taxonomy.genus_named(name)
+        if genus_found:
+            return NameMatch(message + 'EXACT MATCH ON GENUS NAME', genus_found)
+        family_found = taxonomy.family_named(name)
+        if family_found:
+            return NameMatch(message + 'EXACT MATCH ON FAMILY NAME', family_found)
+        return NameMatch(message + 'NO MATCHING GENUS/FAMILY FOUND')
+
+    return NameMatch('Not matching any case...')
+
+
+def reconcile_specimens(queryset, taxonomy):
+    """Attach the matching taxon to the specimens of queryset, with one UPDATE per distinct result.
+
+    Specimens without match are left untouched. Returns the number of specimens updated.
+    """
+    names_by_result = defaultdict(list)  # (taxon id, uncertain) -> initial scientific names
+    for name in queryset.order_by().values_list('initial_scientific_name', flat=True).distinct():
+        match = match_name(taxonomy, name)
+        if match.taxon:
+            names_by_result[(match.taxon.pk, match.uncertain)].append(name)
+
+    updated_count = 0
+    with transaction.atomic():
+        for (taxon_id, uncertain), names in names_by_result.items():
+            values = {'taxon_id': taxon_id}
+            if uncertain:
+                values['uncertain_identification'] = True
+            updated_count += queryset.filter(initial_scientific_name__in=names).update(**values)
+
+    return updated_count
@@ -0,0 +1,94 @@
+"""Routing of the heavy reads to an optional read replica of the database (DATABASES['replica'] in the settings).
+
+Writes always go to the primary (default) database, and so do reads, except inside use_replica() blocks: exports,
+analytics commands, the API, and the admin changelists of users who opted in. Without a replica in the settings,
+use_replica() does nothing.
+
+The replica lags a little behind the primary. During a request, once something has been written, the remaining reads
+stay on the primary, even in use_replica() blocks. ReplicaPinningMiddleware extends this to the requests of the next
+REPLICA_PIN_SECONDS (e.g. the changelist shown after saving an object), with a cookie. Commands are not pinned: they
+only use the replica for reads that don't depend on their own writes.
+"""
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+REPLICA_DATABASE = 'replica'
+REPLICA_PIN_SECONDS = 10  # Longer than the usual replication lag
+PIN_COOKIE = 'astapor_primary'
+
+_state = threading.local()
+
+
+def replica_configured():
+    return REPLICA_DATABASE in settings.DATABASES
+
+
+@contextmanager
+def use_replica():
+    """Read from the replica (if configured) in the block. Also usable as a decorator. Blocks can be nested."""
+    _state.replica_depth = getattr(_state, 'replica_depth', 0) + 1
+    try:
+        yield
+    finally:
+        _state.replica_depth -= 1
+
+
+def reads_from_replica():
+    return (getattr(_state, 'replica_depth', 0) > 0 and not getattr(_state, 'pinned', False) and
+            replica_configured())
+
+
+@contextmanager
+def pinning():
+    """Reads of the block go to the primary once the block has written something (see ReplicaPinningMiddleware).
+
+    Yield a function telling whether the block has written.
+    """
+    _state.pinning, _state.pinned, _state.written = True, False, False
+    try:
+        yield lambda: _state.written
+    finally:
+        _state.pinning, _state.pinned, _state.written = False, False, False
+
+
+def pin_to_primary():
+    """From now on (and until the end of the pinning() block), read from the primary."""
+    if getattr(_state, 'pinning', False):
+        _state.pinned = True
+
+
+def _record_write():
+    if getattr(_state, 'pinning', False):
+        _state.pinned = _state.written = True
+
+
+class ReplicaRouter(object):
+    """Database router (see DATABASE_ROUTERS in the settings)."""
+    def db_for_read(self, model, **hints):
+        return REPLICA_DATABASE if reads_from_replica() else DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        _record_write()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        return True  # Same data on both databases
+
+
+class ReplicaPinningMiddleware(object):
+    """Keep the reads on the primary during and shortly after requests that wrote something."""
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with pinning() as has_written:
+            if request.COOKIES.get(PIN_COOKIE):
+                pin_to_primary()
+            response = self.get_response(request)
+
+            if has_written():
+                response.set_cookie(PIN_COOKIE, '1', max_age=REPLICA_PIN_SECONDS, httponly=True)
+            return response
@@ -0,0 +1,14 @@
+from django.test.runner import DiscoverRunner
+
+PERFORMANCE_TAG = 'performance'
+
+
+class AstaporTestRunner(DiscoverRunner):
+    """The default test runner, without the (slow) performance tests unless they are asked for with --tag performance.
+
+    See tests_performance.py and TEST_RUNNER in the settings.
+    """
+    def __init__(self, *args, tags=None, exclude_tags=None, **kwargs):
+        if PERFORMANCE_TAG not in (tags or ()):
+            exclude_tags = set(exclude_tags or ()) | {PERFORMANCE_TAG}
+        super(AstaporTestRunner, self).__init__(*args, tags=tags, exclude_tags=exclude_tags, **kwargs)
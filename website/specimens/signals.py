@@ -0,0 +1,87 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from . import clustering, taxonomy
+from .models import Station, Specimen, Taxon, TaxonRank
+
+
+def _station_coordinates(station_id):
+    return Station.objects.filter(pk=station_id).values_list('coordinates', flat=True).first()
+
+
+def _specimen_coordinates(specimen):
+    if Specimen.station.is_cached(specimen):
+        return specimen.station.coordinates
+    return _station_coordinates(specimen.station_id)
+
+
+# Station clusters (see clustering.py)
+@receiver(pre_save, sender=Station)
+def remember_previous_station_coordinates(sender, instance, raw, **kwargs):
+    instance._previous_coordinates = None
+    if instance.pk and not raw and not clustering.refresh_is_deferred():
+        instance._previous_coordinates = _station_coordinates(instance.pk)
+
+
+@receiver(post_save, sender=Station)
+def update_clusters_on_station_save(sender, instance, created, raw, **kwargs):
+    if raw:
+        return
+
+    if created:
+        clustering.update_station_clusters(instance.coordinates, 1, 0)
+    else:
+        previous = getattr(instance, '_previous_coordinates', None)
+        if previous != instance.coordinates:  # Moved: we remove it from the old clusters and add it to the new ones
+            specimens_count = instance.specimen_set.count()
+            clustering.update_station_clusters(previous, -1, -specimens_count)
+            clustering.update_station_clusters(instance.coordinates, 1, specimens_count)
+
+
+@receiver(post_delete, sender=Station)
+def update_clusters_on_station_delete(sender, instance, **kwargs):
+    # Specimens of this station have been deleted (and removed from the clusters) before, thanks to the cascade
+    clustering.update_station_clusters(instance.coordinates, -1, 0)
+
+
+@receiver(pre_save, sender=Specimen)
+def remember_previous_specimen_station(sender, instance, raw, **kwargs):
+    instance._previous_station_id = None
+    if instance.pk and not raw and not clustering.refresh_is_deferred():
+        instance._previous_station_id = Specimen.objects.filter(pk=instance.pk).values_list('station_id',
+                                                                                            flat=True).first()
+
+
+@receiver(post_save, sender=Specimen)
+def update_clusters_on_specimen_save(sender, instance, created, raw, **kwargs):
+    if raw or clustering.refresh_is_deferred():
+        return
+
+    previous_station_id = getattr(instance, '_previous_station_id', None)
+    if created or previous_station_id != instance.station_id:
+        if previous_station_id:
+            clustering.update_station_clusters(_station_coordinates(previous_station_id), 0, -1)
+        clustering.update_station_clusters(_specimen_coordinates(instance), 0, 1)
+
+
+@receiver(post_delete, sender=Specimen)
+def update_clusters_on_specimen_delete(sender, instance, **kwargs):
+    if not clustering.refresh_is_deferred():
+        clustering.update_station_clusters(_specimen_coordinates(instance), 0, -1)
+
+
+# Rank registry (see TaxonRankManager)
+@receiver(post_save, sender=TaxonRank)
+@receiver(post_delete, sender=TaxonRank)
+def clear_rank_registry(sender, **kwargs):
+    TaxonRank.objects.clear_cache()
+
+
+# Taxonomy snapshot (see taxonomy.py)
+@receiver(post_save, sender=Taxon)
+@receiver(post_delete, sender=Taxon)
+@receiver(post_save, sender=TaxonRank)
+@receiver(post_delete, sender=TaxonRank)
+def bump_taxonomy_version(sender, **kwargs):
+    if not kwargs.get('raw', False):
+        taxonomy.bump_version()
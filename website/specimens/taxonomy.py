@@ -0,0 +1,152 @@
+"""In-process snapshot of the taxonomy, for fast lookups by name or id (reconciliation, admin display, ...).
+
+The snapshot is loaded lazily (two queries) and shared by everything running in the process. It is keyed by the
+TaxonomyVersion number, which is incremented each time the taxonomy changes (Taxon/TaxonRank save and delete signals,
+imports): the snapshot is only rebuilt when that number changed. Checking the number costs a (tiny) query, so it is
+done at most every VERSION_CHECK_INTERVAL seconds.
+
+Bulk changes (imports, truncations) should run inside bulk_taxonomy_changes(), so the version is only bumped once.
+"""
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db.models import F
+
+from .matching import TrigramIndex
+from .models import (Taxon, TaxonRank, TaxonomyVersion, SPECIES_RANK_NAME, SUBGENUS_RANK_NAME, GENUS_RANK_NAME,
+                     FAMILY_RANK_NAME)
+
+VERSION_CHECK_INTERVAL = 1.0  # seconds
+
+_lock = threading.Lock()
+_snapshot = None
+_last_version_check = 0.0
+_state = threading.local()
+
+
+def current_version():
+    """The TaxonomyVersion number, 0 if the row doesn't exist (e.g. after a flush): bump_version() creates it."""
+    number = TaxonomyVersion.objects.filter(pk=TaxonomyVersion.SINGLETON_PK).values_list('number', flat=True).first()
+    return number if number is not None else 0
+
+
+def bump_version():
+    """Signal to all processes that the taxonomy changed."""
+    if getattr(_state, 'bulk_depth', 0) > 0:
+        return  # Will be done at the end of bulk_taxonomy_changes()
+
+    updated = TaxonomyVersion.objects.filter(pk=TaxonomyVersion.SINGLETON_PK).update(number=F('number') + 1)
+    if not updated:
+        TaxonomyVersion.objects.get_or_create(pk=TaxonomyVersion.SINGLETON_PK, defaults={'number': 1})
+
+    invalidate_local_snapshot()
+
+
+def invalidate_local_snapshot():
+    """Drop the snapshot of this process: it will be rebuilt at the next get_taxonomy_snapshot() call."""
+    global _snapshot
+    with _lock:
+        _snapshot = None
+
+
+@contextmanager
+def bulk_taxonomy_changes():
+    """Don't bump the version for each change made in the block, but once at the end."""
+    _state.bulk_depth = getattr(_state, 'bulk_depth', 0) + 1
+    try:
+        yield
+    finally:
+        _state.bulk_depth -= 1
+
+    bump_version()
+
+
+def get_taxonomy_snapshot():
+    """Return the current TaxonomySnapshot, (re)building it only if the taxonomy changed."""
+    global _snapshot, _last_version_check
+
+    with _lock:
+        now = time.monotonic()
+        if _snapshot is None or now - _last_version_check >= VERSION_CHECK_INTERVAL:
+            version = current_version()
+            _last_version_check = now
+            if _snapshot is None or _snapshot.version != version:
+                _snapshot = TaxonomySnapshot(version)
+
+        return _snapshot
+
+
+class TaxonomySnapshot(object):
+    """All the taxa, indexed by id and by name. Should be considered read-only.
+
+    The Taxon objects have their rank and parent cached, so species_name(), __str__(), ... don't hit the database.
+    """
+    def __init__(self, version):
+        self.version = version
+
+        ranks = {rank.pk: rank for rank in TaxonRank.objects.all()}
+        TaxonRank.objects.set_cache(ranks.values(), version)  # Ranks may have changed in another process
+        self.by_id = {taxon.pk: taxon for taxon in Taxon.objects.all()}
+
+        for taxon in self.by_id.values():
+            taxon.rank = ranks[taxon.rank_id]
+            taxon.parent = self.by_id.get(taxon.parent_id)
+
+        self.species_by_name = {}
+        self.genus_by_name = {}
+        self.subgenus_by_name = {}  # Key is the "parentheses form": "Cheiraster (Luidiaster)"
+        self.family_by_name = {}
+
+        for taxon in self.by_id.values():
+            rank_name = taxon.rank.name
+            if rank_name == SPECIES_RANK_NAME:
+                self.species_by_name.setdefault(taxon.species_name(), taxon)
+            elif rank_name == GENUS_RANK_NAME:
+                self.genus_by_name.setdefault(taxon.name, taxon)
+            elif rank_name == SUBGENUS_RANK_NAME and taxon.parent:
+                self.subgenus_by_name.setdefault('{genus} ({subgenus})'.format(genus=taxon.parent.name,
+                                                                               subgenus=taxon.name), taxon)
+            elif rank_name == FAMILY_RANK_NAME:
+                self.family_by_name.setdefault(taxon.name, taxon)
+
+        self._fuzzy_index = None
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def get(self, taxon_id):
+        return self.by_id.get(taxon_id)
+
+    def full_name(self, taxon_id):
+        """Genus + (subgenus) + species for species, name for other ranks. None if not found."""
+        taxon = self.by_id.get(taxon_id)
+        if taxon is None:
+            return None
+        return taxon.species_name() if taxon.rank.name == SPECIES_RANK_NAME else taxon.name
+
+    def label(self, taxon_id):
+        """Same as str(taxon), without any query."""
+        taxon = self.by_id.get(taxon_id)
+        return str(taxon) if taxon else None
+
+    def species_named(self, name):
+        return self.species_by_name.get(name)
+
+    def genus_named(self, name):
+        return self.genus_by_name.get(name)
+
+    def subgenus_named(self, parentheses_string):
+        return self.subgenus_by_name.get(' '.join(parentheses_string.split()))
+
+    def family_named(self, name):
+        return self.family_by_name.get(name)
+
+    def fuzzy_index(self):
+        """TrigramIndex over species full names, genus and family names (built on first use)."""
+        if self._fuzzy_index is None:
+            self._fuzzy_index = TrigramIndex(
+                [(taxon, name) for name, taxon in self.species_by_name.items()] +
+                [(taxon, name) for name, taxon in self.genus_by_name.items()] +
+                [(taxon, name) for name, taxon in self.family_by_name.items()])
+        return self._fuzzy_index
@@ -1,8 +1,55 @@
-from django.test import TestCase
+import csv
+import datetime
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+from unittest import skipUnless
+from unittest.mock import Mock, patch
 
+import numpy as np
+from openpyxl import Workbook
+from psycopg2.extras import NumericRange
+from django.test import RequestFactory, TestCase, SimpleTestCase, TransactionTestCase, override_settings
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import Permission, User
+from django.contrib.gis.geos import Point
 from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection, transaction
+from django.db.models import F, Max
+from django.urls import reverse
+from django.utils import timezone
 
-from .models import Specimen, Person, SpecimenLocation, Expedition, Station
+from .admin import CNRatioListFilter, SpecimenAdmin, StationAdmin, TaxonAdmin
+from .analytics import grouped_stats
+from .bioregions import read_boundaries, load_bioregions, assign_bioregions
+from .changes import changes_since, purge_tombstones, tables_reload, UPSERT, DELETE, RESET, TOMBSTONE_RETENTION
+from .clustering import deferred_refresh
+from .coordinates import normalize_coordinates, VALID, EMPTY, MISSING, INVALID, OUT_OF_RANGE, SWAPPED
+from .duplicates import find_duplicates, find_near_duplicates, fingerprint as duplicate_fingerprint
+from .denormalized import export_specimens, specimen_batches, COLUMN_NAMES, CSV_GZ
+from .management.commands._utils import source_rows
+from .management.commands.benchmark_coordinates import generate_pairs
+from .management.commands.full_import import (Command as FullImportCommand, Stage, StageFailed, TableBackup,
+                                              cascaded_models, plan_waves)
+from .management.commands.import_specimens import Command as ImportSpecimensCommand
+from .exports import (enqueue_export, claim_next_job, job_queryset, requeue_stale_jobs, run_job,
+                      MAX_ATTEMPTS as MAX_EXPORT_ATTEMPTS)
+from .fasta import import_sequences, read_fasta, FastaRecord
+from .matching import TrigramIndex, levenshtein
+from .models import (Specimen, SpecimenSequence, Person, SpecimenLocation, Expedition, Station, StationCluster, Taxon,
+                     TaxonRank, TaxonomyVersion, ExportJob, Bioregion, Tombstone, SPECIES_RANK_NAME,
+                     SUBGENUS_RANK_NAME, GENUS_RANK_NAME, FAMILY_RANK_NAME)
+from .reconciliation import match_name, reconcile_specimens
+from .routers import ReplicaRouter, use_replica, pinning, REPLICA_DATABASE, PIN_COOKIE
+from .runner import AstaporTestRunner, PERFORMANCE_TAG
+from .taxonomy import get_taxonomy_snapshot, bulk_taxonomy_changes, current_version, invalidate_local_snapshot
 
 
 
@@ -205,4 +252,1300 @@ class SpecimenTestCase(TestCase):
             # Then re-set it to its previous value which is not taken anymore
             first = Specimen.objects.get(specimen_id=4)
             first.mnhn_number = 3
-            first.save()
\ No newline at end of file
+            first.save()
+
+    def test_sequence(self):
+        fasta = ">COI_1\n" + "ACGT" * 200
+        self.specimen1.sequence_fasta = fasta
+        self.specimen1.save()
+        self.assertEqual(SpecimenSequence.objects.count(), 1)
+        self.assertLess(len(SpecimenSequence.objects.get().compressed_fasta), len(fasta))
+
+        # Not loaded with the specimen, only when accessed
+        with self.assertNumQueries(1):
+            specimen = Specimen.objects.get(specimen_id=1)
+        with self.assertNumQueries(1):
+            self.assertEqual(specimen.sequence_fasta, fasta)
+        self.assertEqual(Specimen.objects.select_related('sequence').get(specimen_id=1).sequence_fasta, fasta)
+        self.assertEqual(self.specimen2.sequence_fasta, '')
+
+        # Blank: removed
+        specimen.sequence_fasta = ''
+        specimen.save()
+        self.assertEqual(specimen.sequence_fasta, '')
+        self.assertFalse(SpecimenSequence.objects.exists())
+
+    def test_sequence_admin_form(self):
+        fasta = ">COI_2\n" + "ACGT" * 50
+        self.specimen2.sequence_fasta = fasta
+        self.specimen2.save()
+
+        request = RequestFactory().get('/')
+        request.user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+        form_class = SpecimenAdmin(Specimen, admin.site).get_form(request, self.specimen2)
+        form = form_class(instance=Specimen.objects.get(specimen_id=2))
+        self.assertEqual(form.initial['sequence_fasta'], fasta)
+
+        # Submitted unchanged: the sequence is not rewritten
+        data = {name: form[name].value() for name in form.fields if form[name].value() is not None}
+        form = form_class(data, instance=Specimen.objects.get(specimen_id=2))
+        self.assertTrue(form.is_valid(), form.errors)
+        self.assertNotIn('sequence_fasta', form.changed_data)
+        with patch.object(Specimen, '_save_sequence') as save_sequence:
+            form.save()
+        save_sequence.assert_not_called()
+
+        # Changed
+        data['sequence_fasta'] = ">COI_2\nACGT"
+        form = form_class(data, instance=Specimen.objects.get(specimen_id=2))
+        self.assertTrue(form.is_valid(), form.errors)
+        form.save()
+        self.assertEqual(Specimen.objects.get(specimen_id=2).sequence_fasta, ">COI_2\nACGT")
+
+    def test_isotope_C_N_ratio(self):
+        self.specimen1.isotope_percentC, self.specimen1.isotope_percentN = 20.0, 5.0
+        self.specimen1.save()
+        self.assertEqual(Specimen.objects.get(pk=self.specimen1.pk).isotope_C_N_ratio, 4.0)
+
+        # Also kept up to date when only some fields are saved
+        self.specimen1.isotope_percentN = 8.0
+        self.specimen1.save(update_fields=['isotope_percentN'])
+        self.assertEqual(Specimen.objects.get(pk=self.specimen1.pk).isotope_C_N_ratio, 2.5)
+
+        # Bulk updates
+        Specimen.objects.filter(pk=self.specimen2.pk).update(isotope_percentC=30.0, isotope_percentN=5.0)
+        Specimen.objects.filter(pk=self.specimen1.pk).update(isotope_percentN=0)
+        self.assertEqual(Specimen.objects.update_isotope_C_N_ratio(), 3)
+        self.assertEqual(dict(Specimen.objects.values_list('specimen_id', 'isotope_C_N_ratio')),
+                         {1: None, 2: 6.0, 3: None})
+
+    def test_C_N_ratio_list_filter(self):
+        for specimen, percentC in ((self.specimen1, 10.0), (self.specimen2, 40.0)):
+            specimen.isotope_percentC, specimen.isotope_percentN = percentC, 2.5
+            specimen.save()
+
+        def filtered(value):
+            request = RequestFactory().get('/', {CNRatioListFilter.parameter_name: value})
+            list_filter = CNRatioListFilter(request, request.GET.dict(), Specimen, None)
+            return list(list_filter.queryset(request, Specimen.objects.all()))
+
+        self.assertEqual(filtered('3'), [self.specimen1])  # [4, 5)
+        self.assertEqual(filtered('5'), [self.specimen2])  # >= 7
+        self.assertEqual(filtered('0'), [])
+        self.assertEqual(filtered('none'), [self.specimen3])
+        self.assertEqual(len(filtered('invalid')), 3)
+
+
+class StationClustersTestCase(TestCase):
+    def setUp(self):
+        self.camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        self.ulb = SpecimenLocation.objects.create(name="ULB")
+        self.cambio_expedition = Expedition.objects.create(name="ANT XXVII/3 (CAMBIO)")
+
+        self.station1 = Station.objects.create(name="PS77/239-3", expedition=self.cambio_expedition,
+                                               coordinates=Point(-56.4, -62.1))
+        self.station2 = Station.objects.create(name="PS77/240-1", expedition=self.cambio_expedition,
+                                               coordinates=Point(-56.401, -62.101))
+        self.station3 = Station.objects.create(name="PS77/300-1", expedition=self.cambio_expedition,
+                                               coordinates=Point(110.5, -66.3))
+
+        Specimen.objects.create(specimen_id=1, initial_scientific_name="Acodontaster capitatus",
+                                identified_by=self.camille, specimen_location=self.ulb, station=self.station1)
+
+    def clusters(self, zoom, **params):
+        params['zoom'] = zoom
+        response = self.client.get(reverse('specimens:station_clusters'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()['features']
+
+    def test_incremental_updates_match_rebuild(self):
+        incremental = sorted(StationCluster.objects.values_list('zoom', 'cell_x', 'cell_y', 'stations_count',
+                                                                'specimens_count'))
+        with deferred_refresh():
+            pass  # Exiting the block rebuilds everything
+        rebuilt = sorted(StationCluster.objects.values_list('zoom', 'cell_x', 'cell_y', 'stations_count',
+                                                            'specimens_count'))
+
+        self.assertEqual(incremental, rebuilt)
+
+    def test_clusters_endpoint(self):
+        # At zoom 0, the two close stations are grouped
+        features = self.clusters(0)
+        self.assertEqual(len(features), 2)
+        self.assertEqual(sorted((f['properties']['stations_count'], f['properties']['specimens_count'])
+                                for f in features), [(1, 0), (2, 1)])
+
+        # bbox filter (lon/lat)
+        features = self.clusters(0, bbox='100,-70,120,-60')
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['properties']['stations_count'], 1)
+
+    def test_clusters_endpoint_invalid_parameters(self):
+        url = reverse('specimens:station_clusters')
+        self.assertEqual(self.client.get(url, {'bbox': '0,0,1'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'srid': 'wgs84', 'bbox': '0,0,1,1'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'srid': '1', 'bbox': '0,0,1,1'}).status_code, 400)  # Unknown
+
+    def test_clusters_follow_station_changes(self):
+        self.station3.coordinates = Point(-56.402, -62.102)
+        self.station3.save()
+        self.assertEqual(len(self.clusters(0)), 1)
+
+        self.station3.delete()
+        self.station1.delete()
+        features = self.clusters(0)
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0]['properties'], {'stations_count': 1, 'specimens_count': 0})
+
+
+class FuzzyMatchingTestCase(SimpleTestCase):
+    def setUp(self):
+        self.index = TrigramIndex([(1, "Acodontaster capitatus"),
+                                   (2, "Acodontaster conspicuus"),
+                                   (3, "Acodontaster elongatus"),
+                                   (4, "Odontaster validus"),
+                                   (5, "Odontaster validulus"),
+                                   (6, "Acodontaster")])
+
+    def test_levenshtein(self):
+        self.assertEqual(levenshtein("capitatus", "capitatus"), 0)
+        self.assertEqual(levenshtein("capitatus", "capitatis"), 1)
+        self.assertEqual(levenshtein("", "abc"), 3)
+        self.assertEqual(levenshtein("kitten", "sitting"), 3)
+
+    def test_candidates_are_shortlisted(self):
+        candidates = self.index.candidates("Acodontaster capitatis", limit=2)
+        self.assertEqual(len(candidates), 2)
+        self.assertEqual(candidates[0], (1, "Acodontaster capitatus"))
+
+    def test_confident_match(self):
+        match = self.index.confident_match("Acodontaster capitatis")
+        self.assertEqual(match.obj, 1)
+        self.assertEqual(match.distance, 1)
+
+        # Case and whitespaces are ignored
+        self.assertEqual(self.index.confident_match("acodontaster  Capitatus").distance, 0)
+
+        # Too far from anything
+        self.assertIsNone(self.index.confident_match("Asterias rubens"))
+
+        # Ambiguous: as close to two candidates
+        self.assertIsNone(TrigramIndex([(1, "Odontaster validus"), (2, "Odontaster validas")]).confident_match(
+            "Odontaster validos"))
+
+    def test_confident_match_reuses_matches(self):
+        matches = self.index.best_matches("Acodontaster capitatis")
+        with patch.object(TrigramIndex, 'best_matches') as best_matches:
+            match = self.index.confident_match("Acodontaster capitatis", matches=matches)
+        best_matches.assert_not_called()
+        self.assertIs(match, matches[0])
+
+
+class CoordinatesTestCase(SimpleTestCase):
+    def assertNormalized(self, pairs, expected):
+        normalized = normalize_coordinates([lat for lat, _ in pairs], [lon for _, lon in pairs])
+        for (lat, lon, status), (expected_lat, expected_lon, expected_status) in zip(normalized.pairs(), expected):
+            self.assertEqual(status, expected_status)
+            if expected_status == VALID:
+                self.assertAlmostEqual(lat, expected_lat)
+                self.assertAlmostEqual(lon, expected_lon)
+        self.assertEqual(len(normalized.statuses), len(expected))
+
+    def test_formats(self):
+        self.assertNormalized([("-65.5", "100"),
+                               ("-65,5", " 100,25 "),
+                               ("65°30'36\" S", "W 70°15'"),
+                               ("S 65 30.6", "70 15 E"),
+                               ("65:30:36s", "+70:15")],
+                              [(-65.5, 100, VALID),
+                               (-65.5, 100.25, VALID),
+                               (-65.51, -70.25, VALID),
+                               (-65.51, 70.25, VALID),
+                               (-65.51, 70.25, VALID)])
+
+    def test_problems(self):
+        self.assertNormalized([("", None),
+                               ("-65.5", ""),
+                               ("65 75 S", "100"),
+                               ("-5 N", "100"),
+                               ("S 65 S", "100"),
+                               ("-91", "100"),
+                               ("100", "-65.5"),
+                               ("65 E", "100 S")],
+                              [(None, None, EMPTY),
+                               (None, None, MISSING),
+                               (None, None, INVALID),  # 75 minutes
+                               (None, None, INVALID),
+                               (None, None, INVALID),
+                               (None, None, OUT_OF_RANGE),
+                               (None, None, SWAPPED),
+                               (None, None, SWAPPED)])
+
+    def test_generated_pairs(self):
+        for format in ('decimal', 'dms', 'dm', 'mixed'):
+            normalized = normalize_coordinates(*generate_pairs(300, format))
+            self.assertTrue((normalized.statuses == VALID).all())
+            self.assertTrue(((normalized.latitudes >= -90) & (normalized.latitudes <= -40)).all())
+
+
+class TaxonomySnapshotTestCase(TestCase):
+    def setUp(self):
+        invalidate_local_snapshot()  # The version number is also rolled back after each test
+
+        genus_rank = TaxonRank.objects.create(name=GENUS_RANK_NAME)
+        subgenus_rank = TaxonRank.objects.create(name=SUBGENUS_RANK_NAME)
+        species_rank = TaxonRank.objects.create(name=SPECIES_RANK_NAME)
+
+        self.acodontaster = Taxon.objects.create(name="Acodontaster", rank=genus_rank)
+        self.capitatus = Taxon.objects.create(name="capitatus", rank=species_rank, parent=self.acodontaster)
+        cheiraster = Taxon.objects.create(name="Cheiraster", rank=genus_rank)
+        self.luidiaster = Taxon.objects.create(name="Luidiaster", rank=subgenus_rank, parent=cheiraster)
+        self.gerlachei = Taxon.objects.create(name="gerlachei", rank=species_rank, parent=self.luidiaster)
+
+    def test_lookups(self):
+        taxonomy = get_taxonomy_snapshot()
+
+        self.assertEqual(taxonomy.species_named("Acodontaster capitatus"), self.capitatus)
+        self.assertEqual(taxonomy.species_named("Cheiraster (Luidiaster) gerlachei"), self.gerlachei)
+        self.assertEqual(taxonomy.genus_named("Acodontaster"), self.acodontaster)
+        self.assertEqual(taxonomy.subgenus_named("Cheiraster (Luidiaster)"), self.luidiaster)
+        self.assertIsNone(taxonomy.species_named("Acodontaster capitatis"))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(taxonomy.label(self.gerlachei.pk), str(self.gerlachei))
+            self.assertEqual(taxonomy.full_name(self.capitatus.pk), "Acodontaster capitatus")
+
+    def test_rebuilt_only_when_taxonomy_changes(self):
+        taxonomy = get_taxonomy_snapshot()
+        self.assertIs(get_taxonomy_snapshot(), taxonomy)
+
+        self.acodontaster.name = "Acodontasterr"
+        self.acodontaster.save()
+
+        new_taxonomy = get_taxonomy_snapshot()
+        self.assertIsNot(new_taxonomy, taxonomy)
+        self.assertEqual(new_taxonomy.species_named("Acodontasterr capitatus"), self.capitatus)
+
+    def test_bulk_changes_bump_version_once(self):
+        version = current_version()
+        with bulk_taxonomy_changes():
+            for name in ("a", "b", "c"):
+                Taxon.objects.create(name=name, rank=self.acodontaster.rank)
+            self.assertEqual(current_version(), version)
+        self.assertEqual(current_version(), version + 1)
+
+    def test_missing_version_row(self):
+        # E.g. after a flush (TransactionTestCase)
+        TaxonomyVersion.objects.all().delete()
+        self.assertEqual(current_version(), 0)
+        self.assertEqual(get_taxonomy_snapshot().genus_named("Acodontaster"), self.acodontaster)
+
+        self.acodontaster.save()  # Creates the row
+        self.assertEqual(current_version(), 1)
+
+
+class RankRegistryTestCase(TestCase):
+    def setUp(self):
+        self.genus_rank = TaxonRank.objects.create(name=GENUS_RANK_NAME)
+        self.species_rank = TaxonRank.objects.create(name=SPECIES_RANK_NAME)
+
+        self.acodontaster = Taxon.objects.create(name="Acodontaster", rank=self.genus_rank)
+        self.capitatus = Taxon.objects.create(name="capitatus", rank=self.species_rank, parent=self.acodontaster)
+
+    def test_predicates_and_managers_without_join(self):
+        TaxonRank.objects.id_for(SPECIES_RANK_NAME)  # Loads the registry
+
+        acodontaster = Taxon.objects.get(pk=self.acodontaster.pk)
+        with self.assertNumQueries(0):
+            self.assertTrue(acodontaster.is_genus())
+            self.assertFalse(acodontaster.is_species())
+            self.assertFalse(acodontaster.is_subgenus())
+
+        self.assertNotIn('JOIN', str(Taxon.species_objects.all().query))
+        self.assertEqual(list(Taxon.species_objects.all()), [self.capitatus])
+        self.assertEqual(list(Taxon.genus_objects.all()), [self.acodontaster])
+
+    def test_invalidated_when_ranks_change(self):
+        self.assertIsNone(TaxonRank.objects.id_for(SUBGENUS_RANK_NAME))
+
+        subgenus_rank = TaxonRank.objects.create(name=SUBGENUS_RANK_NAME)
+        self.assertEqual(TaxonRank.objects.id_for(SUBGENUS_RANK_NAME), subgenus_rank.pk)
+
+        subgenus_rank.delete()
+        self.assertIsNone(TaxonRank.objects.id_for(SUBGENUS_RANK_NAME))
+
+    def test_invalidated_by_other_processes(self):
+        self.assertEqual(TaxonRank.objects.id_for(GENUS_RANK_NAME), self.genus_rank.pk)
+
+        # Ranks recreated by another process (no signal here), which bumps the version
+        TaxonRank.objects.filter(pk=self.genus_rank.pk).update(name="Old genus")
+        new_genus_rank = TaxonRank.objects.create(name=GENUS_RANK_NAME)
+        TaxonRank.objects.set_cache([self.genus_rank, self.species_rank], current_version())  # Stale
+        TaxonomyVersion.objects.filter(pk=TaxonomyVersion.SINGLETON_PK).update(number=F('number') + 1)
+
+        self.assertEqual(TaxonRank.objects.id_for(GENUS_RANK_NAME), self.genus_rank.pk)  # Not checked yet
+        with patch('specimens.taxonomy.VERSION_CHECK_INTERVAL', 0):
+            self.assertEqual(TaxonRank.objects.id_for(GENUS_RANK_NAME), new_genus_rank.pk)
+
+
+class IsotopeStatsTestCase(SimpleTestCase):
+    def test_grouped_stats(self):
+        group_ids = np.array([1, 2, 1, 1, 2, 3])
+        values = np.array([[-20.0, 1.0],
+                           [-25.0, np.nan],
+                           [-22.0, 3.0],
+                           [-24.0, np.nan],
+                           [-21.0, np.nan],
+                           [np.nan, np.nan]])
+
+        groups, stats = grouped_stats(group_ids, values)
+
+        np.testing.assert_array_equal(groups, [1, 2, 3])
+        np.testing.assert_array_equal(stats['n'], [[3, 2], [2, 0], [0, 0]])
+        np.testing.assert_allclose(stats['mean'][:, 0], [-22.0, -23.0, np.nan])
+        np.testing.assert_allclose(stats['sd'][0], [2.0, np.sqrt(2)])
+        np.testing.assert_allclose(stats['median'][:, 0], [-22.0, -23.0, np.nan])
+        np.testing.assert_allclose(stats['q25'][0], [-23.0, 1.5])
+        np.testing.assert_allclose(stats['min'][:, 1], [1.0, np.nan, np.nan])
+        np.testing.assert_allclose(stats['max'][:, 0], [-20.0, -21.0, np.nan])
+
+    def test_grouped_stats_without_data(self):
+        groups, stats = grouped_stats(np.empty(0, dtype=np.int64), np.empty((0, 2)))
+        self.assertEqual(len(groups), 0)
+        self.assertEqual(stats['n'].shape, (0, 2))
+        self.assertEqual(stats['median'].shape, (0, 2))
+
+
+class ExportJobTestCase(TestCase):
+    def setUp(self):
+        self.exports_root = tempfile.mkdtemp()
+        for name in ("ANT XXVII/3 (CAMBIO)", "JR144", "PS77"):
+            Expedition.objects.create(name=name)
+        self.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def tearDown(self):
+        shutil.rmtree(self.exports_root)
+
+    def test_queue(self):
+        with override_settings(EXPORTS_ROOT=self.exports_root):
+            job = enqueue_export(Expedition.objects.exclude(name="JR144"), ['name'])
+            self.assertEqual(job.status, ExportJob.QUEUED)
+
+            claimed = claim_next_job()
+            self.assertEqual(claimed.pk, job.pk)
+            self.assertEqual(claimed.status, ExportJob.RUNNING)
+            self.assertIsNone(claim_next_job())  # Only claimed once
+
+            run_job(claimed, chunk_size=1)
+
+            job.refresh_from_db()
+            self.assertEqual(job.status, ExportJob.DONE, job.error)
+            self.assertEqual((job.rows_total, job.rows_done, job.progress()), (2, 2, 100))
+            with job.file.open('rb') as f:
+                rows = list(csv.reader(io.TextIOWrapper(f, encoding='utf-8')))
+            self.assertEqual(rows[0], ['name'])
+            self.assertCountEqual(rows[1:], [["ANT XXVII/3 (CAMBIO)"], ["PS77"]])
+
+    def test_failed_job(self):
+        job = enqueue_export(Expedition.objects.all(), ['no_such_field'])
+        run_job(claim_next_job())
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.FAILED)
+        self.assertIn('no_such_field', job.error)
+
+    def test_select_all_stores_changelist_params(self):
+        self.client.force_login(self.admin_user)
+        self.client.post(reverse('admin:specimens_expedition_changelist') + '?q=PS',
+                         {'action': 'export_csv_in_background', 'select_across': '1', 'index': 0,
+                          '_selected_action': list(Expedition.objects.values_list('pk', flat=True)[:1])})
+
+        job = ExportJob.objects.get()
+        self.assertEqual((job.filters, job.changelist_params), ({}, {'q': 'PS'}))
+        self.assertEqual(list(job_queryset(job).values_list('name', flat=True)), ["PS77"])
+
+    def test_actions_limited_to_specimens_models(self):
+        request = Mock(GET={}, user=self.admin_user)
+        self.assertIn('export_csv_in_background', admin.site._registry[Expedition].get_actions(request))
+        self.assertNotIn('export_csv_in_background', admin.site._registry[User].get_actions(request))
+
+    def test_download_only_by_requester(self):
+        with override_settings(EXPORTS_ROOT=self.exports_root):
+            enqueue_export(Expedition.objects.all(), ['name'], user=self.admin_user)
+            job = run_job(claim_next_job())
+            self.assertTrue(job.file.path.startswith(self.exports_root))  # Not in the public media
+
+            url = reverse('admin:specimens_exportjob_download', args=[job.pk])
+            self.client.force_login(self.admin_user)
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'JR144', b''.join(response.streaming_content))
+
+            other_user = User.objects.create_user('other', 'other@example.com', 'password', is_staff=True)
+            other_user.user_permissions.add(Permission.objects.get(codename='change_exportjob'))
+            self.client.force_login(other_user)
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_stale_jobs_requeued(self):
+        job = enqueue_export(Expedition.objects.all(), ['name'])
+        claim_next_job()
+        self.assertEqual(requeue_stale_jobs(), 0)  # Recent heartbeat
+
+        ExportJob.objects.filter(pk=job.pk).update(heartbeat_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(requeue_stale_jobs(), 1)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (ExportJob.QUEUED, 1))
+
+        # Killed its worker too many times
+        ExportJob.objects.filter(pk=job.pk).update(status=ExportJob.RUNNING, attempts=MAX_EXPORT_ATTEMPTS,
+                                                   heartbeat_at=timezone.now() - datetime.timedelta(hours=1))
+        self.assertEqual(requeue_stale_jobs(), 0)
+        job.refresh_from_db()
+        self.assertEqual(job.status, ExportJob.FAILED)
+
+    def test_requeued_job_result_not_recorded(self):
+        with override_settings(EXPORTS_ROOT=self.exports_root):
+            job = enqueue_export(Expedition.objects.all(), ['name'])
+            claimed = claim_next_job()
+            # Requeued as stale (e.g. a long count) then claimed again by another worker, before this one finishes
+            ExportJob.objects.filter(pk=job.pk).update(attempts=F('attempts') + 1)
+            run_job(claimed)
+
+            job.refresh_from_db()
+            self.assertEqual((job.status, job.file.name), (ExportJob.RUNNING, ''))
+            self.assertEqual(os.listdir(self.exports_root), [])
+
+
+class DenormalizedExportTestCase(TestCase):
+    def setUp(self):
+        invalidate_local_snapshot()
+
+        genus_rank = TaxonRank.objects.create(name=GENUS_RANK_NAME)
+        species_rank = TaxonRank.objects.create(name=SPECIES_RANK_NAME)
+        acodontaster = Taxon.objects.create(name="Acodontaster", rank=genus_rank)
+        capitatus = Taxon.objects.create(name="capitatus", rank=species_rank, parent=acodontaster)
+
+        camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        ulb = SpecimenLocation.objects.create(name="ULB")
+        self.cambio = Expedition.objects.create(name="ANT XXVII/3 (CAMBIO)")
+        self.jr144 = Expedition.objects.create(name="JR144")
+        cambio_station = Station.objects.create(name="PS77/239-3", expedition=self.cambio, coordinates=Point(-57, -62))
+        jr144_station = Station.objects.create(name="EBS", expedition=self.jr144)
+
+        for specimen_id, station in ((1, cambio_station), (2, cambio_station), (3, jr144_station)):
+            Specimen.objects.create(specimen_id=specimen_id, initial_scientific_name="Acodontaster capitatus",
+                                    taxon=capitatus, identified_by=camille, specimen_location=ulb, station=station,
+                                    vial=str(specimen_id))
+
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_batches(self):
+        batches = list(specimen_batches(batch_size=10))
+        self.assertEqual([expedition_id for expedition_id, _ in batches], [self.cambio.pk, self.jr144.pk])
+
+        columns = dict(zip(COLUMN_NAMES, batches[0][1]))
+        self.assertEqual(columns['specimen_id'], [1, 2])
+        self.assertEqual(columns['longitude'], [-57, -57])
+        self.assertEqual(columns['genus'], ["Acodontaster", "Acodontaster"])
+        self.assertEqual(columns['scientific_name'], ["Acodontaster capitatus", "Acodontaster capitatus"])
+
+    def test_csv_export(self):
+        self.assertEqual(export_specimens(self.directory, format=CSV_GZ, batch_size=1), 3)
+
+        path = os.path.join(self.directory, 'expedition_id={pk}'.format(pk=self.cambio.pk), 'part-0.csv.gz')
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            rows = list(csv.DictReader(f))
+        self.assertEqual([row['specimen_id'] for row in rows], ['1', '2'])
+        self.assertEqual(rows[0]['expedition'], "ANT XXVII/3 (CAMBIO)")
+
+
+class FastaTestCase(TestCase):
+    def setUp(self):
+        camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        ulb = SpecimenLocation.objects.create(name="ULB")
+        self.cambio = Expedition.objects.create(name="ANT XXVII/3 (CAMBIO)")
+        station = Station.objects.create(name="PS77/239-3", expedition=self.cambio)
+        jr144_station = Station.objects.create(name="EBS", expedition=Expedition.objects.create(name="JR144"))
+
+        def specimen(specimen_id, station=station, **kwargs):
+            return Specimen.objects.create(specimen_id=specimen_id, initial_scientific_name="Odontaster validus",
+                                           identified_by=camille, specimen_location=ulb, station=station, **kwargs)
+
+        self.named = specimen(1, sequence_name="ODO_1")
+        self.bold = specimen(2, bold_process_id="ANTAR002-10")
+        self.other = specimen(3, station=jr144_station, sequence_name="ODO_3")
+        specimen(4, bold_sample_id="DUP")
+        specimen(5, bold_sample_id="DUP")
+
+        self.directory = tempfile.mkdtemp()
+        self.fasta_path = os.path.join(self.directory, 'sequences.fasta')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def import_fasta(self, content, *args):
+        with open(self.fasta_path, 'w') as f:
+            f.write(content)
+        call_command('import_fasta', self.fasta_path, *args, stdout=io.StringIO())
+
+    def test_import(self):
+        self.import_fasta(">ODO_1 Odontaster validus\nACGT\nACGT\n"
+                          ">ANTAR002-10|Odontaster validus|COI-5P\n" + "TTGA" * 20 + "\n"
+                          ">UNKNOWN\nACGT\n"
+                          ">DUP\nACGT\n"
+                          ">ODO_1 again\nGGGG\n", '--chunk-size', '2', '--name-sequences')
+
+        self.assertEqual(SpecimenSequence.objects.count(), 2)
+        self.assertEqual(Specimen.objects.get(pk=self.named.pk).sequence_fasta, ">ODO_1 Odontaster validus\nACGTACGT\n")
+        bold = Specimen.objects.get(pk=self.bold.pk)
+        self.assertEqual(bold.sequence_fasta.splitlines()[1:], ["TTGA" * 15, "TTGA" * 5])
+        self.assertEqual(bold.sequence_name, "ANTAR002-10")
+
+        # Replaced on the next import
+        self.import_fasta(">ODO_1\nCCCC\n")
+        self.assertEqual(Specimen.objects.get(pk=self.named.pk).sequence_fasta, ">ODO_1\nCCCC\n")
+
+    def test_import_problems(self):
+        with open(self.fasta_path, 'w') as f:
+            f.write(">UNKNOWN\nACGT\n>DUP\nACGT\n>ODO_3\n\n>ODO_1\nA\n>ODO_1\nC\n")
+        with open(self.fasta_path) as f:
+            stored_count, problems = import_sequences(read_fasta(f))
+
+        self.assertEqual(stored_count, 1)
+        self.assertEqual([problem.message for problem in problems],
+                         ['No specimen with this sequence name or BOLD ID',
+                          'Several specimens have this BOLD sample ID',
+                          'Empty sequence',
+                          'Specimen already has a sequence in this file'])
+
+    def test_export(self):
+        self.named.sequence_fasta = ">ODO_1\nACGT\n"
+        self.named.save()
+        self.other.sequence_fasta = "ACGT\nTTGA"  # Pasted without header
+        self.other.save()
+        export_path = os.path.join(self.directory, 'export.fasta')
+
+        call_command('export_fasta', export_path, stdout=io.StringIO())
+        with open(export_path) as f:
+            self.assertEqual(list(read_fasta(f)), [("ODO_1", "ACGT"), ("ODO_3", "ACGTTTGA")])
+
+        call_command('export_fasta', export_path, '--filter', 'station__expedition__name=JR144',
+                     stdout=io.StringIO())
+        with open(export_path) as f:
+            self.assertEqual(f.read(), ">ODO_3\nACGTTTGA\n")
+
+        with self.assertRaises(CommandError):
+            call_command('export_fasta', export_path, '--filter', 'unknown_field=1', stdout=io.StringIO())
+
+
+class XlsxSourceTestCase(SimpleTestCase):
+    def setUp(self):
+        workbook = Workbook()
+        worksheet = workbook.active
+        worksheet.append(["Specimen_id", "Date", "Latitude"])
+        worksheet.append([12.0, datetime.date(2016, 1, 12), -62.5])
+        worksheet.append([None, None, None])
+        worksheet.append([13, "2016-01"])
+        worksheet.append([14, datetime.datetime(2018, 3, 5)])
+
+        f, self.path = tempfile.mkstemp(suffix='.xlsx')
+        os.close(f)
+        workbook.save(self.path)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_rows_like_csv(self):
+        with source_rows(self.path) as rows:
+            rows = list(rows)
+
+        self.assertEqual(rows, [
+            {"Specimen_id": "12", "Date": "12-01-2016", "Latitude": "-62.5"},
+            {"Specimen_id": "13", "Date": "2016-01", "Latitude": ""},  # Blank row skipped, missing cells padded
+            {"Specimen_id": "14", "Date": "05-03-2018", "Latitude": ""},
+        ])
+
+        # Four-digit years are not interpreted like two-digit ones (18 is 1918)
+        importer = ImportSpecimensCommand(stdout=io.StringIO())
+        self.assertEqual(importer.interpret_dates_and_year('', rows[2]["Date"]),
+                         (datetime.date(2018, 3, 5), datetime.date(2018, 3, 5)))
+        self.assertEqual(importer.interpret_capture_date("05-03-18"), (1918, 3, 5))
+
+
+@override_settings(DISABLE_VIAL_UNIQUENESS_VALIDATION=True)
+class DuplicatesTestCase(TestCase):
+    def setUp(self):
+        camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        ulb = SpecimenLocation.objects.create(name="ULB")
+        expedition = Expedition.objects.create(name="ANT XXVII/3 (CAMBIO)")
+        station = Station.objects.create(name="PS77/239-3", expedition=expedition)
+        other_station = Station.objects.create(name="PS77/240-1", expedition=expedition)
+
+        for specimen_id, vial, specimen_station, name in ((1, "100", station, "Odontaster validus"),
+                                                          (2, " 100", station, "odontaster  Validus"),
+                                                          (3, "100", station, "Odontaster validuss"),  # Typo
+                                                          (4, "100", other_station, "Odontaster validus"),
+                                                          (5, "", station, "Odontaster validus"),
+                                                          (6, "", station, "Odontaster validus"),
+                                                          (7, "101", station, "Sterechinus neumayeri"),
+                                                          (8, "101", station, "Sterechinus neumayeri")):
+            Specimen.objects.create(specimen_id=specimen_id, initial_scientific_name=name, identified_by=camille,
+                                    specimen_location=ulb, station=specimen_station, vial=vial)
+
+    def test_exact(self):
+        with self.assertNumQueries(1):
+            groups = find_duplicates()
+        self.assertEqual([group.specimen_ids for group in groups], [[1, 2], [7, 8]])
+
+        # The same fingerprint as computed in Python
+        self.assertEqual(groups[1].fingerprint,
+                         duplicate_fingerprint(["101", str(Station.objects.get(name="PS77/239-3").pk),
+                                                "sterechinus neumayeri"]))
+
+        self.assertEqual([group.specimen_ids for group in find_duplicates(['vial'])], [[1, 2, 3, 4], [7, 8]])
+        with self.assertRaises(ValueError):
+            find_duplicates(['vial', 'unknown'])
+
+    def test_near(self):
+        groups = find_near_duplicates()
+        self.assertEqual([group.specimen_ids for group in groups], [[1, 2, 3], [7, 8]])
+        self.assertEqual([group.specimen_ids for group in find_near_duplicates(max_distance=0)], [[1, 2], [7, 8]])
+
+        with self.assertRaises(ValueError):
+            find_near_duplicates(['initial_scientific_name'], ['initial_scientific_name'])
+
+    def test_command(self):
+        directory = tempfile.mkdtemp()
+        try:
+            report_path = os.path.join(directory, 'duplicates.csv')
+            call_command('find_duplicates', report_path, '--fuzzy', stdout=io.StringIO())
+            with open(report_path) as f:
+                rows = list(csv.DictReader(f))
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertEqual([(row['group'], row['specimen_id']) for row in rows],
+                         [('1', '1'), ('1', '2'), ('1', '3'), ('2', '7'), ('2', '8')])
+        self.assertEqual(rows[2]['initial_scientific_name'], "Odontaster validuss")
+        self.assertEqual(rows[0]['station__name'], "PS77/239-3")
+
+
+SPECIMENS_FILE_HEADER = ['Specimen_id', 'Scientific_name', 'Identified_by', 'Specimen_location', 'Vial_nb', 'Vial Size',
+                         'Numero_mnhn', 'MNA_code', 'BOLD Process ID', 'BOLD Sample ID', 'BOLD BIN', 'Expedition',
+                         'Station', 'Latitude', 'Longitude', 'Depth', 'Year', 'Date', 'Fixation', 'Region', 'Comment']
+
+
+@override_settings(EXPECTED_NUMBER_COLS_SPECIMEN=len(SPECIMENS_FILE_HEADER))
+class ValidateSpecimensTestCase(TestCase):
+    def setUp(self):
+        camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        ulb = SpecimenLocation.objects.create(name="ULB")
+        cambio = Expedition.objects.create(name="ANT XXVII/3 (CAMBIO)")
+        station = Station.objects.create(name="PS77/239-3", expedition=cambio)
+        Specimen.objects.create(specimen_id=100, initial_scientific_name="Acodontaster capitatus", identified_by=camille,
+                                specimen_location=ulb, station=station, vial="V1", mnhn_number="MNHN-1")
+
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'specimens.csv')
+        self.report_path = os.path.join(self.directory, 'report.csv')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_rows(self, rows):
+        with open(self.path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=SPECIMENS_FILE_HEADER, restval='')
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def problems(self):
+        with open(self.report_path) as f:
+            return [(int(row['line']), row['column']) for row in csv.DictReader(f)]
+
+    def test_valid_file(self):
+        self.write_rows([{'Specimen_id': '1', 'Identified_by': 'Camille Moreau', 'Expedition': 'JR144', 'Vial_nb': 'V1',
+                          'Latitude': '-62,5', 'Longitude': '-57', 'Depth': '100-200', 'Date': '12-01-16'}])
+        call_command('validate_specimens', self.path, report=self.report_path, verbosity=0)
+        self.assertEqual(self.problems(), [])
+
+    def test_all_problems_reported(self):
+        self.write_rows([
+            {'Specimen_id': '1', 'Identified_by': 'Camille Moreau', 'Year': '2015', 'Date': '12-01-16'},
+            {'Specimen_id': '1', 'Identified_by': 'Camille', 'Latitude': '-62'},
+            {'Specimen_id': '100', 'Identified_by': 'Camille Moreau', 'Expedition': 'ANT XXVII/3 (CAMBIO)',
+             'Vial_nb': 'V1', 'Numero_mnhn': 'MNHN-1', 'Depth': '300-200'},
+        ])
+
+        with self.assertRaises(CommandError):
+            call_command('validate_specimens', self.path, report=self.report_path, verbosity=0)
+
+        self.assertCountEqual(self.problems(), [
+            (2, 'Year/Date'),
+            (3, 'Specimen_id'), (3, 'Identified_by'), (3, 'Latitude/Longitude'),
+            (4, 'Depth'), (4, 'Specimen_id'), (4, 'Vial_nb'), (4, 'Numero_mnhn'),
+        ])
+
+        # With --truncate, the database content doesn't matter
+        with self.assertRaises(CommandError):
+            call_command('validate_specimens', self.path, report=self.report_path, truncate=True, verbosity=0)
+        self.assertNotIn((4, 'Vial_nb'), self.problems())
+
+
+class FullImportTestCase(TransactionTestCase):
+    # Not in a transaction: the import commits the truncation and each stage separately
+
+    def setUp(self):
+        camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        station = Station.objects.create(name="PS77", expedition=Expedition.objects.create(name="CAMBIO"))
+        self.odontaster = Taxon.objects.create(name="Odontaster", rank=TaxonRank.objects.create(name=GENUS_RANK_NAME))
+        self.specimen = Specimen.objects.create(specimen_id=1, initial_scientific_name="Odontaster sp",
+                                                identified_by=camille, station=station, taxon=self.odontaster,
+                                                specimen_location=SpecimenLocation.objects.create(name="ULB"))
+
+    def test_plan_waves(self):
+        stages = [Stage('reconcile', depends_on=['specimens', 'taxonomy']), Stage('specimens'), Stage('taxonomy'),
+                  Stage('bioregions', depends_on=['reconcile'])]
+        self.assertEqual([[stage.name for stage in wave] for wave in plan_waves(stages)],
+                         [['specimens', 'taxonomy'], ['reconcile'], ['bioregions']])
+
+        with self.assertRaisesMessage(CommandError, 'a, b'):
+            plan_waves([Stage('a', depends_on=['b']), Stage('b', depends_on=['a'])])
+        with self.assertRaises(CommandError):
+            plan_waves([Stage('a', depends_on=['missing'])])
+
+    def assertDataRestored(self):
+        self.assertEqual(Specimen.objects.get().taxon, self.odontaster)
+        self.assertEqual(Taxon.objects.get().name, "Odontaster")
+        self.assertEqual(Station.objects.count(), 1)
+        with connection.cursor() as cursor:
+            self.assertFalse(TableBackup(cascaded_models([Taxon, Station])).exists(cursor))
+
+    def test_failed_stage_restores_data(self):
+        # The specimens import fails (in its own process), the taxonomy import is rolled back
+        with self.assertRaisesMessage(CommandError, 'import_specimens failed'):
+            call_command('full_import', '/nonexistent/specimens.csv', '/nonexistent/taxonomy.csv',
+                         stdout=io.StringIO())
+        self.assertDataRestored()
+
+    def test_failed_later_wave_restores_data(self):
+        since = Specimen.objects.get().updated_at
+        # The first wave committed (here, nothing), then reconcile_taxonomy fails
+        with patch.object(FullImportCommand, 'run_wave', side_effect=[None, StageFailed('reconcile failed')]):
+            with self.assertRaisesMessage(CommandError, 'reconcile failed'):
+                call_command('full_import', 'specimens.csv', 'taxonomy.csv', stdout=io.StringIO())
+        self.assertDataRestored()
+
+        # Fed as a reset followed by the (restored) objects, not as deletions
+        self.assertFalse(Tombstone.objects.exists())
+        changes = [(change.action, change.model) for change in changes_since(since)]
+        self.assertEqual(changes[0], (RESET, None))
+        self.assertCountEqual(changes[1:], [(UPSERT, 'specimens.taxon'), (UPSERT, 'specimens.station'),
+                                            (UPSERT, 'specimens.specimen')])
+
+
+class BulkSpecimenActionsTestCase(TestCase):
+    def setUp(self):
+        invalidate_local_snapshot()
+
+        genus_rank = TaxonRank.objects.create(name=GENUS_RANK_NAME)
+        species_rank = TaxonRank.objects.create(name=SPECIES_RANK_NAME)
+        self.acodontaster = Taxon.objects.create(name="Acodontaster", rank=genus_rank)
+        self.capitatus = Taxon.objects.create(name="capitatus", rank=species_rank, parent=self.acodontaster)
+
+        camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        ulb = SpecimenLocation.objects.create(name="ULB")
+        station = Station.objects.create(name="PS77/239-3", expedition=Expedition.objects.create(name="JR144"))
+        for specimen_id, name in ((1, "Acodontaster capitatus"), (2, "Acodontaster cf capitatus"),
+                                  (3, "Acodontaster sp"), (4, "Unknown thing")):
+            Specimen.objects.create(specimen_id=specimen_id, initial_scientific_name=name, identified_by=camille,
+                                    specimen_location=ulb, station=station)
+
+        self.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def taxa_and_uncertainty(self):
+        return {s.specimen_id: (s.taxon_id, s.uncertain_identification) for s in Specimen.objects.all()}
+
+    def test_match_name(self):
+        taxonomy = get_taxonomy_snapshot()
+        self.assertEqual(match_name(taxonomy, "Acodontaster sp.").taxon, self.acodontaster)
+        self.assertTrue(match_name(taxonomy, "Acodontaster cf. capitatus").uncertain)
+        self.assertTrue(match_name(taxonomy, "Undet").undet)
+        self.assertIsNone(match_name(taxonomy, "Acodontaster capitatis").taxon)
+
+    def test_reconcile_specimens(self):
+        taxonomy = get_taxonomy_snapshot()
+        with self.assertNumQueries(5):  # Names, savepoint (2), one update per distinct result (2)
+            self.assertEqual(reconcile_specimens(Specimen.objects.exclude(specimen_id=1), taxonomy), 2)
+
+        self.assertEqual(self.taxa_and_uncertainty(), {1: (None, False),
+                                                       2: (self.capitatus.pk, True),
+                                                       3: (self.acodontaster.pk, False),
+                                                       4: (None, False)})
+
+    def test_fuzzy_reconciliation_keeps_uncertainty(self):
+        Specimen.objects.filter(specimen_id=4).update(initial_scientific_name="Acodontaster capitatis",
+                                                      uncertain_identification=True)
+        call_command('reconcile_taxonomy', '--all', '--apply-fuzzy', stdout=io.StringIO(), stderr=io.StringIO())
+        self.assertEqual(self.taxa_and_uncertainty()[4], (self.capitatus.pk, True))
+
+    def test_assign_taxon_action(self):
+        self.client.force_login(self.admin_user)
+        url = reverse('admin:specimens_specimen_changelist')
+        selected = [s.pk for s in Specimen.objects.filter(specimen_id__in=[1, 2])]
+
+        # Intermediate page
+        response = self.client.post(url, {'action': 'assign_taxon', '_selected_action': selected, 'index': 0})
+        self.assertContains(response, 'Assign taxon')
+
+        response = self.client.post(url, {'action': 'assign_taxon', '_selected_action': selected, 'apply': 'yes',
+                                          'taxon': self.capitatus.pk, 'uncertain_identification': '2'})  # Yes
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.taxa_and_uncertainty(), {1: (self.capitatus.pk, True),
+                                                       2: (self.capitatus.pk, True),
+                                                       3: (None, False),
+                                                       4: (None, False)})
+
+
+class TaxonTreeAdminTestCase(TestCase):
+    def setUp(self):
+        family_rank = TaxonRank.objects.create(name=FAMILY_RANK_NAME)
+        genus_rank = TaxonRank.objects.create(name=GENUS_RANK_NAME)
+        species_rank = TaxonRank.objects.create(name=SPECIES_RANK_NAME)
+
+        self.acanthasteridae = Taxon.objects.create(name="Acanthasteridae", rank=family_rank)
+        self.odontasteridae = Taxon.objects.create(name="Odontasteridae", rank=family_rank)
+        self.acodontaster = Taxon.objects.create(name="Acodontaster", rank=genus_rank, parent=self.odontasteridae)
+        self.capitatus = Taxon.objects.create(name="capitatus", rank=species_rank, parent=self.acodontaster)
+
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+    def test_children(self):
+        TaxonRank.objects.id_for(GENUS_RANK_NAME)  # Loads the rank registry
+
+        with self.assertNumQueries(3):  # Session, user, children
+            response = self.client.get(reverse('admin:specimens_taxon_tree_children'))
+        self.assertEqual([(n['name'], n['descendants_count']) for n in response.json()['nodes']],
+                         [("Acanthasteridae", 0), ("Odontasteridae", 2)])
+
+        response = self.client.get(reverse('admin:specimens_taxon_tree_children'), {'parent': self.acodontaster.pk})
+        self.assertEqual([n['id'] for n in response.json()['nodes']], [self.capitatus.pk])
+
+    def test_search_with_ancestors(self):
+        response = self.client.get(reverse('admin:specimens_taxon_tree_search'), {'q': 'capit'})
+        results = response.json()['results']
+
+        self.assertEqual(len(results), 1)
+        self.assertEqual([a['name'] for a in results[0]['ancestors']], ["Odontasteridae", "Acodontaster"])
+
+    def test_move(self):
+        response = self.client.post(reverse('admin:specimens_taxon_tree_move'),
+                                    {'node': self.acodontaster.pk, 'target': self.acanthasteridae.pk})
+        self.assertEqual(response.status_code, 200)
+        self.acodontaster.refresh_from_db()
+        self.assertEqual(self.acodontaster.parent, self.acanthasteridae)
+
+        # Into its own subtree
+        response = self.client.post(reverse('admin:specimens_taxon_tree_move'),
+                                    {'node': self.acodontaster.pk, 'target': self.capitatus.pk})
+        self.assertEqual(response.status_code, 400)
+
+    def test_autocomplete_labels_without_n_plus_one(self):
+        TaxonRank.objects.id_for(GENUS_RANK_NAME)  # Loads the rank registry
+        for name in ("antarcticus", "conspicuus", "elongatus"):
+            Taxon.objects.create(name=name, rank=self.capitatus.rank, parent=self.acodontaster)
+
+        with self.assertNumQueries(4):  # Session, user, count, page
+            response = self.client.get(reverse('admin:specimens_taxon_autocomplete'), {'term': 'a'})
+        self.assertIn("Acodontaster antarcticus [Species]", [r['text'] for r in response.json()['results']])
+
+    def test_large_subtrees_not_moved(self):
+        with patch.object(TaxonAdmin, 'MAX_MOVED_SUBTREE_SIZE', 1):
+            response = self.client.post(reverse('admin:specimens_taxon_tree_move'),
+                                        {'node': self.acodontaster.pk, 'target': self.acanthasteridae.pk})
+        self.assertEqual(response.status_code, 400)
+        self.acodontaster.refresh_from_db()
+        self.assertEqual(self.acodontaster.parent, self.odontasteridae)
+
+
+class SpecimenSearchTestCase(TestCase):
+    def setUp(self):
+        genus_rank = TaxonRank.objects.create(name=GENUS_RANK_NAME)
+        species_rank = TaxonRank.objects.create(name=SPECIES_RANK_NAME)
+        self.acodontaster = Taxon.objects.create(name="Acodontaster", rank=genus_rank)
+        capitatus = Taxon.objects.create(name="capitatus", rank=species_rank, parent=self.acodontaster)
+
+        camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        ulb = SpecimenLocation.objects.create(name="ULB")
+        self.expedition = Expedition.objects.create(name="CAMBIO")
+        self.station = Station.objects.create(name="PS77", expedition=self.expedition)
+
+        self.specimen1 = Specimen.objects.create(specimen_id=1, initial_scientific_name="Acodontaster sp",
+                                                 taxon=capitatus, identified_by=camille, specimen_location=ulb,
+                                                 station=self.station, bold_bin="BOLD:AAB1234",
+                                                 comment="Damaged arm")
+        self.specimen2 = Specimen.objects.create(specimen_id=2, initial_scientific_name="Odontaster validus",
+                                                 identified_by=camille, specimen_location=ulb, station=self.station,
+                                                 comment="Acodontaster according to the label")
+
+    def search(self, terms):
+        return list(Specimen.objects.search(terms).values_list('specimen_id', flat=True))
+
+    def test_search(self):
+        self.assertEqual(self.search("damaged"), [1])
+        self.assertEqual(self.search("BOLD:AAB1234"), [1])
+        self.assertEqual(self.search("capitatus"), [1])  # Through the taxon
+        self.assertEqual(self.search("cambio ps77"), [1, 2])
+        self.assertEqual(self.search("acodontaster"), [1, 2])  # Name is more relevant than comment
+
+    def test_related_changes(self):
+        self.station.name = "PS81"
+        self.station.save()
+        self.expedition.name = "JR144"
+        self.expedition.save()
+        self.acodontaster.name = "Acodontasterr"
+        self.acodontaster.save()
+
+        self.assertEqual(self.search("ps81 jr144"), [1, 2])
+        self.assertEqual(self.search("acodontasterr"), [1])
+
+        # Bulk updates too
+        Specimen.objects.filter(pk=self.specimen2.pk).update(comment="Regenerating")
+        self.assertEqual(self.search("regenerating"), [2])
+
+    def test_admin_search(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(reverse('admin:specimens_specimen_changelist'), {'q': 'damaged'})
+        self.assertEqual([s.specimen_id for s in response.context['cl'].result_list], [1])
+
+    def test_admin_autocomplete(self):
+        # Prefixes of the specimen ID, not the full-text search
+        Specimen.objects.create(specimen_id=12, initial_scientific_name="Odontaster validus",
+                                identified_by=self.specimen2.identified_by,
+                                specimen_location=self.specimen2.specimen_location, station=self.station)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(reverse('admin:specimens_specimen_autocomplete'), {'term': '1'})
+        self.assertCountEqual([result['text'] for result in response.json()['results']],
+                              ["Specimen #1", "Specimen #12"])
+
+
+class ChangesFeedTestCase(TransactionTestCase):
+    # Not in a transaction: timestamps are the start time of the writing transaction
+
+    def setUp(self):
+        camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        ulb = SpecimenLocation.objects.create(name="ULB")
+        self.station = Station.objects.create(name="PS77", expedition=Expedition.objects.create(name="CAMBIO"))
+        self.specimen1 = Specimen.objects.create(specimen_id=1, initial_scientific_name="Acodontaster sp",
+                                                 identified_by=camille, specimen_location=ulb, station=self.station)
+        self.specimen2 = Specimen.objects.create(specimen_id=2, initial_scientific_name="Odontaster validus",
+                                                 identified_by=camille, specimen_location=ulb, station=self.station)
+
+    def last_update(self):
+        return max(model.objects.aggregate(last=Max('updated_at'))['last'] for model in (Station, Specimen))
+
+    def changes(self, since):
+        return [(change.model, change.action, change.pk) for change in changes_since(since)]
+
+    def test_bulk_updates(self):
+        since = self.last_update()
+        created_at = Specimen.objects.get(pk=self.specimen2.pk).created_at
+        self.assertEqual(self.changes(since), [])
+
+        Specimen.objects.filter(pk=self.specimen2.pk).update(vial="200")
+        Specimen.objects.filter(pk=self.specimen1.pk).update(vial="")  # Unchanged
+        self.assertEqual(self.changes(since), [('specimens.specimen', UPSERT, self.specimen2.pk)])
+        self.assertEqual(Specimen.objects.get(pk=self.specimen2.pk).created_at, created_at)
+
+    def test_deletions(self):
+        since = self.last_update()
+        self.station.delete()  # And its specimens
+
+        changes = self.changes(since)
+        self.assertEqual(changes[0], ('specimens.station', DELETE, self.station.pk))
+        self.assertCountEqual(changes[1:], [('specimens.specimen', DELETE, self.specimen1.pk),
+                                            ('specimens.specimen', DELETE, self.specimen2.pk)])
+
+    def test_sequences(self):
+        since = self.last_update()
+        fasta = ">COI_1\nACGT"
+        SpecimenSequence.objects.create(specimen=self.specimen1, compressed_fasta=SpecimenSequence.compress(fasta))
+        changes = list(changes_since(since))
+        self.assertEqual([(change.model, change.pk) for change in changes], [('specimens.specimen', self.specimen1.pk)])
+        self.assertEqual(changes[0].data['sequence_fasta'], fasta)
+
+        since = changes[0].timestamp
+        SpecimenSequence.objects.filter(specimen=self.specimen1).delete()
+        changes = list(changes_since(since))
+        self.assertEqual([(change.model, change.pk) for change in changes], [('specimens.specimen', self.specimen1.pk)])
+        self.assertEqual(changes[0].data['sequence_fasta'], '')
+
+    def test_imported_sequences(self):
+        Specimen.objects.filter(pk=self.specimen2.pk).update(sequence_name="ODO_2")
+        since = self.last_update()
+        self.assertEqual(import_sequences([FastaRecord("ODO_2", "ACGT")])[0], 1)
+
+        changes = list(changes_since(since))
+        self.assertEqual([(change.model, change.pk) for change in changes], [('specimens.specimen', self.specimen2.pk)])
+        self.assertEqual(changes[0].data['sequence_fasta'], ">ODO_2\nACGT\n")
+
+    def test_export_command(self):
+        since = self.last_update()
+        Station.objects.filter(pk=self.station.pk).update(coordinates=Point(2.35, -66.5))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'changes.jsonl')
+            stdout, stderr = io.StringIO(), io.StringIO()
+            call_command('export_changes', since.isoformat(), path, stdout=stdout, stderr=stderr)
+            with open(path) as f:
+                changes = [json.loads(line) for line in f]
+
+        # The JSON summary doesn't mix with the output of the command
+        self.assertIn('Summary for export_changes', stderr.getvalue())
+        self.assertNotIn('Summary for', stdout.getvalue())
+        self.assertEqual(len(changes), 1)
+        self.assertEqual(changes[0]['model'], 'specimens.station')
+        self.assertEqual(changes[0]['data']['coordinates']['coordinates'], [2.35, -66.5])
+
+    def test_export_command_full(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'changes.jsonl')
+            too_old = timezone.now() - TOMBSTONE_RETENTION - datetime.timedelta(days=1)
+            with self.assertRaisesMessage(CommandError, '--full'):
+                call_command('export_changes', too_old.isoformat(), path, stdout=io.StringIO())
+
+            call_command('export_changes', path, full=True, stdout=io.StringIO())
+            with open(path) as f:
+                changes = [json.loads(line) for line in f]
+
+        self.assertEqual(changes[0]['action'], RESET)
+        self.assertEqual(len(changes), 4)  # The station and its two specimens
+
+    def test_purge_tombstones(self):
+        self.specimen1.delete()
+        self.assertEqual(purge_tombstones(), 0)  # Recent
+        self.assertEqual(purge_tombstones(before=timezone.now() + datetime.timedelta(seconds=1)), 1)
+        self.assertFalse(Tombstone.objects.exists())
+
+    def test_tables_reload(self):
+        since = self.last_update()
+        with tables_reload():
+            Specimen.objects.all().delete()
+            self.station.delete()
+            reloaded = Station.objects.create(name="PS78", expedition=self.station.expedition)
+            removed = Station.objects.create(name="PS79", expedition=self.station.expedition)
+        removed_pk = removed.pk
+        removed.delete()  # After the reload: recorded again
+
+        self.assertFalse(Tombstone.objects.exclude(object_id=removed_pk).exists())
+        self.assertEqual(self.changes(since), [(None, RESET, None), ('specimens.station', UPSERT, reloaded.pk),
+                                               ('specimens.station', DELETE, removed_pk)])
+
+    def test_tables_reload_in_transaction(self):
+        # The deletions after the block are recorded, even in the same transaction
+        with transaction.atomic():
+            with tables_reload():
+                self.specimen1.delete()
+            self.specimen2.delete()
+        self.assertEqual(list(Tombstone.objects.values_list('model', flat=True)), ['specimens.specimen'])
+
+
+class StationQueriesTestCase(TestCase):
+    def setUp(self):
+        expedition = Expedition.objects.create(name="CAMBIO")
+
+        def station(name, start, end, depth):
+            return Station.objects.create(name=name, expedition=expedition, capture_date_start=start,
+                                          capture_date_end=end, depth=depth)
+
+        self.shelf_2008 = station("ST1", datetime.date(2008, 12, 28), datetime.date(2009, 1, 3),
+                                  NumericRange(150, 250, '[]'))
+        self.slope_2010 = station("ST2", datetime.date(2010, 2, 10), datetime.date(2010, 2, 10),
+                                  NumericRange(700, 900, '[]'))
+        self.abyss_2015 = station("ST3", datetime.date(2015, 7, 1), datetime.date(2015, 7, 2),
+                                  NumericRange(3000, 3000, '[]'))
+        self.unknown = station("ST4", None, None, None)
+
+    def assertStations(self, queryset, expected):
+        self.assertCountEqual(list(queryset), expected)
+
+    def test_dates(self):
+        self.assertStations(Station.objects.captured_between(datetime.date(2009, 1, 1), datetime.date(2010, 12, 31)),
+                            [self.shelf_2008, self.slope_2010])
+        self.assertStations(Station.objects.captured_in_season('summer'), [self.shelf_2008, self.slope_2010])
+        self.assertStations(Station.objects.captured_in_season('winter'), [self.abyss_2015])
+
+    def test_depth(self):
+        self.assertStations(Station.objects.depth_overlaps(200, 1000), [self.shelf_2008, self.slope_2010])
+        self.assertStations(Station.objects.depth_within(200, 1000), [self.slope_2010])
+        self.assertStations(Station.objects.depth_overlaps(2000, None), [self.abyss_2015])
+
+    def test_combined_with_specimens(self):
+        camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        ulb = SpecimenLocation.objects.create(name="ULB")
+        for specimen_id, station in enumerate([self.shelf_2008, self.slope_2010, self.abyss_2015, self.unknown]):
+            Specimen.objects.create(specimen_id=specimen_id, initial_scientific_name="Acodontaster sp",
+                                    identified_by=camille, specimen_location=ulb, station=station)
+
+        # Captured between 600 and 1200m during austral summers 2008-2012
+        stations = (Station.objects.captured_between(datetime.date(2008, 1, 1), datetime.date(2012, 12, 31))
+                                   .captured_in_season('summer')
+                                   .depth_overlaps(600, 1200))
+        self.assertEqual(list(Specimen.objects.filter(station__in=stations).values_list('specimen_id', flat=True)),
+                         [1])
+
+    def test_admin_filters(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        response = self.client.get(reverse('admin:specimens_station_changelist'),
+                                   {'capture_season': 'summer', 'depth': '0'})
+        self.assertStations(response.context['cl'].result_list, [self.shelf_2008])
+
+
+class BioregionAssignmentTestCase(TestCase):
+    BOUNDARIES = {
+        'type': 'FeatureCollection',
+        'features': [
+            {'type': 'Feature', 'properties': {'name': 'Weddell Sea'},
+             'geometry': {'type': 'Polygon', 'coordinates': [[[-60, -80], [0, -80], [0, -60], [-60, -60], [-60, -80]]]}},
+            # Inside the Weddell Sea
+            {'type': 'Feature', 'properties': {'name': 'Filchner Trough'},
+             'geometry': {'type': 'Polygon', 'coordinates': [[[-40, -78], [-30, -78], [-30, -74], [-40, -74],
+                                                              [-40, -78]]]}},
+        ]
+    }
+
+    def setUp(self):
+        camille = Person.objects.create(first_name="Camille", last_name="Moreau")
+        ulb = SpecimenLocation.objects.create(name="ULB")
+        expedition = Expedition.objects.create(name="CAMBIO")
+        self.typed_region = Bioregion.objects.create(name="Weddell Sea")  # From the Region column
+
+        def specimen(specimen_id, coordinates):
+            station = Station.objects.create(name="ST{i}".format(i=specimen_id), expedition=expedition,
+                                             coordinates=coordinates)
+            return Specimen.objects.create(specimen_id=specimen_id, initial_scientific_name="Acodontaster sp",
+                                           identified_by=camille, specimen_location=ulb, station=station,
+                                           bioregion=self.typed_region)
+
+        self.weddell = specimen(1, Point(-10, -70))
+        self.filchner = specimen(2, Point(-35, -76))
+        self.outside = specimen(3, Point(150, -66))
+
+        with tempfile.NamedTemporaryFile('w', suffix='.geojson', delete=False) as f:
+            json.dump(self.BOUNDARIES, f)
+        self.addCleanup(os.remove, f.name)
+        self.boundaries_path = f.name
+
+    def bioregion_names(self):
+        return dict(Specimen.objects.values_list('specimen_id', 'bioregion__name'))
+
+    def test_load_and_assign(self):
+        boundaries = read_boundaries(self.boundaries_path, 'name')
+        self.assertEqual(list(boundaries), ['Weddell Sea', 'Filchner Trough'])
+        self.assertEqual(load_bioregions(boundaries), 1)  # Weddell Sea already exists
+        self.assertEqual(Bioregion.objects.count(), 2)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(assign_bioregions(), 1)  # The smallest region wins, others are unchanged
+        self.assertEqual(self.bioregion_names(), {1: "Weddell Sea", 2: "Filchner Trough", 3: "Weddell Sea"})
+
+    def test_admin_saves(self):
+        load_bioregions(read_boundaries(self.boundaries_path, 'name'))
+
+        specimen_admin = SpecimenAdmin(Specimen, admin.site)
+        specimen_admin.save_model(None, self.filchner, Mock(changed_data=['station']), change=True)
+        self.assertEqual(self.bioregion_names()[2], "Filchner Trough")
+
+        # Unless chosen by hand
+        self.filchner.bioregion = Bioregion.objects.create(name="Other")
+        specimen_admin.save_model(None, self.filchner, Mock(changed_data=['bioregion']), change=True)
+        self.assertEqual(self.bioregion_names()[2], "Other")
+
+        # Moving a station reassigns its specimens
+        station = self.weddell.station
+        station.coordinates = Point(-36, -75)
+        StationAdmin(Station, admin.site).save_model(None, station, Mock(changed_data=['coordinates']), change=True)
+        self.assertEqual(self.bioregion_names()[1], "Filchner Trough")
+
+    def test_command(self):
+        call_command('load_bioregions', self.boundaries_path, '--assign', stdout=io.StringIO())
+        self.assertEqual(self.bioregion_names()[2], "Filchner Trough")
+
+
+class ReplicaRouterTestCase(SimpleTestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+
+    @patch('specimens.routers.replica_configured', return_value=True)
+    def test_routing(self, _):
+        self.assertEqual(self.router.db_for_read(Specimen), 'default')
+        with use_replica():
+            with use_replica():
+                self.assertEqual(self.router.db_for_read(Specimen), REPLICA_DATABASE)
+            self.assertEqual(self.router.db_for_read(Specimen), REPLICA_DATABASE)
+            self.assertEqual(self.router.db_for_write(Specimen), 'default')
+        self.assertEqual(self.router.db_for_read(Specimen), 'default')
+
+    @patch('specimens.routers.replica_configured', return_value=True)
+    def test_pinning(self, _):
+        with pinning() as has_written, use_replica():
+            self.assertEqual(self.router.db_for_read(Specimen), REPLICA_DATABASE)
+            self.router.db_for_write(Specimen)
+            self.assertTrue(has_written())
+            self.assertEqual(self.router.db_for_read(Specimen), 'default')
+
+        # Outside requests (commands), writes don't pin
+        with use_replica():
+            self.router.db_for_write(Specimen)
+            self.assertEqual(self.router.db_for_read(Specimen), REPLICA_DATABASE)
+
+    @patch('specimens.routers.replica_configured', return_value=False)
+    def test_no_replica(self, _):
+        with use_replica():
+            self.assertEqual(self.router.db_for_read(Specimen), 'default')
+
+
+@skipUnless(REPLICA_DATABASE in settings.DATABASES, 'No replica database (see website/settings_test_replica.py)')
+class ReplicaRoutingTestCase(TestCase):
+    multi_db = True
+
+    def setUp(self):
+        # Only in the primary: the test replica is not replicated
+        expedition = Expedition.objects.create(name="ANT XXVII/3 (CAMBIO)")
+        Station.objects.create(name="PS77/239-3", expedition=expedition, coordinates=Point(-57, -62))
+
+    def test_reads(self):
+        with use_replica():
+            self.assertFalse(Station.objects.exists())
+            Expedition.objects.create(name="JR144")  # Writes go to the primary
+        self.assertEqual(Expedition.objects.count(), 2)
+
+    def test_api(self):
+        response = self.client.get(reverse('specimens:station_clusters'))
+        self.assertEqual(json.loads(response.content.decode('utf-8'))['features'], [])
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+    def test_changelist_opt_in(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+        changelist_url = reverse('admin:specimens_station_changelist')
+
+        def stations_count():
+            return len(self.client.get(changelist_url).context['cl'].result_list)
+
+        self.assertEqual(stations_count(), 1)
+
+        response = self.client.get(reverse('admin:specimens_station_replica_reads'), {'on': '1'})
+        self.assertIn(PIN_COOKIE, response.cookies)  # The session has been written
+        self.assertEqual(stations_count(), 1)  # So reads stay on the primary for a while
+
+        del self.client.cookies[PIN_COOKIE]
+        self.assertEqual(stations_count(), 0)
+
+
+class TestRunnerTestCase(SimpleTestCase):
+    def test_performance_tests_only_on_demand(self):
+        self.assertIn(PERFORMANCE_TAG, AstaporTestRunner().exclude_tags)
+        self.assertIn(PERFORMANCE_TAG, AstaporTestRunner(tags=['slow']).exclude_tags)
+        self.assertNotIn(PERFORMANCE_TAG, AstaporTestRunner(tags=[PERFORMANCE_TAG]).exclude_tags)
@@ -0,0 +1,170 @@
+"""Query count and time budgets of the main admin pages and actions, on a collection of realistic size.
+
+They are slow and depend on the machine: the test runner of the project (see runner.py) skips them unless they are
+asked for, e.g. alone (on a local PostGIS database) with:
+
+    python manage.py test specimens --tag performance
+
+The number of seeded specimens can be changed with the ASTAPOR_PERFORMANCE_SPECIMENS environment variable. Query
+budgets don't depend on it (a page shows list_per_page rows): a N+1 problem breaks them whatever the size.
+"""
+import datetime
+import os
+import time
+from contextlib import contextmanager
+
+from psycopg2.extras import NumericRange
+
+from django.contrib.admin.helpers import ACTION_CHECKBOX_NAME
+from django.contrib.auth.models import User
+from django.contrib.gis.geos import Point
+from django.db import connection
+from django.test import TestCase, tag
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from .models import (Specimen, SpecimenPicture, Person, SpecimenLocation, Fixation, Bioregion, Expedition, Gear,
+                     Station, Taxon, TaxonRank, FAMILY_RANK_NAME, GENUS_RANK_NAME, SPECIES_RANK_NAME)
+from .taxonomy import get_taxonomy_snapshot, invalidate_local_snapshot
+
+SPECIMENS_COUNT = int(os.environ.get('ASTAPOR_PERFORMANCE_SPECIMENS', 5000))
+STATIONS_COUNT = 500
+GENERA_COUNT = 10
+SPECIES_PER_GENUS = 10
+PICTURES_EVERY = 10  # One specimen out of PICTURES_EVERY has a picture
+
+PAGE_SECONDS = 2.0
+ACTION_SECONDS = 10.0
+
+
+def seed_collection():
+    """Bulk-create a collection: a few hundred stations, SPECIMENS_COUNT specimens, a small taxonomy."""
+    family_rank = TaxonRank.objects.create(name=FAMILY_RANK_NAME)
+    genus_rank = TaxonRank.objects.create(name=GENUS_RANK_NAME)
+    species_rank = TaxonRank.objects.create(name=SPECIES_RANK_NAME)
+
+    # Taxa are bulk-created with their MPTT fields: one tree per family, with a single genus
+    families = Taxon.objects.bulk_create(
+        Taxon(name='Family{i}dae'.format(i=i), rank=family_rank, tree_id=i + 1, level=0, lft=1,
+              rght=2 * SPECIES_PER_GENUS + 4) for i in range(GENERA_COUNT))
+    genera = Taxon.objects.bulk_create(
+        Taxon(name='Genus{i}'.format(i=i), rank=genus_rank, parent=family, tree_id=family.tree_id, level=1, lft=2,
+              rght=2 * SPECIES_PER_GENUS + 3) for i, family in enumerate(families))
+    species = Taxon.objects.bulk_create(
+        Taxon(name='species{j}'.format(j=j), rank=species_rank, parent=genus, tree_id=genus.tree_id, level=2,
+              lft=3 + 2 * j, rght=4 + 2 * j) for genus in genera for j in range(SPECIES_PER_GENUS))
+
+    people = Person.objects.bulk_create(Person(first_name='First{i}'.format(i=i), last_name='Last{i}'.format(i=i))
+                                        for i in range(20))
+    locations = SpecimenLocation.objects.bulk_create(SpecimenLocation(name='Location {i}'.format(i=i))
+                                                     for i in range(5))
+    fixations = Fixation.objects.bulk_create(Fixation(name='Fixation {i}'.format(i=i)) for i in range(5))
+    bioregions = Bioregion.objects.bulk_create(Bioregion(name='Bioregion {i}'.format(i=i)) for i in range(5))
+    gears = Gear.objects.bulk_create(Gear(name='Gear {i}'.format(i=i)) for i in range(5))
+    expeditions = Expedition.objects.bulk_create(Expedition(name='Expedition {i}'.format(i=i)) for i in range(20))
+
+    stations = Station.objects.bulk_create(
+        Station(name='ST{i}'.format(i=i), expedition=expeditions[i % len(expeditions)], gear=gears[i % len(gears)],
+                coordinates=Point(-180 + i % 360, -60 - i % 30), depth=NumericRange(i % 100, i % 100 + 50, '[]'),
+                capture_date_start=datetime.date(2000 + i % 15, 1, 1),
+                capture_date_end=datetime.date(2000 + i % 15, 1, 10))
+        for i in range(STATIONS_COUNT))
+
+    specimens = Specimen.objects.bulk_create(
+        Specimen(specimen_id=i, initial_scientific_name='{g} {s}'.format(g=taxon.parent.name, s=taxon.name),
+                 taxon=taxon if i % 2 else None, identified_by=people[i % len(people)],
+                 specimen_location=locations[i % len(locations)], fixation=fixations[i % len(fixations)],
+                 bioregion=bioregions[i % len(bioregions)], station=stations[i % len(stations)],
+                 vial=str(i), isotope_percentC=20.0, isotope_percentN=5.0, isotope_C_N_ratio=4.0)
+        for i, taxon in ((i, species[i % len(species)]) for i in range(SPECIMENS_COUNT)))
+
+    SpecimenPicture.objects.bulk_create(
+        SpecimenPicture(specimen=specimen, image='specimen_pictures/{pk}.jpg'.format(pk=specimen.pk),
+                        high_interest=False)
+        for specimen in specimens[::PICTURES_EVERY])
+
+
+@tag('performance')
+class AdminPerformanceTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        seed_collection()
+        cls.specimen = Specimen.objects.get(specimen_id=1)
+        cls.station = cls.specimen.station
+        cls.taxon = cls.specimen.taxon
+        cls.admin_user = User.objects.create_superuser('admin', 'admin@example.com', 'password')
+
+    def setUp(self):
+        # Budgets are for a running site, where the caches (taxonomy snapshot, ranks) are already loaded
+        invalidate_local_snapshot()
+        TaxonRank.objects.clear_cache()
+        get_taxonomy_snapshot()
+        TaxonRank.objects.id_for(SPECIES_RANK_NAME)
+
+        self.client.force_login(self.admin_user)
+
+    @contextmanager
+    def assertBudget(self, max_queries, max_seconds):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            yield
+            duration = time.perf_counter() - start
+
+        self.assertLessEqual(len(queries), max_queries, 'Too many queries:\n' + '\n'.join(
+            query['sql'] for query in queries.captured_queries))
+        self.assertLessEqual(duration, max_seconds, 'Too slow: {d:.2f}s'.format(d=duration))
+
+    def get_page(self, url, max_queries, params=None):
+        with self.assertBudget(max_queries, PAGE_SECONDS):
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def post_action(self, action, max_queries, max_seconds=ACTION_SECONDS):
+        url = reverse('admin:specimens_specimen_changelist')
+        with self.assertBudget(max_queries, max_seconds):
+            response = self.client.post(url, {'action': action, 'select_across': '1', 'index': 0,
+                                              ACTION_CHECKBOX_NAME: [self.specimen.pk]})
+        self.assertEqual(response.status_code, 302)
+
+    # Session, user, counts (2), page and the list filters' choices
+    def test_specimen_changelist(self):
+        response = self.get_page(reverse('admin:specimens_specimen_changelist'), 14)
+        self.assertEqual(len(response.context['cl'].result_list), response.context['cl'].list_per_page)
+
+    def test_specimen_changelist_search(self):
+        self.get_page(reverse('admin:specimens_specimen_changelist'), 14, {'q': 'Genus1'})
+
+    def test_station_changelist(self):
+        self.get_page(reverse('admin:specimens_station_changelist'), 8)
+
+    def test_specimen_changelist_station_filters(self):
+        self.get_page(reverse('admin:specimens_specimen_changelist'), 14,
+                      {'capture_year': '2008', 'capture_season': 'summer', 'depth': '0'})
+
+    def test_taxon_changelist(self):
+        self.get_page(reverse('admin:specimens_taxon_changelist'), 7)
+
+    # Session, user, object, inline(s) and the labels of the selected foreign keys
+    def test_specimen_change_form(self):
+        # + its sequence (see SpecimenSequence)
+        self.get_page(reverse('admin:specimens_specimen_change', args=[self.specimen.pk]), 13)
+
+    def test_station_change_form(self):
+        self.get_page(reverse('admin:specimens_station_change', args=[self.station.pk]), 6)
+
+    def test_taxon_change_form(self):
+        self.get_page(reverse('admin:specimens_taxon_change', args=[self.taxon.pk]), 8)
+
+    # Actions are a constant number of queries, whatever the number of selected specimens
+    def test_mark_uncertain_identification_action(self):
+        self.post_action('mark_uncertain_identification', 8)
+        self.assertFalse(Specimen.objects.filter(uncertain_identification=False).exists())
+
+    def test_background_export_action(self):
+        self.post_action('export_csv_in_background', 8)
+
+    def test_reconcile_taxon_action(self):
+        # One update per distinct matching name (i.e. per species)
+        self.post_action('reconcile_taxon', 8 + GENERA_COUNT * SPECIES_PER_GENUS)
+        self.assertFalse(Specimen.objects.filter(taxon__isnull=True).exists())
@@ -0,0 +1,9 @@
+from django.conf.urls import url
+
+from . import views
+
+app_name = 'specimens'
+
+urlpatterns = [
+    url(r'^station_clusters/$', views.station_clusters, name='station_clusters'),
+]
@@ -1,3 +1,51 @@
-from django.shortcuts import render
+from django.contrib.gis.geos import Polygon
+from django.db import connection
+from django.http import JsonResponse, HttpResponseBadRequest
+from django.views.decorators.http import require_GET
 
-# Create your views here.
+from . import clustering
+from .models import StationCluster
+from .routers import use_replica
+
+
+@require_GET
+@use_replica()
+def station_clusters(request):
+    """GeoJSON FeatureCollection of the (precomputed) station clusters at the requested zoom level.
+
+    Parameters:
+        - zoom: map zoom level (default: 0)
+        - bbox: optional, only return clusters in this box (format: min_x,min_y,max_x,max_y)
+        - srid: SRID of bbox (default: 4326, so bbox is min_lon,min_lat,max_lon,max_lat)
+    """
+    try:
+        zoom = int(request.GET.get('zoom', 0))
+        srid = int(request.GET.get('srid', 4326))
+        bbox = request.GET.get('bbox')
+        if bbox:
+            bbox = [float(v) for v in bbox.split(',')]
+            if len(bbox) != 4:
+                raise ValueError
+    except ValueError:
+        return HttpResponseBadRequest("Invalid zoom, srid or bbox parameter.")
+
+    # PostGIS can't transform from an SRID it doesn't know
+    if bbox and not connection.ops.spatial_ref_sys().objects.filter(srid=srid).exists():
+        return HttpResponseBadRequest("Unknown srid.")
+
+    zoom = min(max(zoom, min(clustering.ZOOM_LEVELS)), max(clustering.ZOOM_LEVELS))
+
+    clusters = StationCluster.objects.filter(zoom=zoom)
+    if bbox:
+        area = Polygon.from_bbox(bbox)
+        area.srid = srid
+        clusters = clusters.filter(coordinates__intersects=area)
+
+    features = [{
+        'type': 'Feature',
+        'geometry': {'type': 'Point', 'coordinates': [coordinates.x, coordinates.y]},
+        'properties': {'stations_count': stations_count, 'specimens_count': specimens_count}
+    } for coordinates, stations_count, specimens_count in clusters.values_list('coordinates', 'stations_count',
+                                                                                'specimens_count')]
+
+    return JsonResponse({'type': 'FeatureCollection', 'features': features})
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'specimens.routers.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -53,6 +54,9 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'website.urls'
 
+# Skips the performance tests, unless run with --tag performance
+TEST_RUNNER = 'specimens.runner.AstaporTestRunner'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
@@ -71,6 +75,9 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'website.wsgi.application'
 
+# Heavy reads go to DATABASES['replica'] if there is one (see settings_local.template.py and specimens/routers.py)
+DATABASE_ROUTERS = ['specimens.routers.ReplicaRouter']
+
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
 
@@ -109,6 +116,10 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Files of the background exports (see specimens/exports.py). Not under MEDIA_ROOT: the admin serves them, only to the
+# users who requested them.
+EXPORTS_ROOT = os.path.join(BASE_DIR, 'private', 'exports')
+
 DISABLE_VIAL_UNIQUENESS_VALIDATION = False
 DISABLE_MNHN_UNIQUENESS_VALIDATION = False
 
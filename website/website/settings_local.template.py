@@ -11,6 +11,14 @@ DATABASES = {
         'USER': 'mydatabaseuser',
         'NAME': 'mydatabase',
     },
+    # Optional read replica (streaming replication of default), for exports, analytics and the API
+    # 'replica': {
+    #     'ENGINE': 'django.contrib.gis.db.backends.postgis',
+    #     'USER': 'mydatabaseuser',
+    #     'NAME': 'mydatabase',
+    #     'HOST': 'replica.example.org',
+    #     'TEST': {'MIRROR': 'default'},
+    # },
 }
 
 MEDIA_ROOT = ''
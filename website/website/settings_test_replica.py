@@ -0,0 +1,9 @@
+# Settings to test the routing to the read replica (see specimens/routers.py):
+#
+#     python manage.py test specimens.tests.ReplicaRoutingTestCase --settings=website.settings_test_replica
+#
+# The replica is a second local database, not replicated: an object written in a test is only found in the primary,
+# which shows where the reads went. Other tests expect a single database.
+from .settings import *
+
+DATABASES['replica'] = dict(DATABASES['default'], NAME=DATABASES['default']['NAME'] + '_replica')
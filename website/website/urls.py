@@ -22,4 +22,5 @@ from django.conf import settings
 urlpatterns = [
     url(r'^admin/', admin.site.urls),
     url(r'^export_action/', include(("export_action.urls", "export_action"), "export_action")),
+    url(r'^api/', include('specimens.urls')),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)